@@ -76,7 +76,8 @@ kwargs = dict(
     install_requires=[
         'tqdm==3.8.0',  # FIXME: Remove once ADAM stops using it (superfluous import)
         'pyyaml==3.11',
-        'biopython==1.67'],
+        'biopython==1.67',
+        'numpy==1.11.1'],  # For the vg pipeline's alignment stats and memory-mapped node store
     tests_require=[
         'pytest==2.8.3'],
     package_dir={'': 'src'},
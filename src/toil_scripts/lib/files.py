@@ -3,6 +3,9 @@ import os
 import tarfile
 import shutil
 
+# How big a buffer should we move data around in when concatenating files?
+COPY_BUFFER_SIZE = 16 * 1024 * 1024
+
 
 def tarball_files(tar_name, file_paths, output_dir='.', prefix=''):
     """
@@ -35,6 +38,32 @@ def copy_files(file_paths, output_dir):
         shutil.copy(file_path, dest)
 
 
+def concatenate_files(file_paths, out_handle, buffer_size=COPY_BUFFER_SIZE, remove=False):
+    """
+    Appends the contents of each file, in order, to an open binary file handle.
+
+    file_paths can be any iterable, including a generator that yields each file
+    as soon as it is ready, so that fetching later files can overlap with
+    copying earlier ones. Data is moved in large fixed-size buffers, without
+    regard for lines, so binary formats are copied exactly.
+
+    :param iter[str] file_paths: Paths of files to concatenate
+    :param file out_handle: Binary file handle to write to
+    :param int buffer_size: Size of the buffer to copy through, in bytes
+    :param bool remove: If True, delete each file once it has been copied
+    :return: Total number of bytes written
+    :rtype: int
+    """
+    total_bytes = 0
+    for file_path in file_paths:
+        with open(file_path, 'rb') as f_in:
+            shutil.copyfileobj(f_in, out_handle, buffer_size)
+            total_bytes += f_in.tell()
+        if remove:
+            os.unlink(file_path)
+    return total_bytes
+
+
 def copy_file_job(job, name, file_id, output_dir):
     """
     Job version of move_files for one file
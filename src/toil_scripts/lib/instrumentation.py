@@ -0,0 +1,414 @@
+import csv
+import functools
+import inspect
+import json
+import logging
+import os
+import resource
+import socket
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+from toil_scripts.lib.toillib import RealTimeLogger
+
+# Columns of the timeline, in order. Any other tags go after these.
+TIMELINE_FIELDS = ['sample', 'name', 'status', 'start', 'end', 'wall_seconds', 'cpu_seconds', 'peak_rss_bytes',
+                   'filestore_read_bytes', 'filestore_write_bytes', 'docker_calls', 'docker_seconds', 'host', 'pid']
+
+# How many seconds apart is resident memory sampled while measuring?
+RSS_SAMPLE_SECONDS = 0.5
+
+# Container time is added up here by docker_call, for whichever measurements are running
+_docker_lock = threading.Lock()
+_docker_totals = {'calls': 0, 'seconds': 0.0}
+
+
+def record_docker_time(seconds):
+    """
+    Counts one container run of the given wall time towards any running measurements
+
+    :param float seconds: How long the container took
+    """
+    with _docker_lock:
+        _docker_totals['calls'] += 1
+        _docker_totals['seconds'] += seconds
+
+
+# What the jobs being measured asked for, innermost last, for docker_call to hold its containers to
+_job_resources = []
+
+
+def job_resources():
+    """
+    :return: The `cores` and `memory` requirements of the innermost job being measured, or None if there isn't one
+    :rtype: dict
+    """
+    return _job_resources[-1] if _job_resources else None
+
+
+def _docker_snapshot():
+    with _docker_lock:
+        return dict(_docker_totals)
+
+
+def _cpu_seconds():
+    """
+    :return: User and system CPU time of this process and its waited-for children
+    :rtype: float
+    """
+    total = 0.0
+    for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN):
+        usage = resource.getrusage(who)
+        total += usage.ru_utime + usage.ru_stime
+    return total
+
+
+def _peak_rss_bytes(who=resource.RUSAGE_SELF):
+    """
+    :param int who: RUSAGE_SELF for this process, or RUSAGE_CHILDREN for its largest waited-for child
+    :return: Peak resident set size over the whole life of the process
+    :rtype: int
+    """
+    # Linux reports kilobytes
+    return 1024 * resource.getrusage(who).ru_maxrss
+
+
+def _rss_bytes():
+    """
+    :return: Current resident set size of this process, or None where /proc can't tell
+    :rtype: int
+    """
+    try:
+        with open('/proc/self/status') as f_in:
+            for line in f_in:
+                if line.startswith('VmRSS:'):
+                    # Linux reports kilobytes
+                    return 1024 * int(line.split()[1])
+    except IOError:
+        pass
+    return None
+
+
+class _RSSSampler(object):
+    """
+    Samples the resident set size of this process in the background while running. The peak that getrusage reports
+    covers the whole life of the process, so on its own it would charge every job with the peak of whichever job ran
+    in the same worker before it.
+    """
+    def __init__(self, interval=None):
+        self.interval = interval or RSS_SAMPLE_SECONDS
+        self.peak = _rss_bytes()
+        self.children_start = _peak_rss_bytes(resource.RUSAGE_CHILDREN)
+        self.done = threading.Event()
+        self.thread = None
+        if self.peak is not None:
+            self.thread = threading.Thread(target=self._run)
+            self.thread.daemon = True
+            self.thread.start()
+
+    def _run(self):
+        while not self.done.wait(self.interval):
+            self._sample()
+
+    def _sample(self):
+        rss = _rss_bytes()
+        if rss is not None:
+            self.peak = max(self.peak, rss)
+
+    def stop(self):
+        """
+        :return: Peak resident set size of this process while sampling, or of a child that finished in that time if
+                 that was bigger. Where /proc isn't available, the peak over the whole life of the process instead.
+                 Containers run under the docker daemon, so their memory is not included.
+        :rtype: int
+        """
+        children_peak = _peak_rss_bytes(resource.RUSAGE_CHILDREN)
+        if self.thread is None:
+            return max(_peak_rss_bytes(), children_peak)
+        self.done.set()
+        self.thread.join()
+        self._sample()
+        # The children's peak only moves if a bigger child finished while we were sampling
+        return max(self.peak, children_peak if children_peak > self.children_start else 0)
+
+
+class _CountingFile(object):
+    """
+    Wraps a file object to count the bytes read from or written to it
+    """
+    def __init__(self, handle, counts, key):
+        self._handle = handle
+        self._counts = counts
+        self._key = key
+
+    def read(self, *args):
+        data = self._handle.read(*args)
+        self._counts[self._key] += len(data)
+        return data
+
+    def readline(self, *args):
+        data = self._handle.readline(*args)
+        self._counts[self._key] += len(data)
+        return data
+
+    def __iter__(self):
+        for line in self._handle:
+            self._counts[self._key] += len(line)
+            yield line
+
+    def write(self, data):
+        self._counts[self._key] += len(data)
+        return self._handle.write(data)
+
+    def __getattr__(self, name):
+        return getattr(self._handle, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return self._handle.__exit__(*exc_info)
+
+
+@contextmanager
+def _count_file_store(file_store, counts):
+    """
+    Counts bytes moved through the given Toil file store into counts['filestore_read_bytes'] and
+    counts['filestore_write_bytes'] for the duration of the context, by wrapping its global file methods.
+    """
+    originals = {}
+    for name in ['readGlobalFile', 'writeGlobalFile', 'readGlobalFileStream', 'writeGlobalFileStream']:
+        if hasattr(file_store, name):
+            originals[name] = (getattr(file_store, name), name in vars(file_store))
+
+    def read_file(*args, **kwargs):
+        path = originals['readGlobalFile'][0](*args, **kwargs)
+        counts['filestore_read_bytes'] += os.path.getsize(path)
+        return path
+
+    def write_file(local_path, *args, **kwargs):
+        counts['filestore_write_bytes'] += os.path.getsize(local_path)
+        return originals['writeGlobalFile'][0](local_path, *args, **kwargs)
+
+    @contextmanager
+    def read_stream(*args, **kwargs):
+        with originals['readGlobalFileStream'][0](*args, **kwargs) as handle:
+            yield _CountingFile(handle, counts, 'filestore_read_bytes')
+
+    @contextmanager
+    def write_stream(*args, **kwargs):
+        with originals['writeGlobalFileStream'][0](*args, **kwargs) as (handle, file_id):
+            yield _CountingFile(handle, counts, 'filestore_write_bytes'), file_id
+
+    wrappers = {'readGlobalFile': read_file, 'writeGlobalFile': write_file,
+                'readGlobalFileStream': read_stream, 'writeGlobalFileStream': write_stream}
+    for name in originals:
+        setattr(file_store, name, wrappers[name])
+    try:
+        yield
+    finally:
+        for name, (original, was_own) in originals.iteritems():
+            if was_own:
+                setattr(file_store, name, original)
+            else:
+                delattr(file_store, name)
+
+
+@contextmanager
+def measure(name, job=None, **tags):
+    """
+    Measures the enclosed code, and emits the measurements as a structured event through RealTimeLogger when it
+    finishes, successfully or not. The event's log record carries them in its `metrics` attribute, as a dict with
+    the TIMELINE_FIELDS and the given tags. Yields that dict, so callers can add tags of their own.
+
+    :param str name: What is being measured, usually the job function's name
+    :param JobFunctionWrappingJob job: If given, bytes through its file store are counted, and its resource
+                                       requirements are available from `job_resources` for the duration
+    :param dict tags: Extra fields for the event, such as `sample`
+    """
+    metrics = {'name': name, 'sample': None, 'host': socket.gethostname(), 'pid': os.getpid()}
+    metrics.update(tags)
+    counts = defaultdict(int)
+    docker_start = _docker_snapshot()
+    cpu_start = _cpu_seconds()
+    rss_sampler = _RSSSampler()
+    start = time.time()
+    metrics['status'] = 'failed'
+    if job is not None:
+        _job_resources.append({'cores': getattr(job, 'cores', None), 'memory': getattr(job, 'memory', None)})
+    try:
+        if job is not None and getattr(job, 'fileStore', None) is not None:
+            with _count_file_store(job.fileStore, counts):
+                yield metrics
+        else:
+            yield metrics
+        metrics['status'] = 'ok'
+    finally:
+        if job is not None:
+            _job_resources.pop()
+        end = time.time()
+        docker_end = _docker_snapshot()
+        metrics.update({'start': start,
+                        'end': end,
+                        'wall_seconds': end - start,
+                        'cpu_seconds': _cpu_seconds() - cpu_start,
+                        'peak_rss_bytes': rss_sampler.stop(),
+                        'filestore_read_bytes': counts['filestore_read_bytes'],
+                        'filestore_write_bytes': counts['filestore_write_bytes'],
+                        'docker_calls': docker_end['calls'] - docker_start['calls'],
+                        'docker_seconds': docker_end['seconds'] - docker_start['seconds']})
+        RealTimeLogger.get().info('{name} {status}: {wall_seconds:.1f}s wall, {cpu_seconds:.1f}s CPU, '
+                                  '{docker_seconds:.1f}s in {docker_calls} containers'.format(**metrics),
+                                  extra={'metrics': metrics})
+
+
+def _find_sample(function, args, kwargs):
+    """
+    Guesses which sample a job function call is for, from an argument called `uuid`, `sample` or `sample_name`,
+    or from such an attribute of a config or options argument.
+    """
+    try:
+        call_args = inspect.getcallargs(function, *args, **kwargs)
+    except TypeError:
+        return None
+    for name in ['uuid', 'sample', 'sample_name']:
+        if isinstance(call_args.get(name), basestring):
+            return call_args[name]
+    for value in call_args.values():
+        for name in ['uuid', 'sample_name']:
+            if isinstance(getattr(value, name, None), basestring):
+                return getattr(value, name)
+    return None
+
+
+def instrumented(function):
+    """
+    Decorates a Toil job function, which takes the job as its first argument, so each run of it is measured as
+    by `measure`, and tagged with its sample when one can be found in its arguments.
+
+    :param function function: Job function to wrap
+    """
+    @functools.wraps(function)
+    def wrapper(job, *args, **kwargs):
+        sample = _find_sample(function, (job,) + args, kwargs)
+        with measure(function.__name__, job=job, sample=sample):
+            return function(job, *args, **kwargs)
+    return wrapper
+
+
+class MetricsCollector(logging.Handler):
+    """
+    Collects the measurement events that jobs send to the master, and writes them out as a timeline per sample.
+    """
+    # Which log record attribute holds the events to collect?
+    attribute = 'metrics'
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.events = []
+
+    def emit(self, record):
+        event = getattr(record, self.attribute, None)
+        if isinstance(event, dict):
+            self.events.append(event)
+
+    def install(self, logger_name='remote'):
+        """
+        Starts collecting events from the given logger, which by default is the one the master's RealTimeLogger
+        server passes job records to
+
+        :param str logger_name: Name of the logger to collect from
+        """
+        logging.getLogger(logger_name).addHandler(self)
+        return self
+
+    def write(self, output_dir):
+        """
+        Writes a <sample>_timeline.json and <sample>_timeline.csv for each sample, ordered by start time. Events
+        with no sample go under `all`.
+
+        :param str output_dir: Directory to write the timelines to
+        :return: Paths of the files written
+        :rtype: list[str]
+        """
+        by_sample = defaultdict(list)
+        for event in self.events:
+            by_sample[event.get('sample') or 'all'].append(event)
+        paths = []
+        for sample, events in sorted(by_sample.iteritems()):
+            events.sort(key=lambda event: event.get('start'))
+            json_path = os.path.join(output_dir, '{}_timeline.json'.format(sample))
+            with open(json_path, 'w') as f_out:
+                json.dump(events, f_out, indent=1, sort_keys=True)
+            extra = sorted(set(key for event in events for key in event) - set(TIMELINE_FIELDS))
+            csv_path = os.path.join(output_dir, '{}_timeline.csv'.format(sample))
+            with open(csv_path, 'wb') as f_out:
+                writer = csv.DictWriter(f_out, TIMELINE_FIELDS + extra)
+                writer.writeheader()
+                for event in events:
+                    writer.writerow(event)
+            paths.extend([json_path, csv_path])
+        return paths
+
+
+class DockerProfileCollector(MetricsCollector):
+    """
+    Collects the profiles that docker_call sends to the master for each container run, and reports where the time
+    spent in docker_call goes: starting containers, running the tools, and fixing ownership of their output.
+    """
+    attribute = 'docker_profile'
+
+    def summary(self):
+        """
+        Adds up the profiles per tool. Profiles of calls that ran several tools count towards all of them.
+
+        :return: Totals for each tool, and for all calls under `all`, of `calls` and of `total_seconds`,
+                 `start_seconds`, `run_seconds`, `chown_seconds` and `throttled_seconds`, with `overhead_seconds`
+                 being the time outside the tools themselves
+        :rtype: dict[str,dict]
+        """
+        totals = defaultdict(lambda: defaultdict(float))
+        for event in self.events:
+            for key in set(event.get('tools') or []) | {'all'}:
+                tool_totals = totals[key]
+                tool_totals['calls'] += 1
+                for field in ['total_seconds', 'start_seconds', 'run_seconds', 'chown_seconds', 'throttled_seconds']:
+                    tool_totals[field] += event.get(field) or 0.0
+        for tool_totals in totals.itervalues():
+            tool_totals['calls'] = int(tool_totals['calls'])
+            tool_totals['overhead_seconds'] = tool_totals['total_seconds'] - tool_totals['run_seconds']
+        return {key: dict(value) for key, value in totals.iteritems()}
+
+    def report(self):
+        """
+        :return: A table of the summary, most expensive tool first, ending with the share of docker_call time spent
+                 outside the tools
+        :rtype: str
+        """
+        summary = self.summary()
+        lines = ['{:<40} {:>6} {:>10} {:>10} {:>10} {:>10} {:>11} {:>9}'.format(
+            'tool', 'calls', 'total_s', 'start_s', 'run_s', 'chown_s', 'throttled_s', 'overhead')]
+        for tool, totals in sorted(summary.iteritems(), key=lambda item: (item[0] == 'all', -item[1]['total_seconds'])):
+            share = totals['overhead_seconds'] / totals['total_seconds'] if totals['total_seconds'] else 0.0
+            lines.append('{:<40} {:>6} {:>10.2f} {:>10.2f} {:>10.2f} {:>10.2f} {:>11.2f} {:>8.1f}%'.format(
+                tool, totals['calls'], totals['total_seconds'], totals['start_seconds'], totals['run_seconds'],
+                totals['chown_seconds'], totals['throttled_seconds'], 100 * share))
+        return '\n'.join(lines)
+
+    def write(self, output_dir):
+        """
+        Writes all the profiles to docker_profile.json, with the summary, and the report to docker_profile.txt
+
+        :param str output_dir: Directory to write the report to
+        :return: Paths of the files written
+        :rtype: list[str]
+        """
+        json_path = os.path.join(output_dir, 'docker_profile.json')
+        with open(json_path, 'w') as f_out:
+            json.dump({'calls': self.events, 'summary': self.summary()}, f_out, indent=1, sort_keys=True)
+        text_path = os.path.join(output_dir, 'docker_profile.txt')
+        with open(text_path, 'w') as f_out:
+            f_out.write(self.report() + '\n')
+        return [json_path, text_path]
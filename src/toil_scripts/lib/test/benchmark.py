@@ -0,0 +1,173 @@
+"""
+Micro-benchmarks for toil_scripts.lib helpers, run against local stand-ins for the services they talk to.
+
+example run: python -m toil_scripts.lib.test.benchmark download --download_mb 1024 --rate_mb 20
+example run: python -m toil_scripts.lib.test.benchmark docker --calls 50 --image ubuntu
+"""
+import argparse
+import distutils.spawn
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from toil_scripts.lib.test.range_server import RangeHTTPServer, RangeRequestHandler
+
+
+def best_time(repeat, function, *args):
+    """
+    Calls function repeat times and returns its last result and the shortest wall-clock time it took
+
+    :param int repeat: Number of timed calls
+    :param function function: Function to call
+    :return: The function's result and the shortest time in seconds
+    :rtype: tuple(object, float)
+    """
+    times = []
+    result = None
+    for _ in xrange(repeat):
+        start_time = time.time()
+        result = function(*args)
+        times.append(time.time() - start_time)
+    return result, min(times)
+
+
+def bench_download(options):
+    """
+    Times downloading a file from a local HTTP server that limits each connection's rate, with curl as download_url
+    used to, and with the native downloader on one connection, on several, and against a server without ranges. Also
+    times resuming a download that was cut off halfway.
+
+    :param Namespace options: Parsed command line options
+    :return: Exit code
+    :rtype: int
+    """
+    from toil_scripts.lib import urls
+
+    serve_dir = tempfile.mkdtemp()
+    work_dir = tempfile.mkdtemp()
+    old_dir = os.getcwd()
+    os.chdir(serve_dir)
+    server = RangeHTTPServer(('127.0.0.1', 0), RangeRequestHandler)
+    server.rate = options.rate_mb * 1e6 or None
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    try:
+        with open('input.bin', 'wb') as handle:
+            block = os.urandom(1024 * 1024)
+            for _ in xrange(options.download_mb):
+                handle.write(block)
+        size = os.path.getsize('input.bin')
+        url = 'http://127.0.0.1:{}/input.bin'.format(server.server_address[1])
+        output = os.path.join(work_dir, 'output.bin')
+
+        def native(threads):
+            urls.download_url(url, work_dir=work_dir, name='output.bin', threads=threads)
+
+        def curl():
+            subprocess.check_call(['curl', '-fs', '--retry', '5', url, '-o', output])
+
+        def no_ranges():
+            server.ranges = False
+            try:
+                native(options.threads)
+            finally:
+                server.ranges = True
+
+        def resume():
+            # Pretend the first half of the segments made it last time
+            segments = urls.split_ranges(size, urls.SEGMENT_SIZE)
+            with open(output + '.part', 'wb') as part_file:
+                part_file.truncate(size)
+            with open(output + '.part.json', 'w') as state_file:
+                json.dump({'url': url, 'size': size,
+                           'validator': '"{}-{}"'.format(size, int(os.path.getmtime('input.bin'))),
+                           'done': [list(segment) for segment in segments[:len(segments) // 2]]}, state_file)
+            native(options.threads)
+
+        print('mode                  time (s)  MB/s')
+        modes = [('curl', curl),
+                 ('native 1 connection', lambda: native(1)),
+                 ('native {} connections'.format(options.threads), lambda: native(options.threads)),
+                 ('native, no ranges', no_ranges),
+                 ('native, resume half', resume)]
+        for mode, function in modes:
+            if mode == 'curl' and not distutils.spawn.find_executable('curl'):
+                continue
+            _, download_time = best_time(options.repeat, function)
+            assert os.path.getsize(output) == size
+            os.unlink(output)
+            print('{:21} {:9.2f}  {:6.1f}'.format(mode, download_time, size / 1e6 / download_time))
+    finally:
+        # Let the server's connection threads finish
+        urls.close_connections()
+        server.shutdown()
+        server.server_close()
+        os.chdir(old_dir)
+        shutil.rmtree(serve_dir)
+        shutil.rmtree(work_dir)
+    return 0
+
+
+def bench_docker(options):
+    """
+    Times a run of small docker_call calls, as jobs like samtools indexing make them, with a new container per call
+    and in a warm container session. Needs docker.
+
+    :param Namespace options: Parsed command line options
+    :return: Exit code
+    :rtype: int
+    """
+    from toil_scripts.lib.programs import docker_call, docker_session
+
+    work_dir = tempfile.mkdtemp()
+    try:
+        def run_calls():
+            for call in xrange(options.calls):
+                docker_call(tool=options.image, work_dir=work_dir,
+                            parameters=['touch', '/data/file_{}'.format(call)],
+                            outputs={'file_{}'.format(call): None}, mock=False)
+
+        def in_session():
+            with docker_session():
+                run_calls()
+
+        # Make sure the image is pulled before anything is timed
+        docker_call(tool=options.image, work_dir=work_dir, parameters=['true'], mock=False)
+
+        print('mode     calls  total (s)  per call (s)')
+        for mode, function in [('run', run_calls), ('session', in_session)]:
+            _, total_time = best_time(options.repeat, function)
+            print('{:8} {:5}  {:9.2f}  {:12.3f}'.format(mode, options.calls, total_time, total_time / options.calls))
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return 0
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('benchmark', choices=['download', 'docker'], help='Benchmark to run')
+    parser.add_argument('--repeat', type=int, default=3, help='Number of timed runs; the fastest is reported')
+    parser.add_argument('--download_mb', type=int, default=256,
+                        help='Size of the file to serve for the download benchmark, in megabytes')
+    parser.add_argument('--rate_mb', type=float, default=10,
+                        help="Megabytes per second the download benchmark's server sends on each connection, "
+                             "like a remote server would, or 0 for no limit")
+    parser.add_argument('--threads', type=int, default=8, help='Number of connections for parallel downloads')
+    parser.add_argument('--calls', type=int, default=20, help='Number of small tool calls for the docker benchmark')
+    parser.add_argument('--image', type=str, default='ubuntu', help='Docker image to make the small tool calls in')
+    options = parser.parse_args(args)
+
+    if options.benchmark == 'download':
+        return bench_download(options)
+    elif options.benchmark == 'docker':
+        return bench_docker(options)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,67 @@
+import BaseHTTPServer
+import os
+import SimpleHTTPServer
+import SocketServer
+import time
+
+
+class RangeRequestHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
+    """
+    Serves files from the current directory like SimpleHTTPServer, but supports single byte ranges as well, like the
+    servers we download inputs from. The server's ranges and rate attributes turn off ranges and limit each
+    connection's bytes per second.
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        path = self.translate_path(self.path)
+        if not os.path.isfile(path):
+            self.send_error(404)
+            return
+        size = os.path.getsize(path)
+        etag = '"{}-{}"'.format(size, int(os.path.getmtime(path)))
+        start, end = 0, size
+        ranged = False
+        range_header = self.headers.getheader('Range')
+        if self.server.ranges and range_header and self.headers.getheader('If-Range', etag) == etag:
+            first, _, last = range_header.split('=', 1)[1].partition('-')
+            start = int(first)
+            end = min(size, int(last) + 1) if last else size
+            if start >= size:
+                self.send_response(416)
+                self.send_header('Content-Range', 'bytes */{}'.format(size))
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            ranged = True
+        self.send_response(206 if ranged else 200)
+        self.send_header('Content-Length', str(end - start))
+        self.send_header('ETag', etag)
+        if ranged:
+            self.send_header('Content-Range', 'bytes {}-{}/{}'.format(start, end - 1, size))
+        self.end_headers()
+        with open(path, 'rb') as handle:
+            handle.seek(start)
+            remaining = end - start
+            while remaining > 0:
+                block = handle.read(min(remaining, 256 * 1024))
+                self.wfile.write(block)
+                remaining -= len(block)
+                if self.server.rate:
+                    time.sleep(len(block) / self.server.rate)
+
+
+class RangeHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """
+    Threaded HTTP server for RangeRequestHandler
+    """
+    daemon_threads = True
+    ranges = True
+    rate = None
+
+    def handle_error(self, request, client_address):
+        # Clients hanging up early are expected
+        pass
@@ -24,6 +24,26 @@ def test_copy_files(tmpdir):
     assert os.path.exists(os.path.join(work_dir, 'test', 'output_file'))
 
 
+def test_concatenate_files(tmpdir):
+    from toil_scripts.lib.files import concatenate_files
+    work_dir = str(tmpdir)
+    contents = [os.urandom(1000), os.urandom(0), os.urandom(4097)]
+    file_paths = []
+    for i, data in enumerate(contents):
+        fpath = os.path.join(work_dir, 'chunk_{}'.format(i))
+        with open(fpath, 'wb') as fout:
+            fout.write(data)
+        file_paths.append(fpath)
+    out_path = os.path.join(work_dir, 'merged')
+    with open(out_path, 'wb') as f_out:
+        # Use a tiny buffer and a generator to make sure neither is assumed to be big or a list
+        total = concatenate_files((fpath for fpath in file_paths), f_out, buffer_size=7, remove=True)
+    assert total == sum(len(data) for data in contents)
+    with open(out_path, 'rb') as f_in:
+        assert f_in.read() == ''.join(contents)
+    assert not any(os.path.exists(fpath) for fpath in file_paths)
+
+
 def test_consolidate_tarballs_job(tmpdir):
     options = Job.Runner.getDefaultOptions(os.path.join(str(tmpdir), 'test_store'))
     Job.Runner.startToil(Job.wrapJobFn(_consolidate_tarball_job_setup), options)
@@ -0,0 +1,137 @@
+import os
+
+
+class _FakeFileStore(object):
+    """
+    Just enough of a Toil file store to move files around in a directory
+    """
+    def __init__(self, directory):
+        self.directory = directory
+
+    def writeGlobalFile(self, local_path, cleanup=False):
+        file_id = os.path.basename(local_path)
+        with open(local_path) as f_in, open(os.path.join(self.directory, file_id), 'w') as f_out:
+            f_out.write(f_in.read())
+        return file_id
+
+    def readGlobalFile(self, file_id, user_path=None):
+        return os.path.join(self.directory, file_id)
+
+
+class _FakeJob(object):
+    cores = 2
+    memory = 1024
+
+    def __init__(self, directory):
+        self.fileStore = _FakeFileStore(directory)
+
+
+class _Config(object):
+    uuid = 'sample-1'
+
+
+def test_instrumented_job(tmpdir):
+    import logging
+    import pytest
+    from toil_scripts.lib.instrumentation import instrumented, record_docker_time, job_resources, MetricsCollector
+    collector = MetricsCollector().install('realtime')
+    try:
+        @instrumented
+        def run_tool(job, config, work_dir):
+            path = os.path.join(work_dir, 'input')
+            with open(path, 'w') as f_out:
+                f_out.write('x' * 1000)
+            file_id = job.fileStore.writeGlobalFile(path)
+            job.fileStore.readGlobalFile(file_id)
+            record_docker_time(2.5)
+            assert job_resources() == {'cores': 2, 'memory': 1024}
+            return file_id
+
+        @instrumented
+        def run_broken(job):
+            raise RuntimeError('tool failed')
+
+        store_dir = str(tmpdir.mkdir('store'))
+        job = _FakeJob(store_dir)
+        assert run_tool(job, _Config(), str(tmpdir)) == 'input'
+        with pytest.raises(RuntimeError):
+            run_broken(job)
+        # The file store goes back to normal afterwards
+        assert 'writeGlobalFile' not in vars(job.fileStore)
+        assert job_resources() is None
+    finally:
+        logging.getLogger('realtime').removeHandler(collector)
+
+    tool, broken = collector.events
+    assert tool['name'] == 'run_tool' and tool['sample'] == 'sample-1' and tool['status'] == 'ok'
+    assert tool['filestore_write_bytes'] == 1000 and tool['filestore_read_bytes'] == 1000
+    assert tool['docker_calls'] == 1 and tool['docker_seconds'] == 2.5
+    assert tool['wall_seconds'] >= 0 and tool['peak_rss_bytes'] > 0
+    assert broken['status'] == 'failed' and broken['sample'] is None
+
+    paths = collector.write(str(tmpdir))
+    assert sorted(os.path.basename(path) for path in paths) == ['all_timeline.csv', 'all_timeline.json',
+                                                               'sample-1_timeline.csv', 'sample-1_timeline.json']
+    with open(os.path.join(str(tmpdir), 'sample-1_timeline.csv')) as f_in:
+        lines = f_in.read().splitlines()
+    assert lines[0].startswith('sample,name,status,start,end,wall_seconds') and len(lines) == 2
+
+
+def test_docker_profile_report(tmpdir):
+    import logging
+    from toil_scripts.lib.instrumentation import DockerProfileCollector
+    collector = DockerProfileCollector().install('realtime')
+    try:
+        logger = logging.getLogger('realtime')
+        for profile in [{'tools': ['quay.io/ucsc_cgl/bwa'], 'mock': False, 'start_seconds': 1.0, 'run_seconds': 6.0,
+                         'chown_seconds': 1.0, 'total_seconds': 8.0},
+                        {'tools': ['quay.io/ucsc_cgl/bwa'], 'mock': False, 'start_seconds': 0.5, 'run_seconds': 1.0,
+                         'chown_seconds': 0.5, 'total_seconds': 2.0},
+                        {'tools': ['quay.io/ucsc_cgl/samtools'], 'mock': True, 'start_seconds': None,
+                         'run_seconds': 0.0, 'chown_seconds': 0.0, 'total_seconds': 0.0}]:
+            logger.info('docker call', extra={'docker_profile': profile})
+        # Ordinary records and job measurements are not docker profiles
+        logger.info('something else', extra={'metrics': {'name': 'run_bwa'}})
+    finally:
+        logging.getLogger('realtime').removeHandler(collector)
+
+    summary = collector.summary()
+    assert summary['quay.io/ucsc_cgl/bwa'] == {'calls': 2, 'total_seconds': 10.0, 'start_seconds': 1.5,
+                                               'run_seconds': 7.0, 'chown_seconds': 1.5, 'throttled_seconds': 0.0,
+                                               'overhead_seconds': 3.0}
+    assert summary['all']['calls'] == 3 and summary['quay.io/ucsc_cgl/samtools']['total_seconds'] == 0.0
+
+    lines = collector.report().splitlines()
+    assert lines[1].startswith('quay.io/ucsc_cgl/bwa') and lines[1].endswith('30.0%')
+    assert lines[-1].startswith('all')
+
+    paths = collector.write(str(tmpdir))
+    assert [os.path.basename(path) for path in paths] == ['docker_profile.json', 'docker_profile.txt']
+
+
+def test_peak_rss_per_measurement():
+    import logging
+    import time
+    import pytest
+    from toil_scripts.lib import instrumentation
+    from toil_scripts.lib.instrumentation import MetricsCollector, measure
+    if instrumentation._rss_bytes() is None:
+        pytest.skip('needs /proc to sample memory')
+    collector = MetricsCollector().install('realtime')
+    big = 256 * 1024 * 1024
+    try:
+        # An earlier job's peak doesn't count against later ones in the same process
+        block = bytearray(big)
+        del block
+        with measure('small'):
+            pass
+        with measure('big'):
+            block = bytearray(big)
+            time.sleep(3 * instrumentation.RSS_SAMPLE_SECONDS)
+            del block
+    finally:
+        logging.getLogger('realtime').removeHandler(collector)
+
+    small, big_job = collector.events
+    assert small['peak_rss_bytes'] < instrumentation._peak_rss_bytes() - big // 2
+    assert big_job['peak_rss_bytes'] > big
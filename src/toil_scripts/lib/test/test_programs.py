@@ -12,3 +12,187 @@ def test_docker_call(tmpdir):
     with open(fpath, 'w') as f:
         docker_call(tool='ubuntu', env=dict(foo='bar'), parameters=['printenv', 'foo'], outfile=f)
     assert open(fpath).read() == 'bar\n'
+
+
+def test_files_to_fix(tmpdir):
+    import time
+    from toil_scripts.lib.programs import _files_to_fix
+    work_dir = str(tmpdir)
+    for name in ['input', 'output', 'other']:
+        tmpdir.join(name).write('x')
+    # Everything was there before the container started
+    since = time.time() + 10
+    stat = os.stat(work_dir)
+    # Nothing needs fixing if everything is already owned by the work dir's owner
+    assert _files_to_fix(work_dir, {'output': None}, since, stat.st_uid, stat.st_gid) == []
+    # Only declared outputs and recently changed files are candidates
+    assert _files_to_fix(work_dir, {'output': None}, since, stat.st_uid + 1, stat.st_gid) == \
+        [os.path.join(work_dir, 'output')]
+    assert sorted(_files_to_fix(work_dir, None, 0, stat.st_uid + 1, stat.st_gid)) == \
+        [os.path.join(work_dir, name) for name in ['input', 'other', 'output']]
+
+
+def test_docker_session(tmpdir):
+    import subprocess
+    import pytest
+    from toil_scripts.lib.programs import docker_call, docker_session
+    work_dir = str(tmpdir)
+    with docker_session() as session:
+        assert docker_call(tool='ubuntu', work_dir=work_dir, parameters=['echo', 'warm'], check_output=True) == 'warm\n'
+        docker_call(tool='ubuntu', work_dir=work_dir, parameters=['touch', '/data/out'], outputs={'out': None})
+        with pytest.raises(subprocess.CalledProcessError):
+            docker_call(tool='ubuntu', work_dir=work_dir, parameters=['false'])
+        # All calls shared one container
+        assert len(session.containers) == 1
+        container = session.containers.values()[0][0]
+    assert os.stat(os.path.join(work_dir, 'out')).st_uid == os.stat(work_dir).st_uid
+    # Which is gone afterwards
+    assert container not in subprocess.check_output(['docker', 'ps', '-aq', '--no-trunc'])
+
+
+def test_docker_pipeline(tmpdir):
+    import subprocess
+    import pytest
+    from toil_scripts.lib.programs import docker_pipeline, _parse_times
+    assert _parse_times('0m0.001s 0m0.002s\n1m2.500s 0m0.250s\n') == 62.75
+    work_dir = str(tmpdir)
+    fpath = os.path.join(work_dir, 'out')
+    with open(fpath, 'w') as f:
+        stages = docker_pipeline([('ubuntu', 'seq 1 1000'), ('ubuntu', 'gzip -c'), ('ubuntu', 'gunzip -c | wc -l')],
+                                 work_dir=work_dir, outfile=f, pipe_size=1024 * 1024)
+    assert open(fpath).read() == '1000\n'
+    assert [stage['returncode'] for stage in stages] == [0, 0, 0]
+    assert all(stage['cpu_seconds'] >= 0 for stage in stages)
+    # Nothing is left behind in the work dir
+    assert os.listdir(work_dir) == ['out']
+    # A failure in the middle of the pipeline is not hidden by the stage after it
+    with pytest.raises(subprocess.CalledProcessError) as e:
+        docker_pipeline([('ubuntu', 'seq 1 1000'), ('ubuntu', 'false'), ('ubuntu', 'cat')], work_dir=work_dir)
+    assert e.value.cmd == 'false'
+
+
+def test_pin_cores(tmpdir):
+    from toil_scripts.lib.programs import _parse_cpu_list, _pin_cores, _release_cores
+    assert _parse_cpu_list('0-3,8,10-11\n') == [0, 1, 2, 3, 8, 10, 11]
+    lock_dir = str(tmpdir)
+    nodes = [[0, 1, 2, 3], [4, 5, 6, 7]]
+    first, first_locks = _pin_cores(3, lock_dir, nodes)
+    assert first == [0, 1, 2]
+    # Pinned calls don't share cores, and stay on one node when they can
+    second, second_locks = _pin_cores(2, lock_dir, nodes)
+    assert second == [4, 5]
+    third, third_locks = _pin_cores(3, lock_dir, nodes)
+    assert third == [3, 6, 7]
+    assert _pin_cores(1, lock_dir, nodes) == (None, [])
+    _release_cores(first_locks)
+    assert _pin_cores(3, lock_dir, nodes)[0] == [0, 1, 2]
+
+
+def test_current_job_resources():
+    from toil_scripts.lib.programs import current_job_resources
+
+    class FakeJob(object):
+        fileStore = None
+        cores = 4
+        memory = 8 * 1024 ** 3
+
+    def run_tool(job):
+        # docker_call looks for the job itself, with no help from the instrumentation
+        return nested()
+
+    def nested():
+        return current_job_resources()
+
+    assert run_tool(FakeJob()) == {'cores': 4, 'memory': 8 * 1024 ** 3}
+    assert current_job_resources() is None
+
+
+def test_docker_session_pinning(tmpdir, monkeypatch):
+    import json
+    import subprocess
+    from toil_scripts.lib import programs
+    monkeypatch.setattr(programs, 'CORE_LOCK_DIR', str(tmpdir))
+    monkeypatch.setattr(programs, '_numa_nodes', lambda: [[0, 1, 2, 3]])
+    runs = []
+
+    def check_output(command):
+        if command[1] == 'inspect':
+            return json.dumps({'Entrypoint': ['samtools'], 'Cmd': None})
+        runs.append(command)
+        return 'container{}\n'.format(len(runs))
+
+    monkeypatch.setattr(subprocess, 'check_output', check_output)
+    monkeypatch.setattr(subprocess, 'check_call', lambda command, **kwargs: 0)
+    session = programs.DockerSession()
+    base = ['docker', 'run', '--cpus=2']
+    first = session.container('samtools', base, 2)
+    # The same call again reuses the container, which keeps its cores
+    assert session.container('samtools', base, 2)[0] == first[0] == 'container1'
+    assert first[3] == [0, 1] and '--cpuset-cpus=0,1' in runs[0] and len(runs) == 1
+    assert programs._pin_cores(2)[0] == [2, 3]
+    session.close()
+    # Which it gives back when it is removed
+    assert programs._pin_cores(2)[0] == [0, 1]
+
+
+def test_docker_pipeline_limits(tmpdir, monkeypatch):
+    import subprocess
+    from toil_scripts.lib import programs
+    monkeypatch.setattr(programs, 'CORE_LOCK_DIR', str(tmpdir.mkdir('cores')))
+    monkeypatch.setattr(programs, '_numa_nodes', lambda: [[0, 1, 2, 3]])
+    calls = []
+
+    class FakeProcess(object):
+        returncode = 0
+
+        def poll(self):
+            return 0
+
+    def popen(call, **kwargs):
+        calls.append(call)
+        return FakeProcess()
+
+    monkeypatch.setattr(subprocess, 'Popen', popen)
+    work_dir = str(tmpdir.mkdir('work'))
+    programs.docker_pipeline([('vg', 'vg view -v graph.vg'), ('vg', 'vg kmers -g -')], work_dir=work_dir,
+                             cores=2, memory=1024 ** 3, pin_cores=True, mock=False)
+    # Every stage is held to the job's limits, and all of them share the job's cores
+    for call in calls:
+        assert '--cpus=2' in call and '--memory=1073741824b' in call and '--cpuset-cpus=0,1' in call
+    # Which are given back afterwards
+    assert programs._pin_cores(2)[0] == [0, 1]
+
+
+def test_docker_pipeline_cleanup(tmpdir, monkeypatch):
+    import subprocess
+    import pytest
+    from toil_scripts.lib import programs
+    calls = []
+    removed = []
+
+    class FakeProcess(object):
+        returncode = None
+
+        def poll(self):
+            return None
+
+        def kill(self):
+            pass
+
+        def wait(self):
+            pass
+
+    def popen(call, **kwargs):
+        if len(calls) == 2:
+            raise OSError('out of processes')
+        calls.append(call)
+        return FakeProcess()
+
+    monkeypatch.setattr(subprocess, 'Popen', popen)
+    monkeypatch.setattr(subprocess, 'call', lambda command, **kwargs: removed.extend(command[3:]))
+    with pytest.raises(OSError):
+        programs.docker_pipeline([('ubuntu', 'seq 1 10'), ('ubuntu', 'cat'), ('ubuntu', 'wc -l')],
+                                 work_dir=str(tmpdir), cores=0, memory=0, mock=False)
+    # The containers of the stages that were started are removed, not just their docker clients killed
+    names = [call[call.index('--name') + 1] for call in calls]
+    assert len(set(names)) == 2 and set(names) <= set(removed)
@@ -0,0 +1,489 @@
+import os
+
+
+def _fetcher(contents, calls):
+    def fetch(path):
+        calls.append(path)
+        os.makedirs(os.path.join(path, 'sub'))
+        for name, data in contents.iteritems():
+            with open(os.path.join(path, name), 'w') as f_out:
+                f_out.write(data)
+    return fetch
+
+
+def test_directory_cache(tmpdir):
+    from toil_scripts.lib.toillib import DirectoryCache
+    cache_dir = os.path.join(str(tmpdir), 'cache')
+    cache = DirectoryCache(cache_dir, max_bytes=150)
+    calls = []
+    index = {'graph.vg': 'x' * 50, 'sub/graph.vg.xg': 'y' * 50}
+    # Two jobs on one host get the same directory, but it is only extracted once
+    for job in ['job1', 'job2']:
+        job_dir = os.path.join(str(tmpdir), job)
+        cache.link_into('index-1', _fetcher(index, calls), job_dir)
+        with open(os.path.join(job_dir, 'sub', 'graph.vg.xg')) as f_in:
+            assert f_in.read() == 'y' * 50
+        # The cached files can't be changed through the links
+        assert not os.access(os.path.join(job_dir, 'graph.vg'), os.W_OK) or os.getuid() == 0
+    assert len(calls) == 1
+    assert cache.stats() == {'hits': 1, 'misses': 1, 'evictions': 0}
+    # Another directory pushes the cache over budget, so the older one goes
+    other_dir = os.path.join(str(tmpdir), 'job3')
+    cache.link_into('index-2', _fetcher({'graph.vg': 'z' * 100}, calls), other_dir)
+    assert cache.stats() == {'hits': 1, 'misses': 2, 'evictions': 1}
+    assert len([name for name in os.listdir(cache_dir) if DirectoryCache.ENTRY_PATTERN.match(name)]) == 1
+    # Links made before eviction still work
+    with open(os.path.join(str(tmpdir), 'job1', 'graph.vg')) as f_in:
+        assert f_in.read() == 'x' * 50
+    cache.link_into('index-1', _fetcher(index, calls), os.path.join(str(tmpdir), 'job4'))
+    assert len(calls) == 3
+
+
+def test_directory_archive_codecs(tmpdir):
+    from StringIO import StringIO
+    from toil_scripts.lib.toillib import write_directory_archive, read_directory_archive, DIRECTORY_CODECS
+    source = os.path.join(str(tmpdir), 'source')
+    os.makedirs(os.path.join(source, 'sub'))
+    contents = {'graph.vg': os.urandom(100000), 'sub/graph.vg.gcsa': 'ACGT' * 10000}
+    for name, data in contents.iteritems():
+        with open(os.path.join(source, name), 'wb') as f_out:
+            f_out.write(data)
+    for codec in DIRECTORY_CODECS:
+        archive = StringIO()
+        try:
+            write_directory_archive(source, archive, codec)
+        except RuntimeError:
+            # No zstd available here
+            assert codec == 'zstd'
+            continue
+        # Reading works out which codec was used by itself
+        destination = os.path.join(str(tmpdir), codec)
+        read_directory_archive(StringIO(archive.getvalue()), destination)
+        for name, data in contents.iteritems():
+            with open(os.path.join(destination, name), 'rb') as f_in:
+                assert f_in.read() == data
+
+
+class _FakeFileStore(object):
+    """
+    Just enough of a Toil file store to save and load global directories.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def writeGlobalFileStream(self, cleanup=False):
+        from contextlib import contextmanager
+
+        @contextmanager
+        def stream():
+            with open(self.path, 'wb') as f_out:
+                yield f_out, 'file-id'
+        return stream()
+
+    def readGlobalFileStream(self, file_id):
+        assert file_id == 'file-id'
+        return open(self.path, 'rb')
+
+
+def test_write_global_directory_copies(tmpdir):
+    from toil_scripts.lib.toillib import FileIOStore, write_global_directory, read_global_directory
+    source = os.path.join(str(tmpdir), 'source')
+    os.makedirs(source)
+    data = os.urandom(3 * 1024 * 1024)
+    with open(os.path.join(source, 'graph.vg.xg'), 'wb') as f_out:
+        f_out.write(data)
+    file_store = _FakeFileStore(os.path.join(str(tmpdir), 'global'))
+    out_store = FileIOStore(os.path.join(str(tmpdir), 'out'))
+    os.makedirs(out_store.path_prefix)
+    tee = os.path.join(str(tmpdir), 'tee.tar.gz')
+    file_id = write_global_directory(file_store, source, tee=tee, copies=[(out_store, 'sub/index.tar.gz')])
+    # The archive is compressed once, and every destination gets the same bytes
+    with open(file_store.path, 'rb') as f_in:
+        archive = f_in.read()
+    for path in [tee, os.path.join(out_store.path_prefix, 'sub', 'index.tar.gz')]:
+        with open(path, 'rb') as f_in:
+            assert f_in.read() == archive
+    read_global_directory(file_store, file_id, os.path.join(str(tmpdir), 'dest'))
+    with open(os.path.join(str(tmpdir), 'dest', 'graph.vg.xg'), 'rb') as f_in:
+        assert f_in.read() == data
+
+
+def test_fan_out_writer_errors():
+    import pytest
+    from StringIO import StringIO
+    from toil_scripts.lib.toillib import FanOutWriter
+
+    class Broken(object):
+        def write(self, data):
+            raise IOError('disk full')
+
+    good = StringIO()
+    writer = FanOutWriter([good, Broken()], chunk_size=10, queue_chunks=1)
+    with pytest.raises(IOError):
+        # The failure shows up on a later write or on close, without blocking the other stream
+        for _ in xrange(100):
+            writer.write('x' * 7)
+        writer.close()
+
+
+def test_spooled_output_stream(tmpdir):
+    from toil_scripts.lib.toillib import IOStore
+
+    class SpoolingStore(IOStore):
+        # Can only save whole files
+        def __init__(self):
+            self.saved = None
+
+        def write_output_file(self, local_path, output_path):
+            with open(local_path) as f_in:
+                self.saved = (os.path.dirname(local_path), f_in.read())
+
+    store = SpoolingStore()
+    with store.write_output_stream('out', temp_dir=str(tmpdir)) as stream:
+        stream.write('data')
+    # The stream was spooled where we asked, and cleaned up
+    assert store.saved == (str(tmpdir), 'data') and os.listdir(str(tmpdir)) == []
+
+
+def test_part_stream():
+    from toil_scripts.lib.toillib import PartStream
+    parts = []
+    stream = PartStream(4, parts.append)
+    stream.write('abc')
+    stream.writelines(['defgh', 'ijklmn'])
+    assert parts == ['abcd', 'efgh', 'ijkl']
+    stream.flush_part()
+    assert parts[-1] == 'mn' and stream.remainder() == ''
+
+
+def test_s3_io_store(tmpdir):
+    import pytest
+    import pickle
+    pytest.importorskip('boto')
+    moto = pytest.importorskip('moto')
+    from toil_scripts.lib.toillib import IOStore
+    # moto stands in for S3 in-process; S3 needs multipart parts of at least 5 MB
+    with moto.mock_s3_deprecated():
+        import boto
+        boto.connect_s3().create_bucket('test-bucket')
+        store = IOStore.get('aws:us-east-1:test-bucket/prefix')
+        store.part_size = 5 * 1024 * 1024
+        # Stores travel between jobs pickled
+        store = pickle.loads(pickle.dumps(store))
+        data = os.urandom(12 * 1024 * 1024)
+        local = os.path.join(str(tmpdir), 'big')
+        with open(local, 'wb') as f_out:
+            f_out.write(data)
+        store.write_output_file(local, 'dir/big')
+        store.write_output_file(local, 'top')
+        assert store.exists('dir/big') and not store.exists('dir/small')
+        # The ETag of a key uploaded in parts is worked out the same way locally
+        assert store.get_checksum('dir/big') == store.local_checksum(local) and store.get_size('dir/big') == len(data)
+        assert store.get_mtime('dir/big') is not None and store.get_mtime('nothing') is None
+        assert sorted(store.list_input_directory('')) == ['dir', 'top']
+        assert sorted(store.list_input_directory('', recursive=True)) == ['dir/big', 'top']
+        copy = os.path.join(str(tmpdir), 'copy')
+        store.read_input_file('dir/big', copy)
+        with open(copy, 'rb') as f_in:
+            assert f_in.read() == data
+        # Streams go up in parts as they are written, or in one go if small
+        with store.write_output_stream('streamed') as stream:
+            for i in xrange(0, len(data), 1024 * 1024):
+                stream.write(data[i:i + 1024 * 1024])
+        with store.write_output_stream('small') as stream:
+            stream.write('small')
+        store.read_input_file('streamed', copy)
+        with open(copy, 'rb') as f_in:
+            assert f_in.read() == data
+        store.read_input_file('small', copy)
+        assert open(copy).read() == 'small'
+        # A missing key is not worth retrying
+        with pytest.raises(RuntimeError):
+            store.read_input_file('nothing', copy)
+
+
+class _FakeAzure(object):
+    """
+    Stands in for the azure module's exception types.
+    """
+    class WindowsAzureError(Exception):
+        pass
+
+    class WindowsAzureMissingResourceError(WindowsAzureError):
+        pass
+
+    class WindowsAzureConflictError(WindowsAzureError):
+        pass
+
+
+class _FakeBlobService(object):
+    """
+    An in-memory stand-in for the parts of azure's BlobService that AzureIOStore transfers use.
+    """
+    blobs = {}
+    blocks = {}
+    metadata = {}
+    list_calls = 0
+
+    def __init__(self, account_name=None, account_key=None):
+        pass
+
+    def create_container(self, container_name):
+        pass
+
+    def get_blob_properties(self, container_name, blob_name):
+        if blob_name not in self.blobs:
+            raise _FakeAzure.WindowsAzureMissingResourceError('not found')
+        properties = {'content-length': str(len(self.blobs[blob_name])), 'last-modified': 'Tue, 18 Oct 2016 10:00:00 GMT'}
+        for name, value in (self.metadata.get(blob_name) or {}).iteritems():
+            properties['x-ms-meta-' + name] = value
+        return properties
+
+    def list_blobs(self, container_name, prefix=None, delimiter=None, marker=None):
+        # Two names to a page, with directories folded up when there is a delimiter
+        _FakeBlobService.list_calls += 1
+        names = set()
+        for name in self.blobs:
+            if name.startswith(prefix or ''):
+                rest = name[len(prefix or ''):]
+                if delimiter and delimiter in rest:
+                    name = name[:len(prefix or '') + rest.index(delimiter) + 1]
+                names.add(name)
+        names = sorted(names)
+        start = int(marker or 0)
+        page = names[start:start + 2]
+        item = lambda name: type('Item', (), {'name': name, 'properties': type('Properties', (), {
+            'last_modified': 'Tue, 18 Oct 2016 10:00:00 GMT'})})
+        result = type('Result', (), {})()
+        result.blobs = [item(n) for n in page if not n.endswith('/')]
+        result.prefixes = [item(n) for n in page if n.endswith('/')]
+        result.next_marker = str(start + 2) if start + 2 < len(names) else ''
+        return result
+
+    def get_blob_to_path(self, container_name, blob_name, file_path):
+        with open(file_path, 'wb') as f_out:
+            f_out.write(self.blobs[blob_name])
+
+    def get_blob(self, container_name, blob_name, x_ms_range=None):
+        start, end = [int(x) for x in x_ms_range[len('bytes='):].split('-')]
+        return self.blobs[blob_name][start:end + 1]
+
+    def put_block_blob_from_path(self, container_name, blob_name, file_path, x_ms_meta_name_values=None):
+        with open(file_path, 'rb') as f_in:
+            self.blobs[blob_name] = f_in.read()
+        self.metadata[blob_name] = x_ms_meta_name_values
+
+    def put_block(self, container_name, blob_name, block, blockid):
+        self.blocks[(blob_name, blockid)] = block
+
+    def put_block_list(self, container_name, blob_name, block_list, x_ms_meta_name_values=None):
+        self.blobs[blob_name] = ''.join(self.blocks.pop((blob_name, b)) for b in block_list)
+        self.metadata[blob_name] = x_ms_meta_name_values
+
+
+def test_azure_io_store_blocks(tmpdir, monkeypatch):
+    from toil_scripts.lib import toillib
+    monkeypatch.setattr(toillib, 'BlobService', _FakeBlobService, raising=False)
+    # Skip the constructor, which wants real Azure credentials
+    store = toillib.AzureIOStore.__new__(toillib.AzureIOStore)
+    store.__setstate__(('account', 'key', 'container', 'prefix/', 1000, 4, 30, False))
+    for size in [0, 999, 1000, 1001, 10500]:
+        data = os.urandom(size)
+        local = os.path.join(str(tmpdir), 'data')
+        with open(local, 'wb') as f_out:
+            f_out.write(data)
+        store.write_output_file(local, 'blob')
+        assert _FakeBlobService.blobs['prefix/blob'] == data
+        copy = os.path.join(str(tmpdir), 'copy')
+        store.read_input_file('blob', copy)
+        with open(copy, 'rb') as f_in:
+            assert f_in.read() == data
+
+
+def test_azure_io_store_listing(tmpdir, monkeypatch):
+    from toil_scripts.lib import toillib
+    monkeypatch.setattr(toillib, 'BlobService', _FakeBlobService, raising=False)
+    monkeypatch.setattr(toillib, 'azure', _FakeAzure, raising=False)
+    _FakeBlobService.blobs = dict.fromkeys(['prefix/a', 'prefix/d/b', 'prefix/d/c', 'prefix/d/e/f', 'other/g'], 'x')
+    store = toillib.AzureIOStore.__new__(toillib.AzureIOStore)
+    store.__setstate__(('account', 'key', 'container', 'prefix/', 1000, 4, 30, False))
+    assert sorted(store.list_input_directory('')) == ['a', 'd']
+    assert sorted(store.list_input_directory('d')) == ['b', 'c', 'e']
+    assert sorted(store.list_input_directory('d/', recursive=True)) == ['b', 'c', 'e/f']
+    assert dict(store.list_input_directory('d', with_times=True))['e'] is None
+    # Listing again inside the TTL is served from the cache, until something is written
+    calls = _FakeBlobService.list_calls
+    assert sorted(store.list_input_directory('d')) == ['b', 'c', 'e']
+    assert _FakeBlobService.list_calls == calls
+    local = os.path.join(str(tmpdir), 'data')
+    with open(local, 'wb') as f_out:
+        f_out.write('y')
+    store.write_output_file(local, 'd/h')
+    assert sorted(store.list_input_directory('d')) == ['b', 'c', 'e', 'h']
+    # Lookups of single blobs don't list at all
+    calls = _FakeBlobService.list_calls
+    assert store.exists('d/b') and not store.exists('d/z')
+    assert store.get_mtime('a').year == 2016 and store.get_mtime('z') is None
+    assert _FakeBlobService.list_calls == calls
+
+
+def test_file_io_store_transfer(tmpdir):
+    import pytest
+    from toil_scripts.lib.toillib import FileIOStore
+    local = os.path.join(str(tmpdir), 'local')
+    with open(local, 'wb') as f_out:
+        f_out.write('data')
+    for transfer in FileIOStore.TRANSFER_MODES:
+        store_dir = os.path.join(str(tmpdir), transfer)
+        os.mkdir(store_dir)
+        store = FileIOStore(store_dir, transfer)
+        store.write_output_file(local, 'sub/out')
+        store.write_output_file(local, 'sub/out')
+        stored = os.path.join(store_dir, 'sub', 'out')
+        with open(stored, 'rb') as f_in:
+            assert f_in.read() == 'data'
+        # Linking shares the local file's inode; copying never does. No temp files are left behind.
+        assert os.path.samefile(local, stored) == (transfer == 'link')
+        assert sorted(os.listdir(store_dir)) == ['sub']
+    with pytest.raises(RuntimeError):
+        FileIOStore(str(tmpdir), 'teleport')
+
+
+def test_bulk_transfers(tmpdir, monkeypatch):
+    import collections
+    import time
+    from toil_scripts.lib import toillib
+    from toil_scripts.lib.toillib import FileIOStore, IOStore
+    store = FileIOStore(os.path.join(str(tmpdir), 'store'))
+    local_dir = str(tmpdir.mkdir('local'))
+    pairs = []
+    for i in xrange(20):
+        local = os.path.join(local_dir, 'in_{}'.format(i))
+        with open(local, 'wb') as f_out:
+            f_out.write(str(i) * (i + 1))
+        pairs.append((local, 'dir/{}'.format(i)))
+    store.write_output_files(pairs, threads=4)
+    # Downloads come back in the order asked for
+    wanted = [('dir/{}'.format(i), os.path.join(local_dir, 'out_{}'.format(i))) for i in reversed(xrange(20))]
+    assert list(store.iter_input_files(wanted, threads=4)) == [local for _, local in wanted]
+    for i in xrange(20):
+        with open(os.path.join(local_dir, 'out_{}'.format(i))) as f_in:
+            assert f_in.read() == str(i) * (i + 1)
+
+    class FlakyStore(IOStore):
+        # Fails each file the first time, to show files are retried on their own
+        def __init__(self):
+            self.tries = collections.Counter()
+
+        def write_output_file(self, local_path, output_path):
+            self.tries[output_path] += 1
+            if self.tries[output_path] == 1:
+                raise IOError('try again')
+
+    # Don't wait between tries
+    original_times = toillib.backoff_times
+    monkeypatch.setattr(toillib, 'backoff_times', lambda retries, base_delay: original_times(retries, 0))
+    flaky = FlakyStore()
+    flaky.write_output_files(pairs[:5], threads=2)
+    assert all(count == 2 for count in flaky.tries.values()) and len(flaky.tries) == 5
+
+    # A slow consumer holds back the downloads it isn't ready for
+    started = []
+    local_paths = [os.path.join(local_dir, 'out_{}'.format(i)) for i in xrange(20)]
+    transfers = toillib.transfer_files('Test', lambda source, destination: started.append(source),
+                                       [(path, path) for path in local_paths], 2, lambda pair: pair[1], 0)
+    next(transfers)
+    time.sleep(0.1)
+    assert len(started) <= 5
+    assert len(list(transfers)) == 19 and len(started) == 20
+
+
+def test_skip_unchanged(tmpdir, monkeypatch):
+    from toil_scripts.lib import toillib
+    from toil_scripts.lib.toillib import IOStore
+    local = os.path.join(str(tmpdir), 'local')
+
+    monkeypatch.setattr(toillib, 'BlobService', _FakeBlobService, raising=False)
+    monkeypatch.setattr(toillib, 'azure', _FakeAzure, raising=False)
+    azure_store = toillib.AzureIOStore.__new__(toillib.AzureIOStore)
+    azure_store.__setstate__(('account', 'key', 'container', 'prefix/', 1000, 4, 30, True))
+    file_store = IOStore.get(os.path.join(str(tmpdir), 'store'), skip_unchanged=True)
+
+    original_checksum = toillib.file_checksum
+    reads = []
+    monkeypatch.setattr(toillib, 'file_checksum',
+                        lambda path, *args, **kwargs: reads.append(path) or original_checksum(path, *args, **kwargs))
+    for store in [file_store, azure_store]:
+        del reads[:]
+        with open(local, 'wb') as f_out:
+            f_out.write('x' * 2500)
+        store.write_output_file(local, 'out')
+        store.write_output_file(local, 'out')
+        with open(local, 'ab') as f_out:
+            f_out.write('changed')
+        store.write_output_file(local, 'out')
+        assert store.checksum_stats == {'hits': 1, 'misses': 2}
+        # Missing and resized files are told apart without reading them, and files on disk by their times too
+        assert reads == ([] if store is file_store else [local])
+        assert store.get_checksum('out') == store.local_checksum(local)
+        assert store.get_checksum('missing') is None
+    # A big blob's checksum comes from its blocks, as they went up
+    assert azure_store.get_checksum('out') == original_checksum(local, part_size=1000)
+    # Files on disk with new times but the same content are still found unchanged
+    os.utime(local, (0, 0))
+    file_store.write_output_file(local, 'out')
+    assert file_store.checksum_stats == {'hits': 2, 'misses': 2}
+
+
+def test_batching_log_handler(monkeypatch):
+    import logging
+    import socket
+    import time
+    from toil_scripts.lib.toillib import RealTimeLogger, BatchingLogHandler
+    monkeypatch.delenv('RT_LOGGING_HOST', raising=False)
+    monkeypatch.delenv('RT_LOGGING_PORT', raising=False)
+    RealTimeLogger.start_master(level=logging.WARNING)
+    try:
+        port = RealTimeLogger.logging_server.server_address[1]
+        handler = BatchingLogHandler('localhost', port, batch_size=7, flush_interval=0.05)
+        logger = logging.getLogger('test_batching_log_handler')
+        logger.propagate = False
+        logger.setLevel(logging.INFO)
+        logger.addHandler(handler)
+        for i in xrange(50):
+            logger.info('chunk %d', i)
+        logger.warning('big record %s', 'x' * 100000)
+        handler.close()
+        logger.removeHandler(handler)
+        # The master decodes every batch, but only shows what is at its level
+        deadline = time.time() + 10
+        while RealTimeLogger.get_stats()['records'] < 51 and time.time() < deadline:
+            time.sleep(0.05)
+        stats = RealTimeLogger.get_stats()
+        assert stats['records'] == 51 and stats['filtered'] == 50 and stats['batches'] >= 8
+        assert stats['dropped'] == 0 and stats['malformed'] == 0
+    finally:
+        RealTimeLogger.stop_master()
+        RealTimeLogger.master_level = logging.INFO
+
+    # With nobody listening, records are counted as dropped instead of blocking
+    listener = socket.socket()
+    listener.bind(('localhost', 0))
+    closed_port = listener.getsockname()[1]
+    listener.close()
+    handler = BatchingLogHandler('localhost', closed_port, max_queued=5, flush_interval=0.05)
+    for i in xrange(20):
+        handler.handle(logging.makeLogRecord({'msg': 'lost', 'levelno': logging.INFO}))
+    handler.close()
+    assert handler.dropped == 20
+
+    # Messages are formatted when logged, so later changes to their arguments don't show
+    handler = BatchingLogHandler('localhost', closed_port, flush_interval=0.05)
+    sent = []
+    handler.send = sent.extend
+    items = ['before']
+    handler.handle(logging.makeLogRecord({'msg': 'items %s', 'args': (items,), 'levelno': logging.INFO}))
+    items[0] = 'after'
+    handler.close()
+    assert [record['msg'] for record in sent] == ["items ['before']"]
@@ -52,3 +52,88 @@ def test_upload_and_download_with_encryption(tmpdir):
             k = Key(b)
             k.key = random_key
             k.delete()
+
+
+def test_download_url_proxy(tmpdir, monkeypatch):
+    from toil_scripts.lib import urls
+    for name in ['http_proxy', 'https_proxy', 'ftp_proxy', 'all_proxy', 'no_proxy']:
+        monkeypatch.delenv(name, raising=False)
+        monkeypatch.delenv(name.upper(), raising=False)
+    calls = []
+
+    def curl(args):
+        calls.append(('curl', args[-3]))
+        open(args[-1], 'w').close()
+
+    def native(url, file_path, **kwargs):
+        calls.append(('native', url))
+        open(file_path, 'w').close()
+
+    monkeypatch.setattr(urls.subprocess, 'check_call', curl)
+    monkeypatch.setattr(urls, '_download_parallel', native)
+    work_dir = str(tmpdir)
+    urls.download_url('http://example.com/direct', work_dir=work_dir)
+    # Only curl knows how to go through the proxy
+    monkeypatch.setenv('http_proxy', 'http://proxy.example.com:3128')
+    urls.download_url('http://example.com/proxied', work_dir=work_dir)
+    urls.download_url('example.com/no_scheme', work_dir=work_dir)
+    urls.download_url('https://example.com/secure', work_dir=work_dir)
+    monkeypatch.setenv('no_proxy', 'example.com')
+    urls.download_url('http://example.com/bypassed', work_dir=work_dir)
+    assert calls == [('native', 'http://example.com/direct'),
+                     ('curl', 'http://example.com/proxied'),
+                     ('curl', 'example.com/no_scheme'),
+                     ('native', 'https://example.com/secure'),
+                     ('native', 'http://example.com/bypassed')]
+
+
+def test_download_url_ranged(tmpdir):
+    import hashlib
+    import json
+    import threading
+    import pytest
+    from toil_scripts.lib import urls
+    from toil_scripts.lib.test.range_server import RangeHTTPServer, RangeRequestHandler
+    serve_dir = tmpdir.mkdir('serve')
+    work_dir = str(tmpdir.mkdir('work'))
+    data = os.urandom(1000)
+    serve_dir.join('input.bin').write(data, mode='wb')
+    serve_dir.join('empty').write('')
+    old_dir = os.getcwd()
+    os.chdir(str(serve_dir))
+    server = RangeHTTPServer(('127.0.0.1', 0), RangeRequestHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    try:
+        url = 'http://127.0.0.1:{}/input.bin'.format(server.server_address[1])
+        output = os.path.join(work_dir, 'output.bin')
+        # Many small segments over a few connections
+        urls._download_parallel(url, output, md5=hashlib.md5(data).hexdigest(), threads=4, segment_size=64)
+        assert open(output, 'rb').read() == data
+        assert not os.path.exists(output + '.part.json')
+        os.unlink(output)
+        # Resume after the first segment, which is wrong on disk so we can tell it wasn't fetched again
+        with open(output + '.part', 'wb') as part_file:
+            part_file.write('x' * 64 + data[64:])
+        etag = '"{}-{}"'.format(len(data), int(os.path.getmtime('input.bin')))
+        with open(output + '.part.json', 'w') as state_file:
+            json.dump({'url': url, 'size': len(data), 'validator': etag, 'done': [[0, 64]]}, state_file)
+        urls._download_parallel(url, output, threads=4, segment_size=64)
+        assert open(output, 'rb').read() == 'x' * 64 + data[64:]
+        os.unlink(output)
+        # Without ranges, there is one stream
+        server.ranges = False
+        urls.download_url(url, work_dir=work_dir, name='output.bin')
+        assert open(output, 'rb').read() == data
+        urls.download_url(url.replace('input.bin', 'empty'), work_dir=work_dir)
+        assert os.path.getsize(os.path.join(work_dir, 'empty')) == 0
+        # A bad checksum leaves nothing behind
+        with pytest.raises(urls._DownloadError):
+            urls.download_url(url, work_dir=work_dir, name='bad.bin', md5='0' * 32)
+        assert not os.path.exists(os.path.join(work_dir, 'bad.bin.part'))
+    finally:
+        urls.close_connections()
+        server.shutdown()
+        server.server_close()
+        os.chdir(old_dir)
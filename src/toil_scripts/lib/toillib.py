@@ -14,6 +14,21 @@ import random
 import time
 import traceback
 import stat
+import fcntl
+import errno
+import hashlib
+import base64
+import re
+import gzip
+import zlib
+import subprocess
+import Queue
+import StringIO
+import itertools
+import multiprocessing.pool
+import urlparse
+import distutils.spawn
+from contextlib import contextmanager
 
 import dateutil.parser
 import dateutil.tz
@@ -31,6 +46,28 @@ except ImportError:
     have_azure = False
     pass
     
+# We need boto in order to have S3
+try:
+    import boto
+    import boto.s3
+    import boto.s3.connection
+    import boto.s3.key
+    import boto.s3.multipart
+    import boto.exception
+    have_s3 = True
+except ImportError:
+    have_s3 = False
+    pass
+
+# zstd compression can be done in-process if we have the bindings, or else with
+# the zstd command.
+try:
+    import zstandard
+    have_zstandard = True
+except ImportError:
+    have_zstandard = False
+    pass
+
 
 def robust_makedirs(directory):
     """
@@ -50,20 +87,94 @@ def robust_makedirs(directory):
     # Make sure it exists and is a directory
     assert(os.path.exists(directory) and os.path.isdir(directory))
 
-class LoggingDatagramHandler(SocketServer.DatagramRequestHandler):
+class LogStats(object):
+    """
+    Counts what the master's logging server has received, so throughput can
+    be reported.
+    
+    """
+    
+    def __init__(self):
+        """
+        Start counting from now.
+        """
+        
+        self.lock = threading.Lock()
+        self.start_time = time.time()
+        self.counts = collections.Counter()
+        
+    def add(self, **counts):
+        """
+        Add to the named counts.
+        """
+        
+        with self.lock:
+            self.counts.update(counts)
+            
+    def get(self):
+        """
+        Return a dict of the counts so far, with records and bytes per second.
+        The counts are "batches", "bytes" (compressed, as received), "records"
+        (received), "filtered" (received but below the master's level),
+        "malformed" (undecodable messages) and "dropped" (records that jobs
+        reported they could not send).
+        
+        """
+        
+        with self.lock:
+            stats = dict(self.counts)
+        for name in ["batches", "bytes", "records", "filtered", "malformed",
+            "dropped"]:
+            stats.setdefault(name, 0)
+        elapsed = max(time.time() - self.start_time, 1e-6)
+        stats["seconds"] = elapsed
+        stats["records_per_second"] = stats["records"] / elapsed
+        stats["bytes_per_second"] = stats["bytes"] / elapsed
+        return stats
+
+def decode_log_message(message):
+    """
+    Decode a logging message from a job. Returns a list of logging record
+    attribute dicts and the number of records the sender reports dropping.
+    
+    Messages are either a single JSON-encoded record, as JSONDatagramHandler
+    sends, or a zlib-compressed JSON batch of records, as BatchingLogHandler
+    sends.
+    
+    >>> decode_log_message('{"msg": "hi"}')
+    ([{u'msg': u'hi'}], 0)
+    >>> decode_log_message(zlib.compress('{"records": [{"msg": "a"}], "dropped": 3}'))
+    ([{u'msg': u'a'}], 3)
+    
+    """
+    
+    if message.startswith("{"):
+        # One plain record
+        return [json.loads(message)], 0
+        
+    batch = json.loads(zlib.decompress(message))
+    return batch["records"], batch.get("dropped", 0)
+
+class LoggingMessageHandler:
     """
     Receive logging messages from the jobs and display them on the master.
+    Mixed in with a SocketServer request handler, for a particular transport,
+    so it is an old-style class like they are.
     
-    Uses length-prefixed JSON message encoding.
+    Uses length-prefixed message encoding (see decode_log_message). Records
+    below RealTimeLogger.master_level are not displayed.
     """
     
     def handle(self):
         """
         Handle messages coming in over self.connection.
         
-        Messages are 4-byte-length-prefixed JSON-encoded logging module records.
+        Messages are 4-byte-length-prefixed, and hold JSON-encoded logging
+        module records.
         """
         
+        stats = getattr(self.server, "log_stats", None)
+        
         while True:
             # Loop until we run out of messages
         
@@ -71,7 +182,6 @@ class LoggingDatagramHandler(SocketServer.DatagramRequestHandler):
             length_data = self.rfile.read(4)
             if len(length_data) < 4:
                 # The connection was closed, or we didn't get enough data
-                # TODO: complain?
                 break
                 
             # Actually parse the length
@@ -83,25 +193,68 @@ class LoggingDatagramHandler(SocketServer.DatagramRequestHandler):
             while length_received < length:
                 # Keep trying to get enough data
                 part = self.rfile.read(length - length_received)
+                if part == "":
+                    # The sender went away partway through
+                    break
                 
                 length_received += len(part)
                 message_parts.append(part)
                 
             # Stitch it all together
             message = "".join(message_parts)
+            
+            if length_received < length:
+                # We can't use a truncated message
+                logging.error("Truncated log message")
+                if stats is not None:
+                    stats.add(malformed=1)
+                break
 
             try:
-            
-                # Parse it as JSON
-                message_attrs = json.loads(message)
-                
-                # Fluff it up into a proper logging record
-                record = logging.makeLogRecord(message_attrs)
+                records, dropped = decode_log_message(message)
             except:
-                logging.error("Malformed record")
+                logging.error("Malformed log message")
+                if stats is not None:
+                    stats.add(malformed=1)
+                continue
+                
+            if stats is not None:
+                stats.add(batches=1, bytes=4 + length, records=len(records),
+                    dropped=dropped)
+            if dropped:
+                logging.getLogger("remote").warning("A job dropped {} log "
+                    "records".format(dropped))
                 
-            # TODO: do log level filtering
-            logging.getLogger("remote").handle(record)
+            for message_attrs in records:
+                try:
+                    # Fluff it up into a proper logging record
+                    record = logging.makeLogRecord(message_attrs)
+                except:
+                    logging.error("Malformed record")
+                    if stats is not None:
+                        stats.add(malformed=1)
+                    continue
+                    
+                if record.levelno < RealTimeLogger.master_level:
+                    # The master doesn't want to see these
+                    if stats is not None:
+                        stats.add(filtered=1)
+                    continue
+                    
+                logging.getLogger("remote").handle(record)
+
+class LoggingDatagramHandler(LoggingMessageHandler,
+    SocketServer.DatagramRequestHandler):
+    """
+    Receive logging messages from the jobs over UDP.
+    """
+    
+class LoggingStreamHandler(LoggingMessageHandler,
+    SocketServer.StreamRequestHandler):
+    """
+    Receive logging messages from the jobs over TCP, one connection per job
+    process.
+    """
             
 class JSONDatagramHandler(logging.handlers.DatagramHandler):
     """
@@ -118,9 +271,181 @@ class JSONDatagramHandler(logging.handlers.DatagramHandler):
         
         return length + json_string
         
+class BatchingLogHandler(logging.Handler):
+    """
+    Send logging records to the master over TCP in the background.
+    
+    Logging formats the record's message and any exception, while its
+    arguments are still as they were when it was logged, and puts the result on
+    a bounded queue as a plain dict, so the calling thread never waits on the
+    network or on serialization. A sender thread takes records off in batches,
+    encodes each batch as compressed JSON, and sends it as one length-prefixed
+    message. When the queue is full, or the master
+    can't be reached, records are dropped and counted, and the count goes to
+    the master with the next batch that gets through.
+    
+    """
+    
+    def __init__(self, host, port, max_queued=10000, batch_size=500,
+        flush_interval=0.5):
+        """
+        Make a handler that sends to the given host and port, holding at most
+        max_queued records, and sending up to batch_size records at a time, at
+        least every flush_interval seconds while there are records.
+        
+        """
+        
+        logging.Handler.__init__(self)
+        
+        self.host = host
+        self.port = port
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        
+        self.queue = Queue.Queue(max_queued)
+        
+        # How many records have we dropped and not yet told the master about?
+        self.dropped = 0
+        self.dropped_lock = threading.Lock()
+        
+        # This holds our connection to the master, when we have one
+        self.socket = None
+        # When can we next try connecting, if the master is unreachable?
+        self.retry_time = 0
+        
+        # This is set when the sender should send what it has and stop
+        self.closing = threading.Event()
+        
+        self.sender = threading.Thread(target=self.send_batches)
+        self.sender.daemon = True
+        self.sender.start()
+        
+    def emit(self, record):
+        """
+        Queue the record to be sent, or drop it if the queue is full or its
+        message can't be formatted.
+        """
+        
+        try:
+            attrs = self.encode_record(record)
+        except:
+            self.count_dropped(1)
+            return
+            
+        try:
+            self.queue.put_nowait(attrs)
+        except Queue.Full:
+            self.count_dropped(1)
+            
+    def count_dropped(self, count):
+        """
+        Note that the given number of records were dropped.
+        """
+        
+        with self.dropped_lock:
+            self.dropped += count
+            
+    def encode_record(self, record):
+        """
+        Turn a record into a dict that JSON can hold, with the message and any
+        exception already formatted.
+        """
+        
+        attrs = dict(record.__dict__)
+        attrs["msg"] = record.getMessage()
+        attrs["args"] = None
+        if record.exc_info:
+            attrs["exc_text"] = self.formatter.formatException(
+                record.exc_info) if self.formatter else "".join(
+                traceback.format_exception(*record.exc_info))
+        attrs["exc_info"] = None
+        return attrs
+        
+    def send_batches(self):
+        """
+        Run in the sender thread, sending batches until we are closed and the
+        queue is empty.
+        """
+        
+        while True:
+            batch = []
+            deadline = time.time() + self.flush_interval
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get(
+                        timeout=max(deadline - time.time(), 0.01)))
+                except Queue.Empty:
+                    break
+                    
+            if batch or self.dropped:
+                self.send(batch)
+                
+            if not batch and self.closing.is_set():
+                break
+                
+    def send(self, batch):
+        """
+        Serialize and send a batch of encoded records, counting them as dropped
+        if they can't be sent.
+        """
+        
+        with self.dropped_lock:
+            dropped = self.dropped
+            self.dropped = 0
+            
+        try:
+            message = zlib.compress(json.dumps({
+                "records": batch,
+                "dropped": dropped
+            }, default=repr), 1)
+        except:
+            # Something in there just won't encode
+            self.count_dropped(dropped + len(batch))
+            return
+            
+        if self.socket is None and time.time() >= self.retry_time:
+            try:
+                self.socket = socket.create_connection((self.host, self.port),
+                    timeout=10)
+            except socket.error:
+                # Don't hold up later batches trying again straight away
+                self.retry_time = time.time() + 5
+                
+        if self.socket is None:
+            self.count_dropped(dropped + len(batch))
+            return
+            
+        try:
+            self.socket.sendall(struct.pack(">L", len(message)) + message)
+        except socket.error:
+            self.socket.close()
+            self.socket = None
+            self.count_dropped(dropped + len(batch))
+            
+    def flush(self, timeout=10):
+        """
+        Wait up to timeout seconds for queued records to be taken for sending.
+        """
+        
+        deadline = time.time() + timeout
+        while not self.queue.empty() and time.time() < deadline:
+            time.sleep(0.01)
+            
+    def close(self):
+        """
+        Send everything still queued, and stop the sender.
+        """
+        
+        self.closing.set()
+        self.sender.join(10)
+        if self.socket is not None:
+            self.socket.close()
+            self.socket = None
+        logging.Handler.close(self)
+        
 class RealTimeLogger(object):
     """
-    All-static class for getting a logger that logs over UDP to the master.
+    All-static class for getting a logger that logs over TCP to the master.
     """
     
     # Also the logger
@@ -129,20 +454,29 @@ class RealTimeLogger(object):
     # The master keeps a server and thread
     logging_server = None
     server_thread = None
+    
+    # Records from jobs below this level are not shown on the master
+    master_level = logging.INFO
   
     @classmethod
-    def start_master(cls):
+    def start_master(cls, level=logging.INFO):
         """
         Start up the master server and put its details into the options
-        namespace.
+        namespace. The master shows records from jobs at the given level and
+        above.
         
         """
         
         logging.basicConfig(level=logging.INFO)
+        cls.master_level = level
     
-        # Start up the logging server
-        cls.logging_server = SocketServer.ThreadingUDPServer(("0.0.0.0", 0),
-            LoggingDatagramHandler)
+        # Start up the logging server. Each job process keeps a connection
+        # open, and gets its own thread here.
+        SocketServer.ThreadingTCPServer.allow_reuse_address = True
+        cls.logging_server = SocketServer.ThreadingTCPServer(("0.0.0.0", 0),
+            LoggingStreamHandler)
+        cls.logging_server.daemon_threads = True
+        cls.logging_server.log_stats = LogStats()
             
         # Set up a thread to do all the serving in the background and exit when we
         # do
@@ -156,17 +490,34 @@ class RealTimeLogger(object):
         os.environ["RT_LOGGING_HOST"] = socket.getfqdn()
         os.environ["RT_LOGGING_PORT"] = str(
             cls.logging_server.server_address[1])
+            
+    @classmethod
+    def get_stats(cls):
+        """
+        Return a dict of what the master has received from jobs so far (see
+        LogStats.get), or None if we aren't the master.
         
+        """
+        
+        if cls.logging_server is None:
+            return None
+        return cls.logging_server.log_stats.get()
         
     @classmethod
     def stop_master(cls):
         """
-        Stop the server on the master.
+        Stop the server on the master, and report what it received.
         
         """
         
         cls.logging_server.shutdown()
         cls.server_thread.join()
+        
+        stats = cls.get_stats()
+        logging.info("Real-time logging received {records} records in "
+            "{batches} batches ({records_per_second:.1f} records/s, "
+            "{bytes_per_second:.0f} bytes/s); {filtered} filtered, {dropped} "
+            "dropped by jobs, {malformed} malformed".format(**stats))
   
     @classmethod
     def get(cls):
@@ -187,772 +538,2417 @@ class RealTimeLogger(object):
                 os.environ.has_key("RT_LOGGING_PORT")):
                 # We know where to send messages to, so send them.
             
-                cls.logger.addHandler(JSONDatagramHandler(
+                cls.logger.addHandler(BatchingLogHandler(
                     os.environ["RT_LOGGING_HOST"],
                     int(os.environ["RT_LOGGING_PORT"])))
         
         return cls.logger
 
-def write_global_directory(file_store, path, cleanup=False, tee=None):
-    """
-    Write the given directory into the file store, and return an ID that can be
-    used to retrieve it. Writes the files in the directory and subdirectories
-    into a tar file in the file store.
+# Which codecs can directory archives be compressed with, and what file
+# extension goes with each?
+DIRECTORY_CODECS = collections.OrderedDict([("none", ".tar"),
+    ("gzip", ".tar.gz"), ("zstd", ".tar.zst")])
 
-    Does not preserve the name or permissions of the given directory (only of
-    its contents).
+# What do compressed archives start with?
+GZIP_MAGIC = "\x1f\x8b"
+ZSTD_MAGIC = "\x28\xb5\x2f\xfd"
 
-    If cleanup is true, directory will be deleted from the file store when this
-    job and its follow-ons finish.
-    
-    If tee is passed, a tar.gz of the directory contents will be written to that
-    filename. The file thus created must not be modified after this function is
-    called.
+# How much data should we move between pipes at a time?
+PIPE_BUFFER_SIZE = 1024 * 1024
+
+class PrefixedReader(object):
+    """
+    A read-only stream that returns some already-read bytes before the rest of
+    another stream, so we can sniff the start of a non-seekable stream.
     
     """
     
-    if tee is not None:
-        with open(tee, "w") as file_handle:
-            # We have a stream, so start taring into it
-            with tarfile.open(fileobj=file_handle, mode="w|gz") as tar:
-                # Open it for streaming-only write (no seeking)
-                
-                # We can't just add the root directory, since then we wouldn't be
-                # able to extract it later with an arbitrary name.
-                
-                for file_name in os.listdir(path):
-                    # Add each file in the directory to the tar, with a relative
-                    # path
-                    tar.add(os.path.join(path, file_name), arcname=file_name)
-                    
-        # Save the file on disk to the file store.
-        return file_store.writeGlobalFile(tee)
-    else:
+    def __init__(self, prefix, stream):
+        self.prefix = prefix
+        self.stream = stream
+        
+    def read(self, size=-1):
+        if not self.prefix:
+            return self.stream.read(size)
+        if size is None or size < 0:
+            data = self.prefix + self.stream.read()
+            self.prefix = ""
+            return data
+        data = self.prefix[:size]
+        self.prefix = self.prefix[size:]
+        if len(data) < size:
+            data += self.stream.read(size - len(data))
+        return data
+
+class GzipReader(object):
+    """
+    A read-only stream of the decompressed contents of a gzip stream, which,
+    unlike gzip.GzipFile, needn't be seekable.
     
-        with file_store.writeGlobalFileStream(cleanup=cleanup) as (file_handle,
-            file_id):
-            # We have a stream, so start taring into it
-            # TODO: don't duplicate this code.
-            with tarfile.open(fileobj=file_handle, mode="w|gz") as tar:
-                # Open it for streaming-only write (no seeking)
-                
-                # We can't just add the root directory, since then we wouldn't be
-                # able to extract it later with an arbitrary name.
-                
-                for file_name in os.listdir(path):
-                    # Add each file in the directory to the tar, with a relative
-                    # path
-                    tar.add(os.path.join(path, file_name), arcname=file_name)
-                    
-            # Spit back the ID to use to retrieve it
-            return file_id
-        
-def read_global_directory(file_store, directory_id, path):
     """
-    Reads a directory with the given tar file id from the global file store and
-    recreates it at the given path.
     
-    The given path, if it exists, must be a directory.
+    def __init__(self, stream):
+        self.stream = stream
+        self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        # Decompressed data not read yet starts at offset in buffer
+        self.buffer = ""
+        self.offset = 0
+        self.done = False
+        
+    def read(self, size=-1):
+        while not self.done and (size is None or size < 0 or
+            len(self.buffer) - self.offset < size):
+            data = self.stream.read(PIPE_BUFFER_SIZE)
+            parts = [self.buffer[self.offset:]]
+            self.offset = 0
+            if not data:
+                parts.append(self.decompressor.flush())
+                self.done = True
+            else:
+                parts.append(self.decompressor.decompress(data))
+                while self.decompressor.unused_data:
+                    # Another gzip member follows this one
+                    data = self.decompressor.unused_data
+                    self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                    parts.append(self.decompressor.decompress(data))
+            self.buffer = "".join(parts)
+        if size is None or size < 0:
+            size = len(self.buffer) - self.offset
+        data = self.buffer[self.offset:self.offset + size]
+        self.offset += len(data)
+        return data
+
+def _pump(source, destination, errors, close=None):
+    """
+    Copy everything from source to destination, putting any exception info in
+    the errors list. Closes close afterwards, if given. For running in a thread.
     
-    Do not use to extract untrusted directories, since they could sneakily plant
-    files anywhere on the filesystem.
+    """
     
+    try:
+        shutil.copyfileobj(source, destination, PIPE_BUFFER_SIZE)
+    except IOError as e:
+        if e.errno != errno.EPIPE:
+            # A broken pipe just means the other end stopped early.
+            errors.append(sys.exc_info())
+    except:
+        errors.append(sys.exc_info())
+    finally:
+        if close is not None:
+            try:
+                close.close()
+            except IOError:
+                pass
+
+@contextmanager
+def filter_stream(command, stream, mode):
     """
+    Run the given command as a filter on a stream. In mode "w", yields a
+    writable stream, and everything written to it comes out of the command
+    into stream. In mode "r", yields a readable stream of stream's data after
+    it goes through the command.
+
+    Raises an error if the command fails, unless the with block already did.
     
-    # Make the path
-    robust_makedirs(path)
+    """
     
-    with file_store.readGlobalFileStream(directory_id) as file_handle:
-        # We need to pull files out of this tar stream
+    proc = subprocess.Popen(command, stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE)
+    errors = []
+    if mode == "w":
+        pumper = threading.Thread(target=_pump, args=(proc.stdout, stream,
+            errors))
+        ours = proc.stdin
+    else:
+        pumper = threading.Thread(target=_pump, args=(stream, proc.stdin,
+            errors, proc.stdin))
+        ours = proc.stdout
+    pumper.daemon = True
+    pumper.start()
     
-        with tarfile.open(fileobj=file_handle, mode="r|*") as tar:
-            # Open it for streaming-only read (no seeking)
-            
-            # We need to extract the whole thing into that new directory
-            tar.extractall(path)
-            
+    try:
+        yield ours
+        if mode == "r":
+            # Let the command finish, even if the reader didn't need all of
+            # its output.
+            while ours.read(PIPE_BUFFER_SIZE):
+                pass
+    finally:
+        ours.close()
+        pumper.join()
+        proc.wait()
+        
+    if errors:
+        raise errors[0][0], errors[0][1], errors[0][2]
+    if proc.returncode != 0:
+        raise RuntimeError("Command {} failed with code {}".format(
+            " ".join(command), proc.returncode))
 
-class IOStore(object):
+class PartStream(object):
     """
-    A class that lets you get your input files and save your output files
-    to/from a local filesystem, Amazon S3, or Microsoft Azure storage
-    transparently.
-    
-    This is the abstract base class; other classes inherit from this and fill in
-    the methods.
+    A writable stream that collects what is written to it into parts of a
+    fixed size, and hands each full part to a function as soon as it has one.
+    Whatever is left at the end, less than a part, can be handed on with
+    flush_part or taken with remainder.
     
     """
     
-    def __init__(self):
-        """
-        Make a new IOStore
+    def __init__(self, part_size, send_part):
         """
+        Make a stream calling send_part with each part_size bytes written.
         
-        raise NotImplementedError()
-            
-    def read_input_file(self, input_path, local_path):
         """
-        Read an input file from wherever the input comes from and send it to the
-        given path.
-        
-        If the file at local_path already exists, it is overwritten.
         
-        If the file at local_path already exists and is a directory, behavior is
-        undefined.
+        self.part_size = part_size
+        self.send_part = send_part
+        self.buffer = []
+        self.buffered = 0
+        
+    def write(self, data):
+        self.buffer.append(data)
+        self.buffered += len(data)
+        while self.buffered >= self.part_size:
+            joined = "".join(self.buffer)
+            rest = joined[self.part_size:]
+            self.buffer = [rest] if rest else []
+            self.buffered = len(rest)
+            self.send_part(joined[:self.part_size])
+            
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+            
+    def flush(self):
+        # Parts are only sent when full
+        pass
         
+    def remainder(self):
         """
+        Return and forget whatever has been written but not sent yet.
         
-        raise NotImplementedError()
-        
-    def list_input_directory(self, input_path, recursive=False,
-        with_times=False):
         """
-        Yields each of the subdirectories and files in the given input path.
-        
-        If recursive is false, yields files and directories in the given
-        directory. If recursive is true, yields all files contained within the
-        current directory, recursively, but does not yield folders.
         
-        If with_times is True, yields (name, modification time) pairs instead of
-        just names, with modification times represented as datetime objects in
-        the GMT timezone. Modification times may be None on objects that do not
-        support them.
+        data = "".join(self.buffer)
+        self.buffer = []
+        self.buffered = 0
+        return data
         
-        Gives relative file/directory names.
+    def flush_part(self):
+        """
+        Send whatever has been written but not sent yet as a last, short part.
         
         """
         
-        raise NotImplementedError()
+        if self.buffered:
+            self.send_part(self.remainder())
+
+class FanOutWriter(object):
+    """
+    A writable stream that copies everything written to it to several other
+    streams at once. Each stream is written from its own thread, through a
+    queue of a few chunks, so a slow stream only holds up the writer once its
+    queue is full, and memory use stays bounded.
     
-    def write_output_file(self, local_path, output_path):
+    """
+    
+    def __init__(self, streams, chunk_size=PIPE_BUFFER_SIZE, queue_chunks=4):
         """
-        Save the given local file to the given output path. No output directory
-        needs to exist already.
-        
-        If the output path already exists, it is overwritten.
-        
-        If the output path already exists and is a directory, behavior is
-        undefined.
+        Make a writer copying to the given streams, handing them data
+        chunk_size bytes at a time, with at most queue_chunks chunks waiting
+        for each stream.
         
         """
         
-        raise NotImplementedError()
-        
-    def exists(self, path):
+        self.chunk_size = chunk_size
+        self.buffer = []
+        self.buffered = 0
+        # This holds exception info from failed streams
+        self.errors = []
+        self.queues = []
+        self.threads = []
+        for stream in streams:
+            queue = Queue.Queue(queue_chunks)
+            thread = threading.Thread(target=self._drain, args=(queue, stream))
+            thread.daemon = True
+            thread.start()
+            self.queues.append(queue)
+            self.threads.append(thread)
+        self.closed = False
+            
+    def _drain(self, queue, stream):
         """
-        Returns true if the given input or output file exists in the store
-        already.
+        Write chunks from the queue to the stream until we get None. If the
+        stream fails, remember why, and keep emptying the queue so the writer
+        isn't blocked.
         
         """
         
-        raise NotImplementedError()
-        
-    def get_mtime(self, path):
+        failed = False
+        while True:
+            chunk = queue.get()
+            if chunk is None:
+                break
+            if not failed:
+                try:
+                    stream.write(chunk)
+                except:
+                    self.errors.append(sys.exc_info())
+                    failed = True
+                    
+    def _check(self):
         """
-        Returns the modification time of the given gile if it exists, or None
-        otherwise.
-        
+        Raise the first error any stream has had.
         """
         
-        raise NotImplementedError()
+        if self.errors:
+            raise self.errors[0][0], self.errors[0][1], self.errors[0][2]
         
-    @staticmethod
-    def get(store_string):
+    def _send(self):
+        """
+        Send the buffered data to all the streams.
         """
-        Get a concrete IOStore created from the given connection string.
-        
-        Valid formats are just like for a Toil JobStore, except with container
-        names being specified on Azure.
-        
-        Formats:
-        
-        /absolute/filesystem/path
-        
-        ./relative/filesystem/path
-        
-        file:filesystem/path
-        
-        aws:region:bucket (TODO)
-        
-        aws:region:bucket/path/prefix (TODO)
-        
-        azure:account:container (instead of a container prefix) (gets keys like
-        Toil)
-        
-        azure:account:container/path/prefix (trailing slash added automatically)
         
+        chunk = "".join(self.buffer)
+        self.buffer = []
+        self.buffered = 0
+        for queue in self.queues:
+            queue.put(chunk)
+        self._check()
+        
+    def write(self, data):
+        self.buffer.append(data)
+        self.buffered += len(data)
+        if self.buffered >= self.chunk_size:
+            self._send()
+            
+    def flush(self):
+        # Nothing leaves the buffer until there is a whole chunk or we close.
+        pass
+            
+    def close(self):
         """
+        Send the last data, wait for all the streams to have it, and raise an
+        error if any of them failed.
         
-        # Code adapted from toil's common.py loadJobStore()
+        """
         
-        if store_string[0] in "/.":
-            # Prepend file: tot he path
-            store_string = "file:" + store_string
+        if self.closed:
+            return
+        self.closed = True
+        if self.buffered:
+            self._send()
+        for queue in self.queues:
+            queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        self._check()
 
-        try:
-            # Break off the first colon-separated piece.
-            store_type, store_arguments = store_string.split(":", 1)
-        except ValueError:
-            # They probably forgot the . or /
-            raise RuntimeError("Incorrect IO store specification {}. "
-                "Local paths must start with . or /".format(store_string))
+@contextmanager
+def nested_streams(managers):
+    """
+    Enter all the given context managers, innermost last, and yield a list of
+    what they produce.
+    
+    """
+    
+    if not managers:
+        yield []
+        return
+    with managers[0] as first:
+        with nested_streams(managers[1:]) as rest:
+            yield [first] + rest
 
-        if store_type == "file":
-            return FileIOStore(store_arguments)
-        elif store_type == "aws":
-            # Break out the AWS arguments
-            region, name_prefix = store_arguments.split(":", 1)
-            raise NotImplementedError("AWS IO store not written")
-        elif store_type == "azure":
-            # Break out the Azure arguments.
-            account, container = store_arguments.split(":", 1)
+@contextmanager
+def compressed_writer(stream, codec):
+    """
+    Yield a writable stream that compresses what is written to it with the
+    given codec ("none", "gzip" or "zstd") into the given stream. Uses all the
+    cores through pigz or zstd when they are installed.
+    
+    """
+    
+    if codec == "none":
+        yield stream
+    elif codec == "gzip":
+        if distutils.spawn.find_executable("pigz") is not None:
+            with filter_stream(["pigz", "-c"], stream, "w") as compressed:
+                yield compressed
+        else:
+            with gzip.GzipFile(fileobj=stream, mode="wb") as compressed:
+                yield compressed
+    elif codec == "zstd":
+        if distutils.spawn.find_executable("zstd") is not None:
+            with filter_stream(["zstd", "-q", "-c", "-T0"], stream,
+                "w") as compressed:
+                yield compressed
+        elif have_zstandard:
+            compressor = zstandard.ZstdCompressor(threads=-1)
+            with compressor.stream_writer(stream) as compressed:
+                yield compressed
+        else:
+            raise RuntimeError("zstd compression needs the zstd command or "
+                "the zstandard module")
+    else:
+        raise RuntimeError("Unknown codec: {}".format(codec))
+
+@contextmanager
+def decompressed_reader(stream):
+    """
+    Yield a readable stream of the decompressed contents of the given stream,
+    detecting whether it is gzip, zstd, or not compressed from its first
+    bytes.
+    
+    """
+    
+    prefix = stream.read(len(ZSTD_MAGIC))
+    stream = PrefixedReader(prefix, stream)
+    
+    if prefix.startswith(GZIP_MAGIC):
+        if distutils.spawn.find_executable("pigz") is not None:
+            with filter_stream(["pigz", "-dc"], stream, "r") as decompressed:
+                yield decompressed
+        else:
+            yield GzipReader(stream)
+    elif prefix == ZSTD_MAGIC:
+        if distutils.spawn.find_executable("zstd") is not None:
+            with filter_stream(["zstd", "-q", "-dc"], stream,
+                "r") as decompressed:
+                yield decompressed
+        elif have_zstandard:
+            yield zstandard.ZstdDecompressor().stream_reader(stream)
+        else:
+            raise RuntimeError("zstd decompression needs the zstd command or "
+                "the zstandard module")
+    else:
+        yield stream
+
+def write_directory_archive(path, stream, codec="gzip"):
+    """
+    Write a tar archive of the contents of the directory at path to the given
+    stream, compressed with the given codec. The stream needn't be seekable.
+    
+    """
+    
+    with compressed_writer(stream, codec) as compressed:
+        # Open it for streaming-only write (no seeking)
+        with tarfile.open(fileobj=compressed, mode="w|") as tar:
+            # We can't just add the root directory, since then we wouldn't be
+            # able to extract it later with an arbitrary name.
             
-            if "/" in container:
-                # Split the container from the path
-                container, path_prefix = container.split("/", 1)
-            else:
-                # No path prefix
-                path_prefix = ""
+            for file_name in os.listdir(path):
+                # Add each file in the directory to the tar, with a relative
+                # path
+                tar.add(os.path.join(path, file_name), arcname=file_name)
+                
+def read_directory_archive(stream, path):
+    """
+    Extract a tar archive, in any codec write_directory_archive can use, from
+    the given stream into the directory at path.
+    
+    """
+    
+    with decompressed_reader(stream) as decompressed:
+        # Open it for streaming-only read (no seeking)
+        with tarfile.open(fileobj=decompressed, mode="r|") as tar:
+            # We need to extract the whole thing into that new directory
+            tar.extractall(path)
+
+def write_global_directory(file_store, path, cleanup=False, tee=None,
+    codec="gzip", copies=()):
+    """
+    Write the given directory into the file store, and return an ID that can be
+    used to retrieve it. Writes the files in the directory and subdirectories
+    into a tar file in the file store, compressed with the given codec (one of
+    DIRECTORY_CODECS).
+
+    Does not preserve the name or permissions of the given directory (only of
+    its contents).
+
+    If cleanup is true, directory will be deleted from the file store when this
+    job and its follow-ons finish.
+    
+    If tee is passed, the compressed tar of the directory contents will be
+    written to that filename. The file thus created must not be modified after
+    this function is called.
+
+    Each (IOStore, output path) pair in copies also gets the compressed tar
+    saved to it. A store that can't take a stream directly spools it next to
+    the directory, on the job's own disk.
+
+    The directory is only tarred and compressed once, and the compressed data
+    is written to the file store, the tee file and the copies all at once.
+    
+    """
+    
+    # What else wants the archive, besides the file store?
+    managers = []
+    if tee is not None:
+        managers.append(open(tee, "w"))
+    for store, output_path in copies:
+        managers.append(store.write_output_stream(output_path,
+            temp_dir=os.path.dirname(os.path.abspath(path))))
+    
+    with file_store.writeGlobalFileStream(cleanup=cleanup) as (file_handle,
+        file_id):
+        with nested_streams(managers) as streams:
+            # We have our streams, so start taring into all of them
+            fan_out = FanOutWriter([file_handle] + streams)
+            try:
+                write_directory_archive(path, fan_out, codec)
+            finally:
+                fan_out.close()
+                
+        # Spit back the ID to use to retrieve it
+        return file_id
+        
+def read_global_directory(file_store, directory_id, path, cache=None):
+    """
+    Reads a directory with the given tar file id from the global file store and
+    recreates it at the given path.
+    
+    The given path, if it exists, must be a directory.
+
+    If a DirectoryCache is passed as cache, the directory is only extracted
+    once per host, and its files are linked into the given path read-only.
+    Jobs must not modify those files in place.
+    
+    Do not use to extract untrusted directories, since they could sneakily plant
+    files anywhere on the filesystem.
+    
+    """
+    
+    def extract(extract_path):
+        """
+        Extract the directory from the file store to the given path.
+        """
+    
+        # Make the path
+        robust_makedirs(extract_path)
+    
+        with file_store.readGlobalFileStream(directory_id) as file_handle:
+            # We need to pull files out of this tar stream, whatever it was
+            # compressed with.
+            read_directory_archive(file_handle, extract_path)
+                
+    if cache is None:
+        extract(path)
+    else:
+        cache.link_into(directory_id, extract, path)
+
+@contextmanager
+def file_lock(lock_path, operation=fcntl.LOCK_EX):
+    """
+    Hold an flock on the given lock file, creating it if needed, while in the
+    with block. With LOCK_NB in the operation, yields False instead of waiting
+    if someone else has the lock, and True otherwise.
+    
+    """
+    
+    with open(lock_path, "a") as lock_handle:
+        try:
+            fcntl.flock(lock_handle, operation)
+        except IOError as e:
+            if (e.errno in (errno.EAGAIN, errno.EACCES) and
+                operation & fcntl.LOCK_NB):
+                yield False
+                return
+            raise
+        try:
+            yield True
+        finally:
+            fcntl.flock(lock_handle, fcntl.LOCK_UN)
+
+class DirectoryCache(object):
+    """
+    A host-level cache of directories from the global file store, such as
+    graph indexes, shared by all the jobs on a host.
+    
+    Each directory is extracted once into the cache, atomically, under a lock
+    that makes other jobs wanting it wait for the one extraction. The cached
+    files are made read-only and hard-linked into each job's directory
+    (falling back to symlinks across filesystems). When the cache is over its
+    size budget, the least recently used directories no job is currently
+    linking from are evicted. Jobs that got symlinks should keep the budget
+    big enough for their directory to stay around.
+    
+    Hit, miss and eviction counts for the host are kept in stats.json in the
+    cache directory.
+    
+    """
+    
+    # Cache entries are named by the hash of their directory ID
+    ENTRY_PATTERN = re.compile("^[0-9a-f]{40}$")
+    
+    def __init__(self, cache_dir, max_bytes):
+        """
+        Make a cache that keeps directories under cache_dir, and tries to use
+        no more than max_bytes of disk.
+        
+        """
+        
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        
+    def _entry(self, key):
+        """
+        Return the path of the cache entry with the given key.
+        """
+        
+        return os.path.join(self.cache_dir, key)
+        
+    def link_into(self, directory_id, fetch, path):
+        """
+        Make the directory with the given ID available at path, calling fetch
+        with a path to extract it to if it isn't cached yet.
+        
+        """
+        
+        robust_makedirs(self.cache_dir)
+        
+        key = hashlib.sha1(str(directory_id)).hexdigest()
+        entry = self._entry(key)
+        
+        with file_lock(entry + ".lock"):
+            hit = os.path.isdir(entry)
+            if not hit:
+                # Extract to a temporary directory and move it into place, so
+                # a partial extraction never looks like a cache entry.
+                RealTimeLogger.get().info("Directory cache miss for {}; "
+                    "extracting to {}".format(directory_id, entry))
+                temp_dir = tempfile.mkdtemp(prefix=key + ".tmp",
+                    dir=self.cache_dir)
+                fetch(temp_dir)
+                
+                size = 0
+                for dir_path, dir_names, file_names in os.walk(temp_dir):
+                    for file_name in file_names:
+                        file_path = os.path.join(dir_path, file_name)
+                        mode = os.lstat(file_path).st_mode
+                        if stat.S_ISREG(mode):
+                            # Make sure nobody scribbles on the cached copy
+                            # through their link.
+                            os.chmod(file_path, mode & ~(stat.S_IWUSR |
+                                stat.S_IWGRP | stat.S_IWOTH))
+                            size += os.path.getsize(file_path)
+                with open(entry + ".size", "w") as size_file:
+                    size_file.write(str(size))
+                os.rename(temp_dir, entry)
             
-            return AzureIOStore(account, container, path_prefix)
-        else:
-            raise RuntimeError("Unknown IOStore implementation {}".format(
-                store_type))
+            self._link_tree(entry, path)
+            
+            # Mark it as recently used
+            os.utime(entry, None)
+            
+        self._update_stats(hits=int(hit), misses=int(not hit))
+        self.evict(keep=key)
+        
+        if hit:
+            RealTimeLogger.get().info("Directory cache hit for {}".format(
+                directory_id))
+            
+    def _link_tree(self, source, destination):
+        """
+        Link all the files under source into the same places under
+        destination, making directories as needed.
         
+        """
+        
+        for dir_path, dir_names, file_names in os.walk(source):
+            dest_dir = os.path.join(destination,
+                os.path.relpath(dir_path, source))
+            robust_makedirs(dest_dir)
+            for file_name in file_names:
+                source_file = os.path.join(dir_path, file_name)
+                dest_file = os.path.join(dest_dir, file_name)
+                if os.path.lexists(dest_file):
+                    os.unlink(dest_file)
+                if os.path.islink(source_file):
+                    os.symlink(os.readlink(source_file), dest_file)
+                    continue
+                try:
+                    os.link(source_file, dest_file)
+                except OSError as e:
+                    if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+                        raise
+                    # Can't hard link here, so use a symlink
+                    os.symlink(source_file, dest_file)
+                    
+    def _update_stats(self, **counts):
+        """
+        Add the given counts to the host's cache stats.
         
+        """
+        
+        stats_path = os.path.join(self.cache_dir, "stats.json")
+        with file_lock(os.path.join(self.cache_dir, "stats.lock")):
+            stats = self.stats()
+            for name, count in counts.iteritems():
+                stats[name] = stats.get(name, 0) + count
+            temp_path = stats_path + ".tmp"
+            with open(temp_path, "w") as stats_file:
+                json.dump(stats, stats_file)
+            os.rename(temp_path, stats_path)
             
-class FileIOStore(IOStore):
+    def stats(self):
+        """
+        Return a dict of the hits, misses and evictions of the cache on this
+        host so far.
+        
+        """
+        
+        stats = {"hits": 0, "misses": 0, "evictions": 0}
+        try:
+            with open(os.path.join(self.cache_dir, "stats.json")) as stats_file:
+                stats.update(json.load(stats_file))
+        except (IOError, ValueError):
+            pass
+        return stats
+        
+    def evict(self, keep=None):
+        """
+        Delete least recently used cache entries, other than the one with the
+        key keep, until the cache fits in its budget. Entries that are locked
+        are skipped, as are abandoned temporary extractions.
+        
+        """
+        
+        with file_lock(os.path.join(self.cache_dir, "evict.lock")):
+            entries = []
+            total_bytes = 0
+            for name in os.listdir(self.cache_dir):
+                entry = self._entry(name)
+                if ".tmp" in name and os.path.isdir(entry):
+                    # Clean up after jobs that died extracting
+                    key = name.split(".tmp")[0]
+                    with file_lock(self._entry(key) + ".lock",
+                        fcntl.LOCK_EX | fcntl.LOCK_NB) as locked:
+                        if locked:
+                            shutil.rmtree(entry, ignore_errors=True)
+                    continue
+                if not self.ENTRY_PATTERN.match(name) or not os.path.isdir(entry):
+                    continue
+                try:
+                    with open(entry + ".size") as size_file:
+                        size = int(size_file.read())
+                except (IOError, ValueError):
+                    size = 0
+                entries.append((os.path.getmtime(entry), name, size))
+                total_bytes += size
+                
+            evictions = 0
+            for _, name, size in sorted(entries):
+                if total_bytes <= self.max_bytes:
+                    break
+                if name == keep:
+                    continue
+                entry = self._entry(name)
+                with file_lock(entry + ".lock",
+                    fcntl.LOCK_EX | fcntl.LOCK_NB) as locked:
+                    if not locked:
+                        # Someone is using it right now
+                        continue
+                    RealTimeLogger.get().info("Evicting {} from directory "
+                        "cache".format(entry))
+                    # Move it out of the way first so it vanishes atomically
+                    doomed = tempfile.mkdtemp(prefix=name + ".tmp",
+                        dir=self.cache_dir)
+                    os.rename(entry, os.path.join(doomed, name))
+                    os.unlink(entry + ".size")
+                    shutil.rmtree(doomed, ignore_errors=True)
+                total_bytes -= size
+                evictions += 1
+                
+        if evictions:
+            self._update_stats(evictions=evictions)
+
+class IOStore(object):
     """
-    A class that lets you get input from and send output to filesystem files.
+    A class that lets you get your input files and save your output files
+    to/from a local filesystem, Amazon S3, or Microsoft Azure storage
+    transparently.
+    
+    This is the abstract base class; other classes inherit from this and fill in
+    the methods.
     
     """
     
-    def __init__(self, path_prefix=""):
+    # How many times should one file in a bulk transfer be retried? Stores that
+    # retry each request or part themselves set this to 0, so retries don't
+    # multiply.
+    file_retries = 2
+    
+    # Should write_output_file leave alone stored files that already have the
+    # local file's content?
+    skip_unchanged = False
+    
+    def __init__(self):
+        """
+        Make a new IOStore
+        """
+        
+        raise NotImplementedError()
+            
+    def read_input_file(self, input_path, local_path):
+        """
+        Read an input file from wherever the input comes from and send it to the
+        given path.
+        
+        If the file at local_path already exists, it is overwritten.
+        
+        If the file at local_path already exists and is a directory, behavior is
+        undefined.
+        
+        """
+        
+        raise NotImplementedError()
+        
+    def list_input_directory(self, input_path, recursive=False,
+        with_times=False):
+        """
+        Yields each of the subdirectories and files in the given input path.
+        
+        If recursive is false, yields files and directories in the given
+        directory. If recursive is true, yields all files contained within the
+        current directory, recursively, but does not yield folders.
+        
+        If with_times is True, yields (name, modification time) pairs instead of
+        just names, with modification times represented as datetime objects in
+        the GMT timezone. Modification times may be None on objects that do not
+        support them.
+        
+        Gives relative file/directory names.
+        
+        """
+        
+        raise NotImplementedError()
+    
+    def write_output_file(self, local_path, output_path):
+        """
+        Save the given local file to the given output path. No output directory
+        needs to exist already.
+        
+        If the output path already exists, it is overwritten.
+        
+        If the output path already exists and is a directory, behavior is
+        undefined.
+        
+        """
+        
+        raise NotImplementedError()
+        
+    def get_checksum(self, path):
+        """
+        Returns the MD5 hex digest of the given stored file, as recorded when
+        it was written, or None if it doesn't exist or has no checksum.
+        
+        """
+        
+        return None
+        
+    def get_size(self, path):
+        """
+        Returns the size in bytes of the given stored file, or None if it
+        doesn't exist.
+        
+        """
+        
+        raise NotImplementedError()
+        
+    def local_checksum(self, local_path):
+        """
+        Returns the checksum of the given local file, in the form get_checksum
+        gives for a stored file with the same content. This is the MD5 hex
+        digest, unless the store records checksums of big files part by part.
+        
+        """
+        
+        return file_checksum(local_path)
+        
+    def quick_check(self, local_path, output_path):
+        """
+        Tell, without reading either file, whether the stored file at the
+        output path has the local file's content. Returns False if it can't
+        have (it is missing or a different size), True if it must have, or None
+        if the checksums have to be compared.
+        
+        """
+        
+        if self.get_size(output_path) != os.path.getsize(local_path):
+            return False
+        return None
+        
+    def check_unchanged(self, local_path, output_path):
+        """
+        Call at the start of write_output_file. Returns a pair of whether the
+        write can be skipped, because skip_unchanged is set and the store
+        already has the local file's content at the output path, and the
+        local file's checksum to record with the stored file, or None if we
+        aren't checking or didn't need to read the file to tell.
+        
+        The local file is only read when quick_check can't tell by itself, so
+        a file that changed size costs no extra pass over it. Hits and misses
+        are counted in checksum_stats.
+        
+        """
+        
+        if not self.skip_unchanged:
+            return False, None
+            
+        checksum = None
+        unchanged = self.quick_check(local_path, output_path)
+        if unchanged is None:
+            checksum = self.local_checksum(local_path)
+            unchanged = (self.get_checksum(output_path) == checksum)
+        
+        # Stores don't all call our __init__, so make the counts on demand
+        stats = self.__dict__.setdefault("checksum_stats",
+            collections.Counter())
+        stats["hits" if unchanged else "misses"] += 1
+        
+        if unchanged:
+            RealTimeLogger.get().info("Skipping unchanged {} ({} skipped, {} "
+                "written so far)".format(output_path, stats["hits"],
+                stats["misses"]))
+        
+        return unchanged, checksum
+        
+    def iter_input_files(self, pairs, threads=8):
+        """
+        Download each of the given (input path, local path) pairs, as in
+        read_input_file, several at once. Yields the local paths in the order
+        given, each as soon as it and all the ones before it are done, so
+        callers can use early files while later ones are still downloading.
+        
+        Each file is retried on its own, and aggregate throughput is logged.
+        
+        """
+        
+        for _, local_path in transfer_files("Download from {}".format(
+            type(self).__name__), self.read_input_file, pairs, threads,
+            lambda pair: pair[1], self.file_retries):
+            yield local_path
+            
+    def read_input_files(self, pairs, threads=8):
+        """
+        Download all the given (input path, local path) pairs, as in
+        read_input_file, several at once. Returns when they are all done.
+        
+        """
+        
+        for _ in self.iter_input_files(pairs, threads):
+            pass
+            
+    def write_output_files(self, pairs, threads=8):
+        """
+        Upload all the given (local path, output path) pairs, as in
+        write_output_file, several at once. Returns when they are all done.
+        
+        Each file is retried on its own, and aggregate throughput is logged.
+        
+        """
+        
+        for _ in transfer_files("Upload to {}".format(type(self).__name__),
+            self.write_output_file, pairs, threads, lambda pair: pair[0],
+            self.file_retries):
+            pass
+        
+    @contextmanager
+    def write_output_stream(self, output_path, temp_dir=None):
+        """
+        Yield a writable stream, and save everything written to it to the given
+        output path when the with block finishes without error, as in
+        write_output_file.
+        
+        Stores that can't save a stream directly save it through a temporary
+        local file in temp_dir, which should be on the job's own disk, or in
+        the system temporary directory if temp_dir is None. The stores here all
+        stream directly.
+        
+        """
+        
+        temp_handle, temp_path = tempfile.mkstemp(dir=temp_dir)
+        try:
+            with os.fdopen(temp_handle, "w") as stream:
+                yield stream
+            self.write_output_file(temp_path, output_path)
+        finally:
+            os.unlink(temp_path)
+        
+    def exists(self, path):
+        """
+        Returns true if the given input or output file exists in the store
+        already.
+        
+        """
+        
+        raise NotImplementedError()
+        
+    def get_mtime(self, path):
+        """
+        Returns the modification time of the given gile if it exists, or None
+        otherwise.
+        
+        """
+        
+        raise NotImplementedError()
+        
+    @staticmethod
+    def get(store_string, file_transfer="copy", skip_unchanged=False):
+        """
+        Get a concrete IOStore created from the given connection string.
+        FileIOStores put output files in place with the given file_transfer
+        mode (see FileIOStore.TRANSFER_MODES). If skip_unchanged is set, the
+        store won't write files whose content it already has.
+        
+        Valid formats are just like for a Toil JobStore, except with container
+        names being specified on Azure.
+        
+        Formats:
+        
+        /absolute/filesystem/path
+        
+        ./relative/filesystem/path
+        
+        file:filesystem/path
+        
+        aws:region:bucket
+        
+        aws:region:bucket/path/prefix (trailing slash added automatically)
+        
+        azure:account:container (instead of a container prefix) (gets keys like
+        Toil)
+        
+        azure:account:container/path/prefix (trailing slash added automatically)
+        
+        """
+        
+        # Code adapted from toil's common.py loadJobStore()
+        
+        if store_string[0] in "/.":
+            # Prepend file: tot he path
+            store_string = "file:" + store_string
+
+        try:
+            # Break off the first colon-separated piece.
+            store_type, store_arguments = store_string.split(":", 1)
+        except ValueError:
+            # They probably forgot the . or /
+            raise RuntimeError("Incorrect IO store specification {}. "
+                "Local paths must start with . or /".format(store_string))
+
+        if store_type == "file":
+            store = FileIOStore(store_arguments, file_transfer)
+        elif store_type == "aws":
+            # Break out the AWS arguments
+            region, bucket = store_arguments.split(":", 1)
+            
+            if "/" in bucket:
+                # Split the bucket from the path
+                bucket, path_prefix = bucket.split("/", 1)
+            else:
+                # No path prefix
+                path_prefix = ""
+                
+            store = S3IOStore(region, bucket, path_prefix)
+        elif store_type == "azure":
+            # Break out the Azure arguments.
+            account, container = store_arguments.split(":", 1)
+            
+            if "/" in container:
+                # Split the container from the path
+                container, path_prefix = container.split("/", 1)
+            else:
+                # No path prefix
+                path_prefix = ""
+            
+            store = AzureIOStore(account, container, path_prefix)
+        else:
+            raise RuntimeError("Unknown IOStore implementation {}".format(
+                store_type))
+                
+        store.skip_unchanged = skip_unchanged
+        return store
+        
+        
+            
+class FileIOStore(IOStore):
+    """
+    A class that lets you get input from and send output to filesystem files.
+    
+    """
+    
+    # How can output files be put into the store? "copy" always copies.
+    # "link" tries a hard link, then a reflink (a copy-on-write clone, on
+    # filesystems like btrfs and XFS), and only then a copy. Linked outputs
+    # share their data with the local file, so they must not be modified after
+    # they are written.
+    TRANSFER_MODES = ["copy", "link"]
+    
+    # ioctl request number for cloning one file's data into another on Linux
+    FICLONE = 0x40049409
+    
+    # Local filesystem errors won't go away if we wait
+    file_retries = 0
+    
+    def __init__(self, path_prefix="", transfer="copy"):
+        """
+        Make a new FileIOStore that just treats everything as local paths,
+        relative to the given prefix. Output files are put in place using the
+        given transfer mode, one of TRANSFER_MODES.
+        
+        """
+        
+        if transfer not in self.TRANSFER_MODES:
+            raise RuntimeError("Unknown FileIOStore transfer mode {}".format(
+                transfer))
+        
+        self.path_prefix = path_prefix
+        self.transfer = transfer
+        
+    def read_input_file(self, input_path, local_path):
+        """
+        Get input from the filesystem.
+        """
+        
+        RealTimeLogger.get().debug("Loading {} from FileIOStore in {} to {}".format(
+            input_path, self.path_prefix, local_path))
+        
+        if os.path.exists(local_path):
+            # Try deleting the existing item if it already exists
+            try:
+                os.unlink(local_path)
+            except:
+                # Don't fail here, fail complaining about the assertion, which
+                # will be more informative.
+                pass
+                
+        # Make sure the path is clear for the symlink.
+        assert(not os.path.exists(local_path))
+        
+        # Where is the file actually?
+        real_path = os.path.abspath(os.path.join(self.path_prefix, input_path))
+        
+        if not os.path.exists(real_path):
+            RealTimeLogger.get().error(
+                "Can't find {} from FileIOStore in {}!".format(input_path,
+                self.path_prefix))
+            raise RuntimeError("File {} missing!".format(real_path))
+        
+        # Make a symlink to grab things
+        os.symlink(real_path, local_path)
+            
+        # Look at the file stats
+        file_stats = os.stat(real_path)
+        
+        if (file_stats.st_uid == os.getuid() and 
+            file_stats.st_mode & stat.S_IWUSR):
+            # We own this file and can write to it. We don't want the user
+            # script messing it up through the symlink.
+            
+            try:
+                # Clear the user write bit, so the user can't accidentally
+                # clobber the file in the actual store through the symlink.
+                os.chmod(real_path, file_stats.st_mode ^ stat.S_IWUSR)
+            except OSError:
+                # If something goes wrong here (like us not having permission to
+                # change permissions), ignore it.
+                pass
+        
+    def list_input_directory(self, input_path, recursive=False,
+        with_times=False):
+        """
+        Loop over directories on the filesystem.
+        """
+        
+        RealTimeLogger.get().info("Enumerating {} from "
+            "FileIOStore in {}".format(input_path, self.path_prefix))
+        
+        if not os.path.exists(os.path.join(self.path_prefix, input_path)):
+            # Nothing to list over
+            return
+            
+        if not os.path.isdir(os.path.join(self.path_prefix, input_path)):
+            # Can't list a file, only a directory.
+            return
+        
+        for item in os.listdir(os.path.join(self.path_prefix, input_path)):
+            if(recursive and os.path.isdir(os.path.join(self.path_prefix,
+                input_path, item))):
+                # We're recursing and this is a directory.
+                # Recurse on this.
+                for subitem in self.list_input_directory(
+                    os.path.join(input_path, item), recursive):
+                    
+                    # Make relative paths include this directory name and yield
+                    # them
+                    name_to_yield = os.path.join(item, subitem)
+                    
+                    if with_times:
+                        # What is the mtime in seconds since epoch?
+                        mtime_epoch_seconds = os.path.getmtime(os.path.join(
+                            input_path, item, subitem))
+                        # Convert it to datetime
+                        mtime_datetime = datetime.datetime.utcfromtimestamp(
+                            mtime_epoch_seconds).replace(
+                            tzinfo=dateutil.tz.tzutc())
+                            
+                        yield name_to_yield, mtime_datetime
+                    else:
+                        yield name_to_yield
+            else:
+                # This isn't a directory or we aren't being recursive
+                # Just report this individual item.
+                
+                if with_times:
+                    # What is the mtime in seconds since epoch?
+                    mtime_epoch_seconds = os.path.getmtime(os.path.join(
+                        input_path, item))
+                    # Convert it to datetime
+                    mtime_datetime = datetime.datetime.utcfromtimestamp(
+                        mtime_epoch_seconds).replace(
+                        tzinfo=dateutil.tz.tzutc())
+                        
+                    yield item, mtime_datetime
+                else:
+                    yield item
+    
+    def write_output_file(self, local_path, output_path):
+        """
+        Write output to the filesystem
+        """
+
+        RealTimeLogger.get().debug("Saving {} to FileIOStore in {}".format(
+            output_path, self.path_prefix))
+            
+        if self.check_unchanged(local_path, output_path)[0]:
+            return
+
+        # What's the real output path to write to?
+        real_output_path = os.path.join(self.path_prefix, output_path)
+
+        # What directory should this go in?
+        parent_dir = os.path.split(real_output_path)[0]
+            
+        if parent_dir != "":
+            # Make sure the directory it goes in exists.
+            robust_makedirs(parent_dir)
+        
+        # Make a temporary file
+        temp_handle, temp_path = tempfile.mkstemp(dir=self.path_prefix)
+        os.close(temp_handle)
+        
+        try:
+            # Put the data in the temp file
+            method = self.__transfer(local_path, temp_path)
+        except:
+            if os.path.exists(temp_path):
+                os.unlink(temp_path)
+            raise
+        
+        if os.path.exists(real_output_path):
+            # At least try to get existing files out of the way first.
+            os.unlink(real_output_path)
+            
+        # Rename the temp file to the right place, atomically
+        os.rename(temp_path, real_output_path)
+        
+        RealTimeLogger.get().debug("Saved {} by {}".format(output_path,
+            method))
+        
+    def __transfer(self, local_path, temp_path):
+        """
+        Fill in the existing temp file from the given local file, according to
+        the store's transfer mode. Returns the method that worked: "link",
+        "reflink" or "copy".
+        
+        """
+        
+        if self.transfer == "link":
+            # Link to the file itself, not to any symlink to it
+            source_path = os.path.realpath(local_path)
+            
+            # A hard link needs the name to be free
+            os.unlink(temp_path)
+            try:
+                os.link(source_path, temp_path)
+                return "link"
+            except OSError as e:
+                if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK,
+                    errno.EOPNOTSUPP):
+                    raise
+                # We can't link here (probably another filesystem). Put the
+                # temp file back and try cloning instead.
+                open(temp_path, "w").close()
+                
+            try:
+                with open(source_path, "rb") as source:
+                    with open(temp_path, "wb") as destination:
+                        fcntl.ioctl(destination.fileno(), self.FICLONE,
+                            source.fileno())
+                shutil.copystat(source_path, temp_path)
+                return "reflink"
+            except (IOError, OSError) as e:
+                if e.errno not in (errno.EXDEV, errno.EOPNOTSUPP, errno.EINVAL,
+                    errno.ENOTTY, errno.EPERM):
+                    raise
+                # This filesystem can't clone files; copy it the old way
+            
+        shutil.copy2(local_path, temp_path)
+        return "copy"
+        
+    @contextmanager
+    def write_output_stream(self, output_path, temp_dir=None):
+        """
+        Write output to the filesystem from a stream, putting the file in place
+        atomically when the stream is done. The stream goes straight into a
+        temporary file next to where it will go, so temp_dir isn't used.
+        
+        """
+        
+        RealTimeLogger.get().debug("Streaming {} to FileIOStore in {}".format(
+            output_path, self.path_prefix))
+            
+        # What's the real output path to write to?
+        real_output_path = os.path.join(self.path_prefix, output_path)
+        
+        # What directory should this go in?
+        parent_dir = os.path.split(real_output_path)[0]
+            
+        if parent_dir != "":
+            # Make sure the directory it goes in exists.
+            robust_makedirs(parent_dir)
+            
+        # Make a temporary file next to where it will go
+        temp_handle, temp_path = tempfile.mkstemp(dir=self.path_prefix)
+        try:
+            with os.fdopen(temp_handle, "w") as stream:
+                yield stream
+        except:
+            os.unlink(temp_path)
+            raise
+            
+        if os.path.exists(real_output_path):
+            # At least try to get existing files out of the way first.
+            os.unlink(real_output_path)
+            
+        # Rename the temp file to the right place, atomically
+        os.rename(temp_path, real_output_path)
+        
+    def get_checksum(self, path):
+        """
+        Returns the MD5 hex digest of the given stored file, or None if it
+        doesn't exist. Files on disk keep no checksums, so this reads the file.
+        
+        """
+        
+        real_path = os.path.join(self.path_prefix, path)
+        if not os.path.isfile(real_path):
+            return None
+        return file_checksum(real_path)
+        
+    def get_size(self, path):
+        """
+        Returns the size in bytes of the given stored file, or None if it
+        doesn't exist.
+        
+        """
+        
+        real_path = os.path.join(self.path_prefix, path)
+        if not os.path.isfile(real_path):
+            return None
+        return os.path.getsize(real_path)
+        
+    def quick_check(self, local_path, output_path):
+        """
+        Every transfer mode keeps the local file's modification time, so a
+        stored file with the same size and modification time is taken to be
+        unchanged without reading either file, as rsync does.
+        
+        """
+        
+        real_path = os.path.join(self.path_prefix, output_path)
+        if not os.path.isfile(real_path):
+            return False
+        local_stat = os.stat(local_path)
+        stored_stat = os.stat(real_path)
+        if local_stat.st_size != stored_stat.st_size:
+            return False
+        # Copies only keep times to the microsecond
+        if abs(local_stat.st_mtime - stored_stat.st_mtime) < 1e-6:
+            return True
+        return None
+        
+    def exists(self, path):
+        """
+        Returns true if the given input or output file exists in the file system
+        already.
+        
+        """
+        
+        return os.path.exists(os.path.join(self.path_prefix, path))
+        
+    def get_mtime(self, path):
+        """
+        Returns the modification time of the given file if it exists, or None
+        otherwise.
+        
+        """
+        
+        if not self.exists(path):
+            return None
+            
+        # What is the mtime in seconds since epoch?
+        mtime_epoch_seconds = os.path.getmtime(os.path.join(self.path_prefix,
+            path))
+        # Convert it to datetime
+        mtime_datetime = datetime.datetime.utcfromtimestamp(
+            mtime_epoch_seconds).replace(tzinfo=dateutil.tz.tzutc())
+            
+        # Return the modification time, timezoned, in UTC
+        return mtime_datetime
+
+class BackoffError(RuntimeError):
+    """
+    Represents an error from running out of retries during exponential back-off.
+    """
+
+def backoff_times(retries, base_delay):
+    """
+    A generator that yields times for random exponential back-off. You have to
+    do the exception handling and sleeping yourself. Stops when the retries run
+    out.
+    
+    """
+    
+    # Don't wait at all before the first try
+    yield 0
+    
+    # What retry are we on?
+    try_number = 1
+    
+    # Make a delay that increases
+    delay = float(base_delay) * 2
+    
+    while try_number <= retries:
+        # Wait a random amount between 0 and 2^try_number * base_delay
+        yield random.uniform(base_delay, delay)
+        delay *= 2
+        try_number += 1
+        
+    # If we get here, we're stopping iteration without succeeding. The caller
+    # will probably raise an error.
+        
+def backoff(original_function, retries=6, base_delay=10):
+    """
+    We define a decorator that does randomized exponential back-off up to a
+    certain number of retries. Raises BackoffError if the operation doesn't
+    succeed after backing off for the specified number of retries (which may be
+    float("inf")).
+    
+    Unfortunately doesn't really work on generators.
+    """
+    
+    # Make a new version of the function
+    @functools.wraps(original_function)
+    def new_function(*args, **kwargs):
+        # Call backoff times, overriding parameters with stuff from kwargs        
+        for delay in backoff_times(retries=kwargs.get("retries", retries),
+            base_delay=kwargs.get("base_delay", base_delay)):
+            # Keep looping until it works or our iterator raises a
+            # BackoffError
+            if delay > 0:
+                # We have to wait before trying again
+                RealTimeLogger.get().error("Retry after {} seconds".format(
+                    delay))
+                time.sleep(delay)
+            try:
+                return original_function(*args, **kwargs)
+            except:
+                # Report the formatted underlying exception with traceback
+                RealTimeLogger.get().error("{} failed due to: {}".format(
+                    original_function.__name__,
+                    "".join(traceback.format_exception(*sys.exc_info()))))
+        
+        
+        # If we get here, the function we're calling never ran through before we
+        # ran out of backoff times. Give an error.
+        raise BackoffError("Ran out of retries calling {}".format(
+            original_function.__name__))
+    
+    return new_function
+            
+def split_ranges(size, part_size):
+    """
+    Split size bytes into (start, end) byte ranges of at most part_size bytes,
+    with exclusive ends.
+    
+    >>> split_ranges(10, 4)
+    [(0, 4), (4, 8), (8, 10)]
+    >>> split_ranges(0, 4)
+    []
+    
+    """
+    
+    return [(start, min(start + part_size, size)) for start in
+        xrange(0, size, part_size)]
+        
+def transfer_parts(description, function, ranges, threads):
+    """
+    Call function(part_number, start, end) for each of the given byte ranges,
+    on the given number of threads, and return the results in order. Part
+    numbers count from 0. Progress and throughput are logged under the given
+    description.
+    
+    The function should do its own retrying, so a failure costs one part
+    rather than the whole transfer. If any part fails for good, raises its
+    error.
+    
+    """
+    
+    total_bytes = sum(end - start for start, end in ranges)
+    start_time = time.time()
+    done_bytes = [0]
+    # How many tenths of the way have we reported?
+    reported = [0]
+    lock = threading.Lock()
+    
+    def do_part(args):
+        part_number, (start, end) = args
+        result = function(part_number, start, end)
+        with lock:
+            done_bytes[0] += end - start
+            tenths = done_bytes[0] * 10 // max(total_bytes, 1)
+            if tenths > reported[0]:
+                reported[0] = tenths
+                elapsed = max(time.time() - start_time, 1e-6)
+                RealTimeLogger.get().info("{}: {:.0f}% of {:.1f} MB "
+                    "({:.1f} MB/s)".format(description, done_bytes[0] * 100.0 /
+                    max(total_bytes, 1), total_bytes / 1e6, done_bytes[0] /
+                    1e6 / elapsed))
+        return result
+        
+    pool = multiprocessing.pool.ThreadPool(max(1, min(threads, len(ranges))))
+    try:
+        return pool.map(do_part, enumerate(ranges))
+    finally:
+        pool.terminate()
+        
+def part_checksum(digests):
+    """
+    Combine the binary MD5 digests of the parts of a file, in order, into the
+    checksum S3 gives a file uploaded in those parts: the MD5 hex digest of the
+    part digests run together, a dash, and the number of parts.
+    
+    >>> part_checksum([hashlib.md5("ab").digest(), hashlib.md5("c").digest()])
+    'd833159094d1d7ad96ffcc78414e3682-2'
+    
+    """
+    
+    return "{}-{}".format(hashlib.md5("".join(digests)).hexdigest(),
+        len(digests))
+
+def file_checksum(path, buffer_size=PIPE_BUFFER_SIZE, part_size=None):
+    """
+    Return the MD5 hex digest of the given file, reading it a block at a time.
+    
+    If part_size is given and the file is bigger than that, return the
+    part_checksum of its parts of that size instead, which a store that
+    uploads in parts can work out from the parts as they go up.
+    
+    """
+    
+    size = os.path.getsize(path)
+    if part_size is None or size <= part_size:
+        checksum = hashlib.md5()
+        with open(path, "rb") as handle:
+            for block in iter(lambda: handle.read(buffer_size), ""):
+                checksum.update(block)
+        return checksum.hexdigest()
+        
+    digests = []
+    with open(path, "rb") as handle:
+        for start, end in split_ranges(size, part_size):
+            checksum = hashlib.md5()
+            remaining = end - start
+            while remaining > 0:
+                block = handle.read(min(buffer_size, remaining))
+                if block == "":
+                    break
+                checksum.update(block)
+                remaining -= len(block)
+            digests.append(checksum.digest())
+    return part_checksum(digests)
+
+def transfer_files(description, function, pairs, threads, local_path,
+    retries):
+    """
+    Call function(source, destination) for each of the given (source,
+    destination) pairs, on the given number of threads, retrying each pair up
+    to the given number of times. Yields the pairs in the order given, each as
+    soon as it and all the ones before it are done. The local_path function
+    picks the local file out of a pair, so the aggregate throughput can be
+    logged under the given description when everything is done.
+    
+    At most twice as many pairs as threads are started ahead of the one the
+    caller is waiting for, so a slow consumer doesn't fill the disk with files
+    it hasn't got to yet.
+    
+    """
+    
+    if retries > 0:
+        function = backoff(function, retries=retries)
+    
+    start_time = time.time()
+    total_bytes = [0]
+    lock = threading.Lock()
+    
+    def do_pair(pair):
+        function(*pair)
+        size = os.path.getsize(local_path(pair))
+        with lock:
+            total_bytes[0] += size
+        return pair
+    
+    pairs = list(pairs)
+    threads = max(1, min(threads, len(pairs)))
+    pool = multiprocessing.pool.ThreadPool(threads)
+    try:
+        pending = collections.deque()
+        for pair in pairs:
+            if len(pending) >= 2 * threads:
+                yield pending.popleft().get()
+            pending.append(pool.apply_async(do_pair, (pair,)))
+        while pending:
+            yield pending.popleft().get()
+    finally:
+        pool.terminate()
+        
+    elapsed = max(time.time() - start_time, 1e-6)
+    RealTimeLogger.get().info("{}: {} files, {:.1f} MB in {:.1f} seconds "
+        "({:.1f} MB/s)".format(description, len(pairs), total_bytes[0] / 1e6,
+        elapsed, total_bytes[0] / 1e6 / elapsed))
+
+class AzureIOStore(IOStore):
+    """
+    A class that lets you get input from and send output to Azure Storage.
+    
+    """
+    
+    # Every request is retried on its own already
+    file_retries = 0
+    
+    def __init__(self, account_name, container_name, name_prefix="",
+        block_size=4 * 1024 * 1024, threads=8, list_cache_ttl=30):
+        """
+        Make a new AzureIOStore that reads from and writes to the given
+        container in the given account, adding the given prefix to keys. All
+        paths will be interpreted as keys or key prefixes. Blobs are
+        transferred in blocks of block_size bytes (at most 4 MB), threads at a
+        time, and each block is retried on its own. Listing pages are reused
+        for list_cache_ttl seconds.
+        
+        If the name prefix does not end with a trailing slash, and is not empty,
+        one will be added automatically.
+        
+        Account keys are retrieved from the AZURE_ACCOUNT_KEY environment
+        variable or from the ~/.toilAzureCredentials file, as in Toil itself.
+        
+        """
+        
+        # Make sure azure libraries actually loaded
+        assert(have_azure)
+        
+        self.account_name = account_name
+        self.container_name = container_name
+        self.name_prefix = name_prefix
+        self.block_size = block_size
+        self.threads = threads
+        self.list_cache_ttl = list_cache_ttl
+        
+        if self.name_prefix != "" and not self.name_prefix.endswith("/"):
+            # Make sure it has the trailing slash required.
+            self.name_prefix += "/"
+        
+        # Sneak into Toil and use the same keys it uses
+        self.account_key = toil.jobStores.azureJobStore._fetchAzureAccountKey(
+            self.account_name)
+            
+        # This will hold out Azure blob store connection
+        self.connection = None
+        
+        # This maps from list_blobs arguments to (time fetched, result page)
+        self.list_cache = {}
+        
+    def __getstate__(self):
+        """
+        Return the state to use for pickling. We don't want to try and pickle
+        an open Azure connection.
+        """
+     
+        return (self.account_name, self.account_key, self.container_name, 
+            self.name_prefix, self.block_size, self.threads,
+            self.list_cache_ttl, self.skip_unchanged)
+        
+    def __setstate__(self, state):
+        """
+        Set up after unpickling.
+        """
+        
+        self.account_name = state[0]
+        self.account_key = state[1]
+        self.container_name = state[2]
+        self.name_prefix = state[3]
+        self.block_size = state[4]
+        self.threads = state[5]
+        self.list_cache_ttl = state[6]
+        self.skip_unchanged = state[7]
+        
+        self.connection = None
+        self.list_cache = {}
+        
+    def __connect(self):
+        """
+        Make sure we have an Azure connection, and set one up if we don't.
+        """
+        
+        if self.connection is None:
+            self.connection = self.__new_connection()
+            
+    def __new_connection(self):
         """
-        Make a new FileIOStore that just treats everything as local paths,
-        relative to the given prefix.
-        
+        Make a new Azure connection, for this thread to use.
         """
         
-        self.path_prefix = path_prefix
+        RealTimeLogger.get().debug("Connecting to account {}, using "
+            "container {} and prefix {}".format(self.account_name,
+            self.container_name, self.name_prefix))
+    
+        # Connect to the blob service where we keep everything
+        return BlobService(account_name=self.account_name,
+            account_key=self.account_key)
+            
+    def __thread_connection(self, connections):
+        """
+        Get a connection from the given threading.local, made for this thread.
+        Transfer threads each need their own connection.
+        """
         
+        if not hasattr(connections, "connection"):
+            connections.connection = self.__new_connection()
+        return connections.connection
+            
     def read_input_file(self, input_path, local_path):
         """
-        Get input from the filesystem.
+        Get input from Azure. Big blobs are downloaded in ranges, several at
+        once.
         """
         
-        RealTimeLogger.get().debug("Loading {} from FileIOStore in {} to {}".format(
-            input_path, self.path_prefix, local_path))
+        self.__connect()
         
-        if os.path.exists(local_path):
-            # Try deleting the existing item if it already exists
-            try:
-                os.unlink(local_path)
-            except:
-                # Don't fail here, fail complaining about the assertion, which
-                # will be more informative.
-                pass
+        
+        RealTimeLogger.get().debug("Loading {} from AzureIOStore".format(
+            input_path))
+            
+        blob_name = self.name_prefix + input_path
+        
+        @backoff
+        def get_size():
+            properties = self.connection.get_blob_properties(
+                self.container_name, blob_name)
+            return int(properties["content-length"])
+        size = get_size()
+        
+        if os.path.lexists(local_path):
+            # Don't write through any symlink that is there
+            os.unlink(local_path)
+            
+        if size <= self.block_size:
+            # Download the blob. This is known to be synchronous, although it
+            # can call a callback during the process.
+            backoff(self.connection.get_blob_to_path)(self.container_name,
+                blob_name, local_path)
+            return
+            
+        # Make the file full size, so each range can be written in place
+        with open(local_path, "wb") as local_file:
+            local_file.truncate(size)
+            
+        connections = threading.local()
+            
+        @backoff
+        def download_range(part_number, start, end):
+            data = self.__thread_connection(connections).get_blob(
+                self.container_name, blob_name,
+                x_ms_range="bytes={}-{}".format(start, end - 1))
+            if len(data) != end - start:
+                raise RuntimeError("Got {} bytes instead of {} for range {} "
+                    "of {}".format(len(data), end - start, part_number,
+                    blob_name))
+            with open(local_path, "r+b") as local_file:
+                local_file.seek(start)
+                local_file.write(data)
                 
-        # Make sure the path is clear for the symlink.
-        assert(not os.path.exists(local_path))
+        transfer_parts("Download of {}".format(blob_name), download_range,
+            split_ranges(size, self.block_size), self.threads)
+            
+    def __list_page(self, prefix, delimiter, marker):
+        """
+        Get one page of list_blobs results for the given prefix, delimiter and
+        marker. Pages are remembered for list_cache_ttl seconds, so repeated
+        listings of the same fake directory don't go back to Azure.
         
-        # Where is the file actually?
-        real_path = os.path.abspath(os.path.join(self.path_prefix, input_path))
+        """
         
-        if not os.path.exists(real_path):
-            RealTimeLogger.get().error(
-                "Can't find {} from FileIOStore in {}!".format(input_path,
-                self.path_prefix))
-            raise RuntimeError("File {} missing!".format(real_path))
+        key = (prefix, delimiter, marker)
+        now = time.time()
         
-        # Make a symlink to grab things
-        os.symlink(real_path, local_path)
-            
-        # Look at the file stats
-        file_stats = os.stat(real_path)
+        if key in self.list_cache:
+            fetched, result = self.list_cache[key]
+            if now - fetched < self.list_cache_ttl:
+                return result
         
-        if (file_stats.st_uid == os.getuid() and 
-            file_stats.st_mode & stat.S_IWUSR):
-            # We own this file and can write to it. We don't want the user
-            # script messing it up through the symlink.
+        result = backoff(self.connection.list_blobs)(self.container_name,
+            prefix=prefix, delimiter=delimiter, marker=marker)
+            
+        # Drop expired pages so the cache doesn't grow forever
+        for old_key in [k for k, (fetched, _) in self.list_cache.iteritems()
+            if now - fetched >= self.list_cache_ttl]:
+            del self.list_cache[old_key]
+            
+        self.list_cache[key] = (now, result)
+        return result
             
-            try:
-                # Clear the user write bit, so the user can't accidentally
-                # clobber the file in the actual store through the symlink.
-                os.chmod(real_path, file_stats.st_mode ^ stat.S_IWUSR)
-            except OSError:
-                # If something goes wrong here (like us not having permission to
-                # change permissions), ignore it.
-                pass
-        
     def list_input_directory(self, input_path, recursive=False,
         with_times=False):
         """
-        Loop over directories on the filesystem.
+        Loop over fake /-delimited directories on Azure. The prefix may or may
+        not not have a trailing slash; if not, one will be added automatically.
+        
+        Returns the names of files and fake directories in the given input fake
+        directory, non-recursively.
+        
+        If with_times is specified, will yield (name, time) pairs including
+        modification times as datetime objects. Times on directories are None.
+        
         """
         
-        RealTimeLogger.get().info("Enumerating {} from "
-            "FileIOStore in {}".format(input_path, self.path_prefix))
+        self.__connect()
         
-        if not os.path.exists(os.path.join(self.path_prefix, input_path)):
-            # Nothing to list over
-            return
+        RealTimeLogger.get().info("Enumerating {} from AzureIOStore".format(
+            input_path))
+        
+        # Work out what the directory name to list is
+        fake_directory = self.name_prefix + input_path
+        
+        if fake_directory != "" and not fake_directory.endswith("/"):
+            # We have a nonempty prefix, and we need to end it with a slash
+            fake_directory += "/"
             
-        if not os.path.isdir(os.path.join(self.path_prefix, input_path)):
-            # Can't list a file, only a directory.
-            return
+        # Let the server find the subdirectories, unless we want everything.
+        # Azure sends them back in the result's prefixes, not with the blobs.
+        delimiter = None if recursive else "/"
         
-        for item in os.listdir(os.path.join(self.path_prefix, input_path)):
-            if(recursive and os.path.isdir(os.path.join(self.path_prefix,
-                input_path, item))):
-                # We're recursing and this is a directory.
-                # Recurse on this.
-                for subitem in self.list_input_directory(
-                    os.path.join(input_path, item), recursive):
-                    
-                    # Make relative paths include this directory name and yield
-                    # them
-                    name_to_yield = os.path.join(item, subitem)
-                    
-                    if with_times:
-                        # What is the mtime in seconds since epoch?
-                        mtime_epoch_seconds = os.path.getmtime(os.path.join(
-                            input_path, item, subitem))
-                        # Convert it to datetime
-                        mtime_datetime = datetime.datetime.utcfromtimestamp(
-                            mtime_epoch_seconds).replace(
-                            tzinfo=dateutil.tz.tzutc())
-                            
-                        yield name_to_yield, mtime_datetime
-                    else:
-                        yield name_to_yield
-            else:
-                # This isn't a directory or we aren't being recursive
-                # Just report this individual item.
+        # This will hold the marker that we need to send back to get the next
+        # page, if there is one. See <http://stackoverflow.com/a/24303682>
+        marker = None
+        
+        while True:
+        
+            result = self.__list_page(fake_directory or None, delimiter,
+                marker)
+                
+            RealTimeLogger.get().debug("Found {} files and {} directories"
+                .format(len(result.blobs), len(result.prefixes)))
+                
+            for prefix in result.prefixes:
+                # Drop the common prefix and the trailing slash
+                subdirectory = prefix.name[len(fake_directory):].rstrip("/")
                 
                 if with_times:
-                    # What is the mtime in seconds since epoch?
-                    mtime_epoch_seconds = os.path.getmtime(os.path.join(
-                        input_path, item))
-                    # Convert it to datetime
-                    mtime_datetime = datetime.datetime.utcfromtimestamp(
-                        mtime_epoch_seconds).replace(
+                    yield subdirectory, None
+                else:
+                    yield subdirectory
+                
+            for blob in result.blobs:
+                # Drop the common prefix
+                relative_path = blob.name[len(fake_directory):]
+                
+                if with_times:
+                    mtime = dateutil.parser.parse(
+                        blob.properties.last_modified).replace(
                         tzinfo=dateutil.tz.tzutc())
+                    yield relative_path, mtime
                         
-                    yield item, mtime_datetime
                 else:
-                    yield item
-    
+                    yield relative_path
+                
+            # Save the marker
+            marker = result.next_marker
+                
+            if not marker:
+                break
+                
     def write_output_file(self, local_path, output_path):
         """
-        Write output to the filesystem
+        Write output to Azure. Will create the container if necessary. Big
+        files are uploaded in blocks, several at once.
         """
-
-        RealTimeLogger.get().debug("Saving {} to FileIOStore in {}".format(
-            output_path, self.path_prefix))
-
-        # What's the real output path to write to?
-        real_output_path = os.path.join(self.path_prefix, output_path)
-
-        # What directory should this go in?
-        parent_dir = os.path.split(real_output_path)[0]
-            
-        if parent_dir != "":
-            # Make sure the directory it goes in exists.
-            robust_makedirs(parent_dir)
         
-        # Make a temporary file
-        temp_handle, temp_path = tempfile.mkstemp(dir=self.path_prefix)
-        os.close(temp_handle)
-        
-        # Copy to the temp file
-        shutil.copy2(local_path, temp_path)
+        self.__connect()
         
-        if os.path.exists(real_output_path):
-            # At least try to get existing files out of the way first.
-            os.unlink(real_output_path)
+        RealTimeLogger.get().debug("Saving {} to AzureIOStore".format(
+            output_path))
             
-        # Rename the temp file to the right place, atomically
-        os.rename(temp_path, real_output_path)
+        unchanged, checksum = self.check_unchanged(local_path, output_path)
+        if unchanged:
+            return
+            
+        blob_name = self.name_prefix + output_path
         
-    def exists(self, path):
-        """
-        Returns true if the given input or output file exists in the file system
-        already.
+        # Listings we remember may not have this blob in them
+        self.list_cache.clear()
         
+        @backoff
+        def make_container():
+            try:
+                # Make the container
+                self.connection.create_container(self.container_name)
+            except azure.WindowsAzureConflictError:
+                # The container probably already exists
+                pass
+        make_container()
+        
+        size = os.path.getsize(local_path)
+        if size <= self.block_size:
+            # Upload the blob (synchronously). Azure works out the MD5 of a
+            # blob put in one piece itself, so we only record one we have.
+            backoff(self.connection.put_block_blob_from_path)(
+                self.container_name, blob_name, local_path,
+                x_ms_meta_name_values={"md5": checksum} if checksum is not None
+                else None)
+            return
+            
+        connections = threading.local()
+        
+        @backoff
+        def upload_block(part_number, start, end):
+            with open(local_path, "rb") as local_file:
+                local_file.seek(start)
+                data = local_file.read(end - start)
+            # Block IDs all have to be the same length
+            block_id = "{0:08d}".format(part_number)
+            self.__thread_connection(connections).put_block(
+                self.container_name, blob_name, data, block_id)
+            return block_id, hashlib.md5(data).digest()
+            
+        blocks = transfer_parts("Upload of {}".format(blob_name),
+            upload_block, split_ranges(size, self.block_size), self.threads)
+            
+        # Now commit the blocks, in order, as the blob. Remember the checksum
+        # of the blocks with it, so we can skip it next time without reading
+        # the file again now.
+        backoff(self.connection.put_block_list)(self.container_name,
+            blob_name, [block_id for block_id, _ in blocks],
+            x_ms_meta_name_values={"md5": part_checksum(
+            [digest for _, digest in blocks])})
+            
+    @contextmanager
+    def write_output_stream(self, output_path, temp_dir=None):
         """
+        Write output to Azure from a stream, uploading blocks as the data comes
+        in. Will create the container if necessary. Nothing is saved locally,
+        so temp_dir isn't used.
         
-        return os.path.exists(os.path.join(self.path_prefix, path))
+        A stream can't be replayed, so unlike write_output_file this doesn't
+        retry.
         
-    def get_mtime(self, path):
         """
-        Returns the modification time of the given file if it exists, or None
-        otherwise.
         
-        """
+        self.__connect()
         
-        if not self.exists(path):
-            return None
+        RealTimeLogger.get().debug("Streaming {} to AzureIOStore".format(
+            output_path))
             
-        # What is the mtime in seconds since epoch?
-        mtime_epoch_seconds = os.path.getmtime(os.path.join(self.path_prefix,
-            path))
-        # Convert it to datetime
-        mtime_datetime = datetime.datetime.utcfromtimestamp(
-            mtime_epoch_seconds).replace(tzinfo=dateutil.tz.tzutc())
+        # Listings we remember may not have this blob in them
+        self.list_cache.clear()
+        
+        try:
+            # Make the container
+            self.connection.create_container(self.container_name)
+        except azure.WindowsAzureConflictError:
+            # The container probably already exists
+            pass
             
-        # Return the modification time, timezoned, in UTC
-        return mtime_datetime
-
-class BackoffError(RuntimeError):
-    """
-    Represents an error from running out of retries during exponential back-off.
-    """
-
-def backoff_times(retries, base_delay):
-    """
-    A generator that yields times for random exponential back-off. You have to
-    do the exception handling and sleeping yourself. Stops when the retries run
-    out.
-    
-    """
-    
-    # Don't wait at all before the first try
-    yield 0
-    
-    # What retry are we on?
-    try_number = 1
-    
-    # Make a delay that increases
-    delay = float(base_delay) * 2
+        # The upload reads from a pipe that we fill from the with block.
+        read_fd, write_fd = os.pipe()
+        errors = []
+        
+        def upload():
+            try:
+                with os.fdopen(read_fd, "r") as read_handle:
+                    self.connection.put_block_blob_from_file(
+                        self.container_name, self.name_prefix + output_path,
+                        read_handle)
+            except:
+                errors.append(sys.exc_info())
+                
+        uploader = threading.Thread(target=upload)
+        uploader.daemon = True
+        uploader.start()
+        
+        write_handle = os.fdopen(write_fd, "w")
+        try:
+            yield write_handle
+        except:
+            # Don't leave a truncated blob behind
+            write_handle.close()
+            uploader.join()
+            try:
+                self.connection.delete_blob(self.container_name,
+                    self.name_prefix + output_path)
+            except azure.WindowsAzureMissingResourceError:
+                pass
+            raise
+            
+        try:
+            write_handle.close()
+        except IOError:
+            # The upload must have died; we'll report why
+            pass
+        uploader.join()
+            
+        if errors:
+            raise errors[0][0], errors[0][1], errors[0][2]
     
-    while try_number <= retries:
-        # Wait a random amount between 0 and 2^try_number * base_delay
-        yield random.uniform(base_delay, delay)
-        delay *= 2
-        try_number += 1
+    @backoff
+    def __properties(self, path):
+        """
+        Get the properties of the given blob with a single HEAD request, or
+        None if it doesn't exist.
+        
+        """
         
-    # If we get here, we're stopping iteration without succeeding. The caller
-    # will probably raise an error.
+        self.__connect()
         
-def backoff(original_function, retries=6, base_delay=10):
-    """
-    We define a decorator that does randomized exponential back-off up to a
-    certain number of retries. Raises BackoffError if the operation doesn't
-    succeed after backing off for the specified number of retries (which may be
-    float("inf")).
-    
-    Unfortunately doesn't really work on generators.
-    """
+        try:
+            return self.connection.get_blob_properties(self.container_name,
+                self.name_prefix + path)
+        except azure.WindowsAzureError as e:
+            if (isinstance(e, azure.WindowsAzureMissingResourceError) or
+                getattr(e, "status_code", None) == 404):
+                # The blob (or the whole container) isn't there
+                return None
+            raise
     
-    # Make a new version of the function
-    @functools.wraps(original_function)
-    def new_function(*args, **kwargs):
-        # Call backoff times, overriding parameters with stuff from kwargs        
-        for delay in backoff_times(retries=kwargs.get("retries", retries),
-            base_delay=kwargs.get("base_delay", base_delay)):
-            # Keep looping until it works or our iterator raises a
-            # BackoffError
-            if delay > 0:
-                # We have to wait before trying again
-                RealTimeLogger.get().error("Retry after {} seconds".format(
-                    delay))
-                time.sleep(delay)
-            try:
-                return original_function(*args, **kwargs)
-            except:
-                # Report the formatted underlying exception with traceback
-                RealTimeLogger.get().error("{} failed due to: {}".format(
-                    original_function.__name__,
-                    "".join(traceback.format_exception(*sys.exc_info()))))
+    def get_checksum(self, path):
+        """
+        Returns the checksum recorded for the given blob, or None if it doesn't
+        exist or has no checksum. Blobs uploaded in blocks have the
+        part_checksum of their blocks.
         
+        """
         
-        # If we get here, the function we're calling never ran through before we
-        # ran out of backoff times. Give an error.
-        raise BackoffError("Ran out of retries calling {}".format(
-            original_function.__name__))
+        properties = self.__properties(path)
+        
+        if properties is None:
+            return None
+            
+        if "x-ms-meta-md5" in properties:
+            # We saved it ourselves
+            return properties["x-ms-meta-md5"]
+        if properties.get("content-md5"):
+            # Azure computed it when the blob went up in one piece
+            return base64.b64decode(properties["content-md5"]).encode("hex")
+        return None
     
-    return new_function
+    def get_size(self, path):
+        """
+        Returns the size in bytes of the given blob, or None if it doesn't
+        exist.
+        
+        """
+        
+        properties = self.__properties(path)
+        
+        if properties is None:
+            return None
+        return int(properties["content-length"])
+        
+    def local_checksum(self, local_path):
+        """
+        Returns the checksum a blob uploaded from the given local file would
+        have, block by block if it is bigger than a block.
+        
+        """
+        
+        return file_checksum(local_path, part_size=self.block_size)
+        
+    def exists(self, path):
+        """
+        Returns true if the given input or output file exists in Azure already.
+        
+        """
+        
+        return self.__properties(path) is not None
+        
+    def get_mtime(self, path):
+        """
+        Returns the modification time of the given blob if it exists, or None
+        otherwise.
+        
+        """
+        
+        properties = self.__properties(path)
+        
+        if properties is None:
+            return None
             
-class AzureIOStore(IOStore):
+        return dateutil.parser.parse(properties["last-modified"]).replace(
+            tzinfo=dateutil.tz.tzutc())
+        
+class S3IOStore(IOStore):
     """
-    A class that lets you get input from and send output to Azure Storage.
+    A class that lets you get input from and send output to Amazon S3, or
+    anything that speaks the S3 protocol.
+    
+    Big files are moved in parts, several at once, with each part retried on
+    its own.
     
     """
     
-    def __init__(self, account_name, container_name, name_prefix=""):
+    # Every request is retried on its own already
+    file_retries = 0
+    
+    # Each thread in a process keeps one connection per endpoint and region,
+    # since boto connections can't be shared between threads.
+    connections = threading.local()
+    
+    def __init__(self, region, bucket_name, name_prefix="",
+        part_size=64 * 1024 * 1024, threads=8):
         """
-        Make a new AzureIOStore that reads from and writes to the given
-        container in the given account, adding the given prefix to keys. All
-        paths will be interpreted as keys or key prefixes.
+        Make a new S3IOStore that reads from and writes to the given bucket in
+        the given region, adding the given prefix to keys. All paths will be
+        interpreted as keys or key prefixes. Files are transferred in parts of
+        part_size bytes, threads at a time.
         
         If the name prefix does not end with a trailing slash, and is not empty,
         one will be added automatically.
         
-        Account keys are retrieved from the AZURE_ACCOUNT_KEY environment
-        variable or from the ~/.toilAzureCredentials file, as in Toil itself.
+        Credentials come from the environment or the boto config file, as in
+        boto itself. To use an S3-compatible server instead of Amazon, such as
+        a local stand-in for testing, set TOIL_SCRIPTS_S3_ENDPOINT to its URL,
+        like http://localhost:9000.
         
         """
         
-        # Make sure azure libraries actually loaded
-        assert(have_azure)
+        # Make sure boto actually loaded
+        assert(have_s3)
         
-        self.account_name = account_name
-        self.container_name = container_name
+        self.region = region
+        self.bucket_name = bucket_name
         self.name_prefix = name_prefix
+        self.part_size = part_size
+        self.threads = threads
         
         if self.name_prefix != "" and not self.name_prefix.endswith("/"):
             # Make sure it has the trailing slash required.
             self.name_prefix += "/"
-        
-        # Sneak into Toil and use the same keys it uses
-        self.account_key = toil.jobStores.azureJobStore._fetchAzureAccountKey(
-            self.account_name)
             
-        # This will hold out Azure blob store connection
-        self.connection = None
-        
+        # Where is the server? None means real S3.
+        self.endpoint = os.environ.get("TOIL_SCRIPTS_S3_ENDPOINT")
+            
     def __getstate__(self):
         """
         Return the state to use for pickling. We don't want to try and pickle
-        an open Azure connection.
+        an open S3 connection.
         """
-     
-        return (self.account_name, self.account_key, self.container_name, 
-            self.name_prefix)
         
+        return (self.region, self.bucket_name, self.name_prefix,
+            self.part_size, self.threads, self.endpoint, self.skip_unchanged)
+            
     def __setstate__(self, state):
         """
         Set up after unpickling.
         """
         
-        self.account_name = state[0]
-        self.account_key = state[1]
-        self.container_name = state[2]
-        self.name_prefix = state[3]
+        (self.region, self.bucket_name, self.name_prefix, self.part_size,
+            self.threads, self.endpoint, self.skip_unchanged) = state
+            
+    def __bucket(self):
+        """
+        Get the bucket, through this thread's connection, making the connection
+        if needed.
+        """
         
-        self.connection = None
+        cache_key = (self.endpoint, self.region)
+        if not hasattr(self.connections, "by_key"):
+            self.connections.by_key = {}
+        connection = self.connections.by_key.get(cache_key)
+        
+        if connection is None:
+            RealTimeLogger.get().debug("Connecting to S3 in {}{}".format(
+                self.region, "" if self.endpoint is None else
+                " at " + self.endpoint))
+            if self.endpoint is None:
+                connection = boto.s3.connect_to_region(self.region)
+            else:
+                endpoint = urlparse.urlparse(self.endpoint)
+                connection = boto.s3.connection.S3Connection(
+                    host=endpoint.hostname, port=endpoint.port,
+                    is_secure=(endpoint.scheme == "https"),
+                    calling_format=boto.s3.connection.OrdinaryCallingFormat())
+            self.connections.by_key[cache_key] = connection
+            
+        # Don't send a request to check the bucket; the operations will fail
+        # anyway if it isn't there.
+        return connection.get_bucket(self.bucket_name, validate=False)
         
-    def __connect(self):
+    def __get_key(self, key_name):
         """
-        Make sure we have an Azure connection, and set one up if we don't.
+        Get the given key, or None if it doesn't exist, retrying on errors.
         """
         
-        if self.connection is None:
-            RealTimeLogger.get().debug("Connecting to account {}, using "
-                "container {} and prefix {}".format(self.account_name,
-                self.container_name, self.name_prefix))
+        return backoff(lambda: self.__bucket().get_key(key_name))()
         
-            # Connect to the blob service where we keep everything
-            self.connection = BlobService(
-                account_name=self.account_name, account_key=self.account_key)
-            
-    @backoff        
     def read_input_file(self, input_path, local_path):
         """
-        Get input from Azure.
+        Get input from S3. Each request is retried on its own, and a missing
+        key fails right away.
         """
         
-        self.__connect()
-        
-        
-        RealTimeLogger.get().debug("Loading {} from AzureIOStore".format(
+        RealTimeLogger.get().debug("Loading {} from S3IOStore".format(
             input_path))
-        
-        # Download the blob. This is known to be synchronous, although it can
-        # call a callback during the process.
-        self.connection.get_blob_to_path(self.container_name,
-            self.name_prefix + input_path, local_path)
+            
+        key_name = self.name_prefix + input_path
+        key = self.__get_key(key_name)
+        if key is None:
+            raise RuntimeError("File {} missing from bucket {}!".format(
+                key_name, self.bucket_name))
+                
+        if os.path.lexists(local_path):
+            # Don't write through any symlink that is there
+            os.unlink(local_path)
+            
+        if key.size <= self.part_size:
+            backoff(key.get_contents_to_filename)(local_path)
+            return
+            
+        # Make the file full size, so each part can be written in place
+        with open(local_path, "wb") as local_file:
+            local_file.truncate(key.size)
+            
+        @backoff
+        def download_part(part_number, start, end):
+            part_key = self.__bucket().get_key(key_name)
+            with open(local_path, "r+b") as local_file:
+                local_file.seek(start)
+                part_key.get_file(local_file, headers={
+                    "Range": "bytes={}-{}".format(start, end - 1)})
+                if local_file.tell() != end:
+                    raise RuntimeError("Got {} bytes instead of {} for part {} "
+                        "of {}".format(local_file.tell() - start, end - start,
+                        part_number, key_name))
+                    
+        transfer_parts("Download of {}".format(key_name), download_part,
+            split_ranges(key.size, self.part_size), self.threads)
             
     def list_input_directory(self, input_path, recursive=False,
         with_times=False):
         """
-        Loop over fake /-delimited directories on Azure. The prefix may or may
-        not not have a trailing slash; if not, one will be added automatically.
-        
-        Returns the names of files and fake directories in the given input fake
-        directory, non-recursively.
+        Loop over fake /-delimited directories on S3. The prefix may or may not
+        have a trailing slash; if not, one will be added automatically.
         
         If with_times is specified, will yield (name, time) pairs including
         modification times as datetime objects. Times on directories are None.
         
         """
         
-        self.__connect()
-        
-        RealTimeLogger.get().info("Enumerating {} from AzureIOStore".format(
+        RealTimeLogger.get().info("Enumerating {} from S3IOStore".format(
             input_path))
-        
+            
         # Work out what the directory name to list is
         fake_directory = self.name_prefix + input_path
         
         if fake_directory != "" and not fake_directory.endswith("/"):
             # We have a nonempty prefix, and we need to end it with a slash
             fake_directory += "/"
+            
+        # Let the server find the subdirectories, unless we want everything
+        delimiter = "" if recursive else "/"
         
-        # This will hold the marker that we need to send back to get the next
-        # page, if there is one. See <http://stackoverflow.com/a/24303682>
-        marker = None
-        
-        # This holds the subdirectories we found; we yield each exactly once if
-        # we aren't recursing.
-        subdirectories = set()
-        
-        while True:
-        
-            # Get the results from Azure. We don't use delimiter since Azure
-            # doesn't seem to provide the placeholder entries it's supposed to.
+        for item in self.__bucket().list(prefix=fake_directory,
+            delimiter=delimiter):
             
-            result = self.connection.list_blobs(self.container_name, 
-                marker=marker)
-                
-            RealTimeLogger.get().info("Found {} files".format(len(result)))
-                
-            for blob in result:
-                # Yield each result's blob name, but directory names only once
-                
-                # Drop the common prefix
-                relative_path = blob.name
-                
-                if (not recursive) and "/" in relative_path:
-                    # We found a file in a subdirectory, and we aren't supposed
-                    # to be recursing.
-                    subdirectory, _ = relative_path.split("/", 1)
-                    
-                    if subdirectory not in subdirectories:
-                        # It's a new subdirectory. Yield and remember it
-                        subdirectories.add(subdirectory)
-                        
-                        if with_times:
-                            yield subdirectory, None
-                        else:
-                            yield subdirectory
+            # Drop the common prefix, and any trailing slash on directories
+            relative_path = item.name[len(fake_directory):].rstrip("/")
+            
+            if with_times:
+                if isinstance(item, boto.s3.key.Key):
+                    yield relative_path, dateutil.parser.parse(
+                        item.last_modified).replace(
+                        tzinfo=dateutil.tz.tzutc())
                 else:
-                    # We found an actual file 
-                    if with_times:
-                        mtime = dateutil.parser.parse(
-                            blob.properties.last_modified).replace(
-                            tzinfo=dateutil.tz.tzutc())
-                        yield relative_path, mtime
-                            
-                    else:
-                        yield relative_path
-                
-            # Save the marker
-            marker = result.next_marker
-                
-            if not marker:
-                break
+                    yield relative_path, None
+            else:
+                yield relative_path
                 
-    @backoff
     def write_output_file(self, local_path, output_path):
         """
-        Write output to Azure. Will create the container if necessary.
+        Write output to S3. Each request is retried on its own.
         """
         
-        self.__connect()
-        
-        RealTimeLogger.get().debug("Saving {} to AzureIOStore".format(
+        RealTimeLogger.get().debug("Saving {} to S3IOStore".format(
             output_path))
+            
+        if self.check_unchanged(local_path, output_path)[0]:
+            return
+            
+        key_name = self.name_prefix + output_path
+        size = os.path.getsize(local_path)
         
+        # S3 gives every key a checksum, in its ETag, so we don't record one
+        if size <= self.part_size:
+            key = self.__bucket().new_key(key_name)
+            backoff(key.set_contents_from_filename)(local_path)
+            return
+            
+        upload = backoff(lambda: self.__bucket().initiate_multipart_upload(
+            key_name))()
+        
+        @backoff
+        def upload_part(part_number, start, end):
+            # Each thread needs the upload on its own connection
+            part_upload = boto.s3.multipart.MultiPartUpload(self.__bucket())
+            part_upload.key_name = key_name
+            part_upload.id = upload.id
+            with open(local_path, "rb") as local_file:
+                local_file.seek(start)
+                # S3 numbers parts from 1
+                part_upload.upload_part_from_file(local_file, part_number + 1,
+                    size=end - start)
+                    
         try:
-            # Make the container
-            self.connection.create_container(self.container_name)
-        except azure.WindowsAzureConflictError:
-            # The container probably already exists
-            pass
+            transfer_parts("Upload of {}".format(key_name), upload_part,
+                split_ranges(size, self.part_size), self.threads)
+            backoff(upload.complete_upload)()
+        except:
+            upload.cancel_upload()
+            raise
+            
+    @contextmanager
+    def write_output_stream(self, output_path, temp_dir=None):
+        """
+        Write output to S3 from a stream, uploading parts as the data comes in,
+        several at once. Each part is held in memory until it is uploaded, so
+        it can be retried on its own, and at most threads parts are waiting at
+        a time. Nothing is saved locally, so temp_dir isn't used.
         
-        # Upload the blob (synchronously)
-        # TODO: catch no container error here, make the container, and retry
-        self.connection.put_block_blob_from_path(self.container_name,
-            self.name_prefix + output_path, local_path)
-    
-    @backoff        
-    def exists(self, path):
         """
-        Returns true if the given input or output file exists in Azure already.
         
+        RealTimeLogger.get().debug("Streaming {} to S3IOStore".format(
+            output_path))
+            
+        key_name = self.name_prefix + output_path
+        # The multipart upload is only started once there is more than a part
+        upload = []
+        pool = multiprocessing.pool.ThreadPool(self.threads)
+        pending = []
+        part_numbers = itertools.count()
+        
+        @backoff
+        def upload_part(part_number, data):
+            # Each thread needs the upload on its own connection
+            part_upload = boto.s3.multipart.MultiPartUpload(self.__bucket())
+            part_upload.key_name = key_name
+            part_upload.id = upload[0].id
+            part_upload.upload_part_from_file(StringIO.StringIO(data),
+                part_number + 1, size=len(data))
+                
+        def send_part(data):
+            if not upload:
+                upload.append(backoff(lambda: self.__bucket(
+                    ).initiate_multipart_upload(key_name))())
+            if len(pending) >= self.threads:
+                # Wait for the oldest part, raising its error if it failed
+                pending.pop(0).get()
+            pending.append(pool.apply_async(upload_part, (next(part_numbers),
+                data)))
+        
+        stream = PartStream(self.part_size, send_part)
+        try:
+            yield stream
+            if not upload:
+                # It all fit in one part
+                key = self.__bucket().new_key(key_name)
+                backoff(key.set_contents_from_string)(stream.remainder())
+            else:
+                stream.flush_part()
+                for result in pending:
+                    result.get()
+                backoff(upload[0].complete_upload)()
+        except:
+            if upload:
+                upload[0].cancel_upload()
+            raise
+        finally:
+            pool.terminate()
+            
+    @backoff
+    def get_checksum(self, path):
         """
+        Returns the checksum S3 has for the given key, or None if it doesn't
+        exist. That is the key's ETag: the MD5 hex digest for keys not uploaded
+        in parts, and the part_checksum of the parts for the rest.
         
-        self.__connect()
+        """
         
-        marker = None
+        key = self.__bucket().get_key(self.name_prefix + path)
+        if key is None:
+            return None
+        return key.etag.strip('"')
         
-        while True:
+    @backoff
+    def get_size(self, path):
+        """
+        Returns the size in bytes of the given key, or None if it doesn't
+        exist.
         
-            try:
-                # Make the container
-                self.connection.create_container(self.container_name)
-            except azure.WindowsAzureConflictError:
-                # The container probably already exists
-                pass
-            
-            # Get the results from Azure.
-            result = self.connection.list_blobs(self.container_name, 
-                prefix=self.name_prefix + path, marker=marker)
-                
-            for blob in result:
-                # Look at each blob
-                
-                if blob.name == self.name_prefix + path:
-                    # Found it
-                    return True
-                
-            # Save the marker
-            marker = result.next_marker
-                
-            if not marker:
-                break 
+        """
         
-        return False
+        key = self.__bucket().get_key(self.name_prefix + path)
+        if key is None:
+            return None
+        return key.size
         
+    def local_checksum(self, local_path):
+        """
+        Returns the ETag a key uploaded from the given local file would have,
+        part by part if it is bigger than a part.
         
-    @backoff        
-    def get_mtime(self, path):
         """
-        Returns the modification time of the given blob if it exists, or None
-        otherwise.
         
+        return file_checksum(local_path, part_size=self.part_size)
+        
+    @backoff
+    def exists(self, path):
         """
+        Returns true if the given input or output file exists in S3 already.
         
-        self.__connect()
+        """
         
-        marker = None
+        return self.__bucket().get_key(self.name_prefix + path) is not None
         
-        while True:
+    @backoff
+    def get_mtime(self, path):
+        """
+        Returns the modification time of the given key if it exists, or None
+        otherwise.
         
-            # Get the results from Azure.
-            result = self.connection.list_blobs(self.container_name, 
-                prefix=self.name_prefix + path, marker=marker)
-                
-            for blob in result:
-                # Look at each blob
-                
-                if blob.name == self.name_prefix + path:
-                    # Found it
-                    return dateutil.parser.parse(
-                        blob.properties.last_modified).replace(
-                        tzinfo=dateutil.tz.tzutc())
-                
-            # Save the marker
-            marker = result.next_marker
-                
-            if not marker:
-                break 
+        """
         
-        return None
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
+        key = self.__bucket().get_key(self.name_prefix + path)
+        if key is None:
+            return None
+            
+        return dateutil.parser.parse(key.last_modified).replace(
+            tzinfo=dateutil.tz.tzutc())
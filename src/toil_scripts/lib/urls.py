@@ -1,34 +1,71 @@
+import ftplib
 import glob
+import httplib
+import json
+import multiprocessing.pool
 import os
 import shutil
 import subprocess
-from urlparse import urlparse
+import threading
+import time
+import urllib
+from collections import defaultdict
+from urlparse import urlparse, urljoin
 
 from toil_scripts.lib import require
 from toil_scripts.lib.programs import docker_call
+from toil_scripts.lib.toillib import RealTimeLogger, backoff_times, file_checksum, split_ranges
 
+# How many connections does one download use at once?
+DOWNLOAD_THREADS = 8
+# How many bytes does each ranged request get?
+SEGMENT_SIZE = 32 * 1024 * 1024
+# How many bytes are read from a connection at a time?
+READ_SIZE = 1024 * 1024
+# How many seconds can a connection stall before it is given up on?
+DOWNLOAD_TIMEOUT = 60
+# How many times is each part of a download retried?
+DOWNLOAD_RETRIES = 5
 
-def download_url(url, work_dir='.', name=None, s3_key_path=None, cghub_key_path=None):
+
+def download_url(url, work_dir='.', name=None, s3_key_path=None, cghub_key_path=None, md5=None,
+                 threads=DOWNLOAD_THREADS):
     """
     Downloads URL, can pass in file://, http://, s3://, or ftp://, gnos://cghub/analysisID, or gnos:///analysisID
 
+    HTTP and FTP downloads fetch byte ranges over several connections at once when the server supports it, and
+    resume from where an interrupted download stopped. Where the environment sets a proxy for the URL, they go
+    through curl instead, which knows how to use it.
+
     :param str url: URL to download from
     :param str work_dir: Directory to download file to
     :param str name: Name of output file, if None, basename of URL is used
     :param str s3_key_path: Path to 32-byte encryption key if url points to S3 file that uses SSE-C
     :param str cghub_key_path: Path to cghub key used to download from CGHub.
+    :param str md5: Expected MD5 hex digest of an HTTP or FTP download, to check it against
+    :param int threads: Most connections to use for an HTTP or FTP download
     :return: Path to the downloaded file
     :rtype: str
     """
     file_path = os.path.join(work_dir, name) if name else os.path.join(work_dir, os.path.basename(url))
+    scheme = urlparse(url).scheme
+    # Like curl, take a URL without a scheme to be HTTP
+    native = scheme in ('http', 'https', 'ftp', '') and not _proxied(url if scheme else 'http://' + url)
     if cghub_key_path:
         _download_with_genetorrent(url, file_path, cghub_key_path)
-    elif urlparse(url).scheme == 's3':
+    elif scheme == 's3':
         _s3am_with_retry(num_cores=1, file_path=file_path, s3_url=url, mode='download', s3_key_path=s3_key_path)
-    elif urlparse(url).scheme == 'file':
+    elif scheme == 'file':
         shutil.copy(urlparse(url).path, file_path)
+    elif native:
+        if not os.path.isdir(work_dir):
+            os.makedirs(work_dir)
+        _download_parallel(url if scheme else 'http://' + url, file_path, md5=md5, threads=threads)
     else:
         subprocess.check_call(['curl', '-fs', '--retry', '5', '--create-dir', url, '-o', file_path])
+        if md5 is not None and file_checksum(file_path) != md5.lower():
+            os.unlink(file_path)
+            raise _DownloadError('MD5 of {} does not match {}'.format(url, md5))
     assert os.path.exists(file_path)
     return file_path
 
@@ -41,6 +78,356 @@ def download_url_job(job, url, name=None, s3_key_path=None, cghub_key_path=None)
     return job.fileStore.writeGlobalFile(fpath)
 
 
+def _proxied(url):
+    """
+    :param str url: HTTP, HTTPS or FTP URL
+    :return: Whether the proxy environment variables, like http_proxy, all_proxy and no_proxy, send the URL through a
+             proxy. The native downloader only makes direct connections.
+    :rtype: bool
+    """
+    parsed = urlparse(url)
+    proxies = urllib.getproxies()
+    return (parsed.scheme in proxies or 'all' in proxies) and not urllib.proxy_bypass(parsed.hostname or '')
+
+
+class _ConnectionPool(object):
+    """
+    Keeps idle HTTP connections for reuse by later requests to the same server, for the life of the process
+    """
+    def __init__(self, max_idle=2 * DOWNLOAD_THREADS):
+        self.max_idle = max_idle
+        self.idle = defaultdict(list)
+        self.lock = threading.Lock()
+
+    def get(self, scheme, netloc):
+        """
+        :return: An idle connection to the given server, or a new one
+        :rtype: httplib.HTTPConnection
+        """
+        with self.lock:
+            if self.idle[(scheme, netloc)]:
+                return self.idle[(scheme, netloc)].pop()
+        connection_class = httplib.HTTPSConnection if scheme == 'https' else httplib.HTTPConnection
+        return connection_class(netloc, timeout=DOWNLOAD_TIMEOUT)
+
+    def put(self, scheme, netloc, connection, response):
+        """
+        Takes back a connection once its response has been handled, keeping it if it can be used again
+
+        :param httplib.HTTPResponse response: The last response on the connection
+        """
+        with self.lock:
+            idle = self.idle[(scheme, netloc)]
+            if response.isclosed() and not response.will_close and len(idle) < self.max_idle:
+                idle.append(connection)
+                return
+        connection.close()
+
+    def clear(self):
+        """
+        Closes all the idle connections
+        """
+        with self.lock:
+            idle, self.idle = self.idle, defaultdict(list)
+        for connections in idle.itervalues():
+            for connection in connections:
+                connection.close()
+
+
+_connections = _ConnectionPool()
+
+
+def close_connections():
+    """
+    Closes the connections kept open for later downloads
+    """
+    _connections.clear()
+
+
+class _DownloadError(Exception):
+    """
+    A download failed in a way that retrying won't fix
+    """
+
+
+class _HTTPSource(object):
+    """
+    A file to download over HTTP or HTTPS
+    """
+    def __init__(self, url):
+        self.url = url
+        self.size = None
+        self.ranges = False
+        self.validator = None
+
+    def _get(self, headers, redirects=5, allowed_errors=()):
+        """
+        Sends a GET request for the file, following redirects, which are remembered for later requests. Error
+        statuses raise an exception, unless they are allowed.
+
+        :return: The connection and its response, which must be given back to the pool
+        :rtype: tuple(httplib.HTTPConnection,httplib.HTTPResponse)
+        """
+        for _ in xrange(redirects + 1):
+            parsed = urlparse(self.url)
+            connection = _connections.get(parsed.scheme, parsed.netloc)
+            path = (parsed.path or '/') + ('?' + parsed.query if parsed.query else '')
+            try:
+                connection.request('GET', path, headers=headers)
+                response = connection.getresponse()
+            except:
+                connection.close()
+                raise
+            if response.status in (301, 302, 303, 307, 308):
+                location = response.getheader('location')
+                response.read()
+                _connections.put(parsed.scheme, parsed.netloc, connection, response)
+                self.url = urljoin(self.url, location)
+                continue
+            if response.status >= 400 and response.status not in allowed_errors:
+                response.read()
+                _connections.put(parsed.scheme, parsed.netloc, connection, response)
+                error = IOError if response.status >= 500 else _DownloadError
+                raise error('HTTP {} {} for {}'.format(response.status, response.reason, self.url))
+            return connection, response
+        raise _DownloadError('Too many redirects for {}'.format(self.url))
+
+    def _done(self, connection, response):
+        parsed = urlparse(self.url)
+        _connections.put(parsed.scheme, parsed.netloc, connection, response)
+
+    def probe(self):
+        """
+        Finds out the file's size, whether the server can send parts of it, and what identifies this version of it
+        """
+        # An empty file has no byte 0 to send
+        connection, response = self._get({'Range': 'bytes=0-0'}, allowed_errors=(416,))
+        if response.status in (206, 416):
+            try:
+                response.read()
+            finally:
+                self._done(connection, response)
+        else:
+            # No ranges, so this is the whole file. Don't read it just to reuse the connection.
+            connection.close()
+        self.validator = response.getheader('etag') or response.getheader('last-modified')
+        total = (response.getheader('content-range') or '').rpartition('/')[2]
+        if response.status == 206 and total.isdigit():
+            self.size = int(total)
+            self.ranges = True
+        elif response.status == 416 and total == '0':
+            self.size = 0
+        elif response.status == 200 and response.getheader('content-length') is not None:
+            self.size = int(response.getheader('content-length'))
+
+    def fetch(self, handle, start, end):
+        """
+        Writes bytes start up to end of the file to the same place in the given file object
+        """
+        headers = {'Range': 'bytes={}-{}'.format(start, end - 1)}
+        if self.validator:
+            # Get the whole file instead, which we'll reject, if it has changed
+            headers['If-Range'] = self.validator
+        connection, response = self._get(headers)
+        try:
+            content_range = response.getheader('content-range') or ''
+            if response.status != 206 or not content_range.startswith('bytes {}-'.format(start)):
+                raise _DownloadError('{} changed during download'.format(self.url))
+            _copy_bytes(response.read, handle, start, end - start)
+        except:
+            connection.close()
+            raise
+        else:
+            self._done(connection, response)
+
+    def stream(self, handle):
+        """
+        Writes the whole file to the given file object, over one connection
+        """
+        connection, response = self._get({})
+        try:
+            _copy_bytes(response.read, handle, 0, self.size)
+        except:
+            connection.close()
+            raise
+        else:
+            self._done(connection, response)
+
+
+class _FTPSource(object):
+    """
+    A file to download over FTP. Every request gets its own control connection, since a ranged transfer has to be
+    cut off partway through.
+    """
+    def __init__(self, url):
+        self.url = url
+        self.parsed = urlparse(url)
+        self.size = None
+        self.ranges = False
+        self.validator = None
+
+    def _connect(self):
+        ftp = ftplib.FTP(timeout=DOWNLOAD_TIMEOUT)
+        ftp.connect(self.parsed.hostname, self.parsed.port or ftplib.FTP_PORT)
+        ftp.login(self.parsed.username or 'anonymous', self.parsed.password or 'anonymous@')
+        ftp.voidcmd('TYPE I')
+        return ftp
+
+    def probe(self):
+        ftp = self._connect()
+        try:
+            try:
+                self.size = ftp.size(self.parsed.path)
+            except ftplib.error_perm:
+                pass
+            try:
+                self.validator = ftp.sendcmd('MDTM {}'.format(self.parsed.path))
+            except ftplib.error_perm:
+                pass
+            try:
+                self.ranges = ftp.sendcmd('REST 0').startswith('350')
+            except ftplib.error_perm:
+                self.ranges = False
+        finally:
+            ftp.close()
+
+    def _transfer(self, handle, start, length):
+        ftp = self._connect()
+        try:
+            data = ftp.transfercmd('RETR {}'.format(self.parsed.path), rest=start or None)
+            try:
+                _copy_bytes(data.makefile('rb').read, handle, start, length)
+            finally:
+                data.close()
+        finally:
+            ftp.close()
+
+    def fetch(self, handle, start, end):
+        self._transfer(handle, start, end - start)
+
+    def stream(self, handle):
+        self._transfer(handle, 0, self.size)
+
+
+def _copy_bytes(read, handle, start, length):
+    """
+    Copies length bytes, or everything if length is None, from the read function to the given file object at the
+    given offset, and fails if there weren't enough
+    """
+    handle.seek(start)
+    copied = 0
+    while length is None or copied < length:
+        data = read(READ_SIZE if length is None else min(READ_SIZE, length - copied))
+        if not data:
+            break
+        handle.write(data)
+        copied += len(data)
+    if length is not None and copied < length:
+        raise IOError('Connection closed after {} of {} bytes'.format(copied, length))
+
+
+def _retrying(function, *args):
+    """
+    Calls the function with the given arguments, retrying with exponential back-off on network errors
+    """
+    for delay in backoff_times(retries=DOWNLOAD_RETRIES, base_delay=1):
+        time.sleep(delay)
+        try:
+            return function(*args)
+        except (IOError, EOFError, httplib.HTTPException, ftplib.error_temp, ftplib.error_reply) as e:
+            RealTimeLogger.get().warning('{} failed, will retry: {}'.format(function.__name__, e))
+            error = e
+    raise error
+
+
+def _download_parallel(url, file_path, md5=None, threads=DOWNLOAD_THREADS, segment_size=SEGMENT_SIZE):
+    """
+    Downloads an HTTP or FTP URL to the given path, in segments fetched over several connections if the server
+    supports ranges, or over one connection if it doesn't. The download goes to <file_path>.part, and which segments
+    are done is kept in <file_path>.part.json, so an interrupted download of an unchanged file picks up where it
+    stopped. The file is only moved into place once its size, and MD5 if given, are right.
+
+    :param str url: HTTP, HTTPS or FTP URL
+    :param str file_path: Where to put the file
+    :param str md5: Expected MD5 hex digest
+    :param int threads: Most connections to use at once
+    :param int segment_size: Bytes to fetch with each request
+    """
+    part_path = file_path + '.part'
+    state_path = part_path + '.json'
+    source = _FTPSource(url) if urlparse(url).scheme == 'ftp' else _HTTPSource(url)
+    _retrying(source.probe)
+    start_time = time.time()
+
+    state = {'url': url, 'size': source.size, 'validator': source.validator, 'done': []}
+    if source.ranges and source.validator and os.path.exists(state_path) and os.path.exists(part_path):
+        with open(state_path) as state_file:
+            try:
+                saved = json.load(state_file)
+            except ValueError:
+                saved = {}
+        if all(saved.get(key) == state[key] for key in ['url', 'size', 'validator']):
+            state['done'] = saved.get('done', [])
+    if not state['done']:
+        with open(part_path, 'wb') as part_file:
+            if source.ranges:
+                part_file.truncate(source.size)
+    resumed = len(state['done'])
+
+    lock = threading.Lock()
+
+    def save_state():
+        temp_path = state_path + '.tmp'
+        with open(temp_path, 'w') as state_file:
+            json.dump(state, state_file)
+        os.rename(temp_path, state_path)
+
+    def fetch(segment):
+        with open(part_path, 'r+b') as part_file:
+            _retrying(source.fetch, part_file, segment[0], segment[1])
+        with lock:
+            state['done'].append(list(segment))
+            save_state()
+
+    if source.ranges and source.size:
+        done = set(tuple(segment) for segment in state['done'])
+        segments = [segment for segment in split_ranges(source.size, segment_size) if segment not in done]
+        if segments:
+            pool = multiprocessing.pool.ThreadPool(max(1, min(threads, len(segments))))
+            try:
+                for _ in pool.imap_unordered(fetch, segments):
+                    pass
+            finally:
+                pool.terminate()
+    else:
+        def stream():
+            with open(part_path, 'wb') as part_file:
+                source.stream(part_file)
+        _retrying(stream)
+
+    try:
+        if source.size is not None and os.path.getsize(part_path) != source.size:
+            raise _DownloadError('Downloaded {} bytes of {} but expected {}'.format(
+                os.path.getsize(part_path), url, source.size))
+        if md5 is not None and file_checksum(part_path) != md5.lower():
+            raise _DownloadError('MD5 of {} does not match {}'.format(url, md5))
+    except _DownloadError:
+        # Don't resume from something broken
+        for path in [part_path, state_path]:
+            if os.path.exists(path):
+                os.unlink(path)
+        raise
+    os.rename(part_path, file_path)
+    if os.path.exists(state_path):
+        os.unlink(state_path)
+
+    elapsed = max(time.time() - start_time, 1e-6)
+    size = os.path.getsize(file_path)
+    RealTimeLogger.get().info('Downloaded {}: {:.1f} MB in {:.1f} seconds ({:.1f} MB/s), {}{}'.format(
+        url, size / 1e6, elapsed, size / 1e6 / elapsed,
+        'ranged' if source.ranges else 'single stream', ', resumed' if resumed else ''))
+
+
 def _download_with_genetorrent(url, file_path, cghub_key_path):
     parsed_url = urlparse(url)
     analysis_id = parsed_url.path[1:]
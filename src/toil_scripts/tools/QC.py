@@ -1,9 +1,11 @@
 import os
 
 from toil_scripts.lib.files import tarball_files
+from toil_scripts.lib.instrumentation import instrumented
 from toil_scripts.lib.programs import docker_call
 
 
+@instrumented
 def run_fastqc(job, r1_id, r2_id):
     """
     Run Fastqc on the input reads
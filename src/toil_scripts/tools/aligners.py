@@ -2,10 +2,12 @@ import os
 
 import subprocess
 
+from toil_scripts.lib.instrumentation import instrumented
 from toil_scripts.lib.programs import docker_call
 from toil_scripts.lib.urls import download_url
 
 
+@instrumented
 def run_star(job, cores, r1_id, r2_id, star_index_url, wiggle=False):
     """
     Performs alignment of fastqs to bam via STAR
@@ -67,6 +69,7 @@ def run_star(job, cores, r1_id, r2_id, star_index_url, wiggle=False):
         return transcriptome_id, sorted_id
 
 
+@instrumented
 def run_bwakit(job, config, threads, sort=True, trim=False):
     """
     Runs BWA-Kit to align a fastq file or fastq pair into a BAM file.
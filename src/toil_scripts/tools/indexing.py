@@ -1,8 +1,10 @@
 import os
 
+from toil_scripts.lib.instrumentation import instrumented
 from toil_scripts.lib.programs import docker_call
 
 
+@instrumented
 def run_bwa_index(job, ref_id):
     """
     Use BWA to create reference index files
@@ -24,6 +26,7 @@ def run_bwa_index(job, ref_id):
     return ids['amb'], ids['ann'], ids['bwt'], ids['pac'], ids['sa']
 
 
+@instrumented
 def run_samtools_faidx(job, ref_id):
     """
     Use Samtools to create reference index file
@@ -3,9 +3,11 @@ from glob import glob
 
 from toil_scripts.tools import get_mean_insert_size
 from toil_scripts.lib.files import tarball_files
+from toil_scripts.lib.instrumentation import instrumented
 from toil_scripts.lib.programs import docker_call
 
 
+@instrumented
 def run_mutect(job, normal_bam, normal_bai, tumor_bam, tumor_bai, ref, ref_dict, fai, cosmic, dbsnp):
     """
     Calls MuTect to perform variant analysis
@@ -50,6 +52,7 @@ def run_mutect(job, normal_bam, normal_bai, tumor_bam, tumor_bai, ref, ref_dict,
     return job.fileStore.writeGlobalFile(os.path.join(work_dir, 'mutect.tar.gz'))
 
 
+@instrumented
 def run_muse(job, cores, normal_bam, normal_bai, tumor_bam, tumor_bai, ref, ref_dict, fai, dbsnp):
     """
     Calls MuSe to find variants
@@ -91,6 +94,7 @@ def run_muse(job, cores, normal_bam, normal_bai, tumor_bam, tumor_bai, ref, ref_
     return job.fileStore.writeGlobalFile(os.path.join(work_dir, 'muse.tar.gz'))
 
 
+@instrumented
 def run_pindel(job, cores, normal_bam, normal_bai, tumor_bam, tumor_bai, ref, fai):
     """
     Calls Pindel to compute indels / deletions
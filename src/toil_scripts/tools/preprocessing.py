@@ -1,9 +1,11 @@
 import os
 
 from toil_scripts.lib import require
+from toil_scripts.lib.instrumentation import instrumented
 from toil_scripts.lib.programs import docker_call
 
 
+@instrumented
 def run_cutadapt(job, r1_id, r2_id, fwd_3pr_adapter, rev_3pr_adapter):
     """
     Adapter triming for RNA-seq data
@@ -45,6 +47,7 @@ def run_cutadapt(job, r1_id, r2_id, fwd_3pr_adapter, rev_3pr_adapter):
     return r1_cut_id, r2_cut_id
 
 
+@instrumented
 def run_samtools_faidx(job, ref_id):
     """
     Use Samtools to create reference index file
@@ -63,6 +66,7 @@ def run_samtools_faidx(job, ref_id):
     return job.fileStore.writeGlobalFile(os.path.join(work_dir, 'ref.fasta.fai'))
 
 
+@instrumented
 def run_samtools_index(job, bam_id):
     """
     Runs samtools index to create (.bai) files
@@ -82,6 +86,7 @@ def run_samtools_index(job, bam_id):
     return job.fileStore.writeGlobalFile(os.path.join(work_dir, 'sample.bam.bai'))
 
 
+@instrumented
 def run_picard_create_sequence_dictionary(job, ref_id):
     """
     Use Picard-tools to create reference dictionary
@@ -100,6 +105,7 @@ def run_picard_create_sequence_dictionary(job, ref_id):
     return job.fileStore.writeGlobalFile(os.path.join(work_dir, 'ref.dict'))
 
 
+@instrumented
 def run_gatk_preprocessing(job, cores, bam, bai, ref, ref_dict, fai, phase, mills, dbsnp, mem='10G', unsafe=False):
     """
     Convenience method for grouping together GATK preprocessing
@@ -131,6 +137,7 @@ def run_gatk_preprocessing(job, cores, bam, bai, ref, ref_dict, fai, phase, mill
     return pr.rv(0), pr.rv(1)
 
 
+@instrumented
 def run_realigner_target_creator(job, cores, bam, bai, ref, ref_dict, fai, phase, mills, mem, unsafe=False):
     """
     Creates intervals file needed for indel realignment
@@ -173,6 +180,7 @@ def run_realigner_target_creator(job, cores, bam, bai, ref, ref_dict, fai, phase
     return job.fileStore.writeGlobalFile(os.path.join(work_dir, 'sample.intervals'))
 
 
+@instrumented
 def run_indel_realignment(job, intervals, bam, bai, ref, ref_dict, fai, phase, mills, mem, unsafe=False):
     """
     Creates realigned bams using the intervals file from previous step
@@ -220,6 +228,7 @@ def run_indel_realignment(job, intervals, bam, bai, ref, ref_dict, fai, phase, m
     return indel_bam, indel_bai
 
 
+@instrumented
 def run_base_recalibration(job, cores, indel_bam, indel_bai, ref, ref_dict, fai, dbsnp, mem, unsafe=False):
     """
     Creates recal table used in Base Quality Score Recalibration
@@ -259,6 +268,7 @@ def run_base_recalibration(job, cores, indel_bam, indel_bai, ref, ref_dict, fai,
     return job.fileStore.writeGlobalFile(os.path.join(work_dir, 'sample.recal.table'))
 
 
+@instrumented
 def run_print_reads(job, cores, table, indel_bam, indel_bai, ref, ref_dict, fai, mem, unsafe=False):
     """
     Creates BAM that has had the base quality scores recalibrated
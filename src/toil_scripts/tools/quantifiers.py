@@ -3,10 +3,12 @@ import os
 import subprocess
 
 from toil_scripts.lib.files import tarball_files
+from toil_scripts.lib.instrumentation import instrumented
 from toil_scripts.lib.programs import docker_call
 from toil_scripts.lib.urls import download_url
 
 
+@instrumented
 def run_kallisto(job, cores, r1_id, r2_id, kallisto_index_url):
     """
     RNA quantification via Kallisto
@@ -44,6 +46,7 @@ def run_kallisto(job, cores, r1_id, r2_id, kallisto_index_url):
     return job.fileStore.writeGlobalFile(os.path.join(work_dir, 'kallisto.tar.gz'))
 
 
+@instrumented
 def run_rsem(job, cores, bam_id, rsem_ref_url, paired=True):
     """
     RNA quantification with RSEM
@@ -92,6 +95,7 @@ def run_rsem(job, cores, bam_id, rsem_ref_url, paired=True):
     return gene_id, isoform_id
 
 
+@instrumented
 def run_rsem_postprocess(job, uuid, rsem_gene_id, rsem_isoform_id):
     """
     Parses RSEMs output to produce the separate .tab files (TPM, FPKM, counts) for both gene and isoform.
@@ -0,0 +1,504 @@
+#!/usr/bin/env python2.7
+"""
+benchmark.py: micro-benchmarks for the vg evaluation pipeline helpers, run on
+synthetic inputs so they need neither docker nor a real graph.
+
+example run: python benchmark.py stats --reads 200000
+example run: python benchmark.py codecs --index_dir /path/to/index
+example run: python benchmark.py upload --fastq_mb 1024 --store_dir /scratch/out
+"""
+
+import argparse, sys, os, json, random, string, time, collections
+import shutil, tempfile
+
+from toil_scripts.lib.toillib import (DIRECTORY_CODECS,
+    write_directory_archive, read_directory_archive, FileIOStore)
+from toil_scripts.vg_evaluation_pipeline.fastq_split import split_fastq
+from toil_scripts.vg_evaluation_pipeline.gam_stats import (alignment_stats,
+    have_ujson)
+from toil_scripts.vg_evaluation_pipeline.node_store import NodeSequences
+
+def parse_args(args):
+    """
+    Takes in the command-line arguments list (args), and returns a nice argparse
+    result with fields for all the options.
+
+    """
+
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+
+    parser.add_argument("benchmark", choices=["stats", "codecs", "upload"],
+        help="benchmark to run")
+    parser.add_argument("--nodes", type=int, default=100000,
+        help="number of nodes in the synthetic graph")
+    parser.add_argument("--node_length", type=int, default=32,
+        help="length of each synthetic node")
+    parser.add_argument("--reads", type=int, default=100000,
+        help="number of synthetic reads")
+    parser.add_argument("--seed", type=int, default=1,
+        help="random seed for the synthetic data")
+    parser.add_argument("--repeat", type=int, default=3,
+        help="number of timed runs; the fastest is reported")
+    parser.add_argument("--index_dir", type=str,
+        help="index directory to pack for the codecs benchmark, instead of "
+        "a synthetic one")
+    parser.add_argument("--index_mb", type=int, default=256,
+        help="size of the synthetic index directory, in megabytes")
+    parser.add_argument("--fastq_mb", type=int, default=512,
+        help="size of the synthetic FASTQ for the upload benchmark, in "
+        "megabytes")
+    parser.add_argument("--chunks", type=int, default=8,
+        help="number of chunks to split the FASTQ into for the upload "
+        "benchmark")
+    parser.add_argument("--store_dir", type=str,
+        help="directory to put the upload benchmark's out stores in, instead "
+        "of next to the chunks")
+
+    # The command line arguments start with the program name, which we don't
+    # want to treat as an argument for argparse. So we remove it.
+    args = args[1:]
+
+    return parser.parse_args(args)
+
+def synthetic_graph(node_count, node_length, seed=1):
+    """
+    Return a list of lines of vg graph JSON describing a graph of node_count
+    nodes of node_length random bases each. Some nodes contain runs of Ns.
+
+    """
+
+    rng = random.Random(seed)
+    lines = []
+    nodes = []
+    for node_id in xrange(1, node_count + 1):
+        sequence = [rng.choice("ACGT") for _ in xrange(node_length)]
+        if rng.random() < 0.1:
+            # Put in a run of Ns
+            start = rng.randrange(node_length)
+            for i in xrange(start, min(node_length,
+                start + rng.randint(1, 8))):
+                sequence[i] = "N"
+        nodes.append({"id": node_id, "sequence": "".join(sequence)})
+        if len(nodes) == 1000:
+            lines.append(json.dumps({"node": nodes}))
+            nodes = []
+    if nodes:
+        lines.append(json.dumps({"node": nodes}))
+    return lines
+
+def synthetic_alignments(read_count, node_count, node_length, seed=1):
+    """
+    Return a list of lines of vg alignment JSON for read_count synthetic reads
+    against a graph made by synthetic_graph. Reads have a mix of matches,
+    substitutions, insertions, deletions and soft clips, on both strands. Some
+    are unmapped and some have a secondary alignment.
+
+    """
+
+    rng = random.Random(seed)
+    lines = []
+    for read_number in xrange(read_count):
+        name = "read{}".format(read_number)
+        sequence = "".join(rng.choice("ACGTN") for _ in xrange(100))
+
+        if rng.random() < 0.05:
+            # Unmapped
+            lines.append(json.dumps({"name": name, "sequence": sequence}))
+            continue
+
+        alignments = [{"name": name, "sequence": sequence}]
+        if rng.random() < 0.2:
+            alignments.append({"name": name, "sequence": sequence,
+                "is_secondary": True})
+
+        for alignment in alignments:
+            alignment["score"] = rng.randint(0, 100)
+            mappings = []
+            node_id = rng.randint(1, node_count)
+            for _ in xrange(rng.randint(1, 4)):
+                mapping = {"position": {"node_id": node_id,
+                    "offset": rng.randrange(node_length)}}
+                if rng.random() < 0.5:
+                    mapping["is_reverse"] = True
+                edits = []
+                for _ in xrange(rng.randint(1, 6)):
+                    kind = rng.random()
+                    length = rng.randint(1, 10)
+                    if kind < 0.5:
+                        edits.append({"from_length": length,
+                            "to_length": length})
+                    elif kind < 0.7:
+                        edits.append({"from_length": length,
+                            "to_length": length, "sequence": "A" * length})
+                    elif kind < 0.85:
+                        edits.append({"to_length": length,
+                            "sequence": "C" * length})
+                    else:
+                        edits.append({"from_length": length})
+                mapping["edit"] = edits
+                mappings.append(mapping)
+                node_id = node_id % node_count + 1
+            if rng.random() < 0.02:
+                # Sometimes an insertion against no node at all
+                mappings.append({"edit": [{"to_length": 3,
+                    "sequence": "GGG"}]})
+            alignment["path"] = {"mapping": mappings}
+            lines.append(json.dumps(alignment))
+
+    return lines
+
+def best_time(repeat, function, *args):
+    """
+    Call the given function with the given arguments repeat times, and return
+    its result and the shortest wall-clock time it took.
+
+    """
+
+    times = []
+    for _ in xrange(repeat):
+        start_time = time.time()
+        result = function(*args)
+        times.append(time.time() - start_time)
+    return result, min(times)
+
+# Reverse complement needs a global translation table
+reverse_complement_translation_table = string.maketrans("ACGTN", "TGCAN")
+def reverse_complement(sequence):
+    """
+    Compute the reverse complement of a DNA sequence.
+
+    Follows algorithm from <http://stackoverflow.com/a/26615937>
+    """
+
+    if isinstance(sequence, unicode):
+        # Encode the sequence in ASCII for easy translation
+        sequence = sequence.encode("ascii", "replace")
+
+    # Translate and then reverse
+    return sequence.translate(reverse_complement_translation_table)[::-1]
+
+def count_Ns(sequence):
+    """
+    Return the number of N bases in the given DNA sequence
+    """
+
+    n_count = 0
+    for item in sequence:
+        if item == "N":
+            n_count += 1
+
+    return n_count
+
+def legacy_alignment_stats(alignment_lines, graph_lines):
+    """
+    Compute alignment stats the way run_stats used to, one alignment and one
+    edit at a time against a dict of node sequences. Used as the reference
+    that the batched implementation must match exactly.
+
+    """
+
+    node_sequences = {}
+    for line in graph_lines:
+        graph_chunk = json.loads(line)
+        for node_dict in graph_chunk.get("node", []):
+            node_sequences[node_dict["id"]] = node_dict["sequence"]
+
+    stats = {
+        "total_reads": 0,
+        "total_mapped": 0,
+        "total_multimapped": 0,
+        "mapped_lengths": collections.Counter(),
+        "unmapped_lengths": collections.Counter(),
+        "aligned_lengths": collections.Counter(),
+        "primary_scores": collections.Counter(),
+        "primary_mismatches": collections.Counter(),
+        "primary_indels": collections.Counter(),
+        "primary_substitutions": collections.Counter(),
+        "secondary_scores": collections.Counter(),
+        "secondary_mismatches": collections.Counter(),
+        "secondary_indels": collections.Counter(),
+        "secondary_substitutions": collections.Counter(),
+        "run_time": None
+    }
+
+    last_alignment = None
+
+    for line in alignment_lines:
+        alignment = json.loads(line)
+        length = len(alignment["sequence"])
+
+        if alignment.has_key("score"):
+            score = alignment["score"]
+            mappings = alignment.get("path", {}).get("mapping", [])
+            matches = 0
+            indels = 0
+            substitutions = 0
+            aligned_length = 0
+
+            for mapping_number, mapping in enumerate(mappings):
+                position = mapping.get("position", {})
+                if position.has_key("node_id"):
+                    ref_sequence = node_sequences[position["node_id"]]
+                    offset = position.get("offset", 0)
+                    if mapping.get("is_reverse", False):
+                        ref_sequence = reverse_complement(
+                            ref_sequence[0:offset + 1])
+                    else:
+                        ref_sequence = ref_sequence[offset:]
+                else:
+                    ref_sequence = ""
+
+                index_in_ref = 0
+                edits = mapping.get("edit", [])
+
+                for edit_number, edit in enumerate(edits):
+                    may_be_soft_clip = ((edit_number == 0 and
+                        mapping_number == 0) or
+                        (edit_number == len(edits) - 1 and
+                        mapping_number == len(mappings) - 1))
+
+                    reference_N_count = count_Ns(ref_sequence[
+                        index_in_ref:index_in_ref + edit.get("from_length", 0)])
+
+                    if edit.get("to_length", 0) == edit.get("from_length", 0):
+                        aligned_length += edit.get("to_length", 0)
+
+                    if (not edit.has_key("sequence") and
+                        edit.get("to_length", 0) == edit.get("from_length", 0)):
+                        matches += edit["from_length"]
+
+                    if not may_be_soft_clip and (edit.get("to_length", 0) !=
+                        edit.get("from_length", 0)):
+                        if reference_N_count == 0:
+                            indels += 1
+
+                    if (edit.get("to_length", 0) ==
+                        edit.get("from_length", 0) and
+                        edit.has_key("sequence")):
+                        substitutions += (edit.get("to_length", 0) -
+                            reference_N_count)
+                        aligned_length -= reference_N_count
+
+                    index_in_ref += edit.get("from_length", 0)
+
+            mismatches = length - matches
+
+            if alignment.get("is_secondary", False):
+                if (last_alignment is None or
+                    last_alignment.get("name") != alignment.get("name") or
+                    last_alignment.get("is_secondary", False)):
+                    raise RuntimeError("{} secondary alignment comes after "
+                        "alignment of {} instead of corresponding primary "
+                        "alignment\n".format(alignment.get("name"),
+                        last_alignment.get("name") if last_alignment is not None
+                        else "nothing"))
+
+                stats["total_multimapped"] += 1
+                stats["secondary_scores"][score] += 1
+                stats["secondary_mismatches"][mismatches] += 1
+                stats["secondary_indels"][indels] += 1
+                stats["secondary_substitutions"][substitutions] += 1
+            else:
+                stats["total_mapped"] += 1
+                stats["primary_scores"][score] += 1
+                stats["primary_mismatches"][mismatches] += 1
+                stats["primary_indels"][indels] += 1
+                stats["primary_substitutions"][substitutions] += 1
+                stats["mapped_lengths"][length] += 1
+                stats["aligned_lengths"][aligned_length] += 1
+                stats["total_reads"] += 1
+
+        elif not alignment.get("is_secondary", False):
+            stats["total_reads"] += 1
+            stats["unmapped_lengths"][length] += 1
+
+        last_alignment = alignment
+
+    return stats
+
+def bench_stats(options):
+    """
+    Time the legacy and batched stats implementations on the same synthetic
+    GAM, and check that they produce byte-identical stats JSON.
+
+    """
+
+    graph_lines = synthetic_graph(options.nodes, options.node_length,
+        options.seed)
+    alignment_lines = synthetic_alignments(options.reads, options.nodes,
+        options.node_length, options.seed)
+
+    def legacy():
+        return json.dumps(legacy_alignment_stats(alignment_lines, graph_lines))
+
+    def batched():
+        node_sequences = NodeSequences.from_graph_json(graph_lines)
+        return json.dumps(alignment_stats(alignment_lines, node_sequences))
+
+    legacy_json, legacy_time = best_time(options.repeat, legacy)
+    batched_json, batched_time = best_time(options.repeat, batched)
+
+    print("{} alignment lines against {} nodes, decoded with {}".format(
+        len(alignment_lines), options.nodes, "ujson" if have_ujson else "json"))
+    print("legacy:  {:.2f} seconds".format(legacy_time))
+    print("batched: {:.2f} seconds ({:.1f}x)".format(batched_time,
+        legacy_time / batched_time))
+    print("identical output: {}".format(legacy_json == batched_json))
+
+    return 0 if legacy_json == batched_json else 1
+
+def synthetic_index(directory, megabytes, seed=1):
+    """
+    Fill the given directory with megabytes of files standing in for a graph
+    index: mostly poorly-compressible binary data, like xg and GCSA files, and
+    some DNA sequence, like the graph itself.
+
+    """
+
+    rng = random.Random(seed)
+    block = 1024 * 1024
+    with open(os.path.join(directory, "graph.vg.gcsa"), "wb") as gcsa:
+        for _ in xrange(megabytes * 3 // 4):
+            gcsa.write(os.urandom(block))
+    with open(os.path.join(directory, "graph.vg"), "wb") as graph:
+        for _ in xrange(megabytes - megabytes * 3 // 4):
+            graph.write("".join(rng.choice("ACGT") for _ in xrange(1024)) *
+                (block // 1024))
+
+def bench_codecs(options):
+    """
+    Time packing and unpacking an index directory with each directory archive
+    codec, and report the archive sizes.
+
+    """
+
+    work_dir = tempfile.mkdtemp()
+    try:
+        index_dir = options.index_dir
+        if index_dir is None:
+            index_dir = os.path.join(work_dir, "index")
+            os.mkdir(index_dir)
+            synthetic_index(index_dir, options.index_mb, options.seed)
+
+        print("codec  size (MB)  pack (s)  unpack (s)")
+        for codec, extension in DIRECTORY_CODECS.iteritems():
+            archive = os.path.join(work_dir, "index" + extension)
+            unpacked = os.path.join(work_dir, "unpacked")
+
+            def pack():
+                with open(archive, "wb") as handle:
+                    write_directory_archive(index_dir, handle, codec)
+
+            def unpack():
+                shutil.rmtree(unpacked, ignore_errors=True)
+                with open(archive, "rb") as handle:
+                    read_directory_archive(handle, unpacked)
+
+            try:
+                _, pack_time = best_time(options.repeat, pack)
+            except RuntimeError as e:
+                print("{:5}  unavailable: {}".format(codec, e))
+                continue
+            _, unpack_time = best_time(options.repeat, unpack)
+
+            print("{:5}  {:9.1f}  {:8.2f}  {:10.2f}".format(codec,
+                os.path.getsize(archive) / 1e6, pack_time, unpack_time))
+            os.unlink(archive)
+    finally:
+        shutil.rmtree(work_dir)
+
+    return 0
+
+def synthetic_fastq(path, megabytes, read_length=100, seed=1):
+    """
+    Write about megabytes of random reads of the given length to a FASTQ file
+    at the given path.
+
+    """
+
+    rng = random.Random(seed)
+    # Repeat a pool of random reads, since making each one is slow
+    reads = []
+    for read_number in xrange(1000):
+        sequence = "".join(rng.choice("ACGT") for _ in xrange(read_length))
+        quality = "".join(rng.choice("#?ABCDEFGHI")
+            for _ in xrange(read_length))
+        reads.append("@read{}\n{}\n+\n{}\n".format(read_number, sequence,
+            quality))
+    block = "".join(reads)
+    with open(path, "wb") as handle:
+        for _ in xrange(megabytes * 1024 * 1024 // len(block) + 1):
+            handle.write(block)
+
+def bench_upload(options):
+    """
+    Time the chunk upload path of run_split_fastq against a local out store,
+    with each FileIOStore transfer mode.
+
+    """
+
+    work_dir = tempfile.mkdtemp()
+    store_root = tempfile.mkdtemp(dir=options.store_dir or work_dir)
+    try:
+        fastq = os.path.join(work_dir, "reads.fq")
+        synthetic_fastq(fastq, options.fastq_mb, seed=options.seed)
+        fastq_bytes = os.path.getsize(fastq)
+
+        print("mode  upload (s)  MB/s    linked chunks")
+        for transfer in FileIOStore.TRANSFER_MODES:
+            store_dir = os.path.join(store_root, transfer)
+            chunk_dir = os.path.join(work_dir, "chunks")
+
+            def upload():
+                # Each run starts from fresh chunks and an empty store
+                shutil.rmtree(store_dir, ignore_errors=True)
+                shutil.rmtree(chunk_dir, ignore_errors=True)
+                os.mkdir(store_dir)
+                os.mkdir(chunk_dir)
+                with open(fastq, "rb") as handle:
+                    chunks = list(split_fastq(handle, lambda number:
+                        os.path.join(chunk_dir, "chunk_{}.fq".format(number)),
+                        bytes_per_chunk=fastq_bytes // options.chunks + 1))
+
+                # Time just the uploads, as run_split_fastq does them
+                out_store = FileIOStore(store_dir, transfer)
+                start_time = time.time()
+                for chunk_number, path, _ in chunks:
+                    out_store.write_output_file(path,
+                        "chunks/" + os.path.basename(path))
+                return (time.time() - start_time, [path for _, path, _ in
+                    chunks])
+
+            upload_time, paths = min(upload() for _ in
+                xrange(options.repeat))
+            linked = sum(os.path.samefile(path, os.path.join(store_dir,
+                "chunks", os.path.basename(path))) for path in paths)
+
+            print("{:5} {:10.2f}  {:6.1f}  {}/{}".format(transfer, upload_time,
+                fastq_bytes / 1e6 / max(upload_time, 1e-6), linked,
+                len(paths)))
+    finally:
+        shutil.rmtree(store_root)
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    return 0
+
+def main(args):
+    """
+    Parses command line arguments and runs the requested benchmark.
+    "args" specifies the program arguments, with args[0] being the executable
+    name. The return value should be used as the program's exit code.
+    """
+
+    options = parse_args(args)
+
+    if options.benchmark == "stats":
+        return bench_stats(options)
+    elif options.benchmark == "codecs":
+        return bench_codecs(options)
+    elif options.benchmark == "upload":
+        return bench_upload(options)
+
+if __name__ == "__main__" :
+    sys.exit(main(sys.argv))
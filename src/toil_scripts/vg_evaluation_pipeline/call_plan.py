@@ -0,0 +1,97 @@
+"""
+call_plan.py: decide how to divide variant calling between jobs.
+
+Calling time grows with the number of bases called, so the planner aims to
+give every calling job about the same number of bases. Contigs much bigger
+than the target are split into windows that tile them, which are called with
+some overlapping context on each side and clipped back to the window, and
+contigs much smaller than the target are packed together into one job. Each
+job's cores and memory are scaled to its share of bases.
+"""
+
+import collections
+import math
+
+# Which part of which contig does a calling job call? Regions tile each contig
+# without overlapping. order is the region's place in the merged VCF.
+CallRegion = collections.namedtuple("CallRegion", ["order", "contig",
+    "contig_length", "start", "end"])
+
+# What does each calling job do, and with how many resources?
+CallJob = collections.namedtuple("CallJob", ["regions", "bases", "cores",
+    "memory"])
+
+def region_key(region):
+    """
+    Return the output store key for the VCF of the given CallRegion. Regions
+    covering whole contigs are named for just the contig.
+
+    >>> region_key(CallRegion(0, "1", 1000, 0, 1000))
+    '1.vcf.gz'
+    >>> region_key(CallRegion(1, "2", 1000, 0, 500))
+    '2_0-500.vcf.gz'
+
+    """
+
+    if region.start == 0 and region.end == region.contig_length:
+        return "{}.vcf.gz".format(region.contig)
+    return "{}_{}-{}.vcf.gz".format(region.contig, region.start, region.end)
+
+def split_contigs(contigs, window_bases):
+    """
+    Split the (name, length) contigs into CallRegions of at most about
+    window_bases each, of nearly equal size within a contig, in order.
+
+    >>> [(r.contig, r.start, r.end) for r in split_contigs([("1", 25), ("2", 5)], 10)]
+    [('1', 0, 8), ('1', 8, 16), ('1', 16, 25), ('2', 0, 5)]
+
+    """
+
+    regions = []
+    for contig, length in contigs:
+        windows = max(1, int(math.ceil(length / float(window_bases))))
+        for window in xrange(windows):
+            regions.append(CallRegion(len(regions), contig, length,
+                length * window // windows, length * (window + 1) // windows))
+    return regions
+
+def plan_calling(contigs, window_bases, max_cores, max_memory, min_memory):
+    """
+    Plan calling the given (name, length) contigs, aiming for window_bases
+    bases per job. Jobs with a full window's bases get max_cores cores and
+    max_memory bytes of memory, and smaller jobs get proportionally less, but
+    at least 1 core and min_memory bytes. Returns a list of CallJobs, biggest
+    first.
+
+    >>> jobs = plan_calling([("1", 250), ("21", 48), ("22", 51), ("Y", 59)],
+    ...     100, 16, 100, 10)
+    >>> [[(r.contig, r.start, r.end) for r in job.regions] for job in jobs]
+    [[('1', 166, 250)], [('1', 0, 83)], [('1', 83, 166)], [('Y', 0, 59)], [('22', 0, 51), ('21', 0, 48)]]
+    >>> [(job.cores, job.memory) for job in jobs]
+    [(13, 84), (13, 83), (13, 83), (9, 59), (16, 99)]
+
+    """
+
+    # Cut up the big contigs
+    regions = split_contigs(contigs, window_bases)
+
+    # Pack regions into jobs, first fit by decreasing size
+    bins = []
+    for region in sorted(regions, key=lambda r: (r.start - r.end, r.order)):
+        for packed in bins:
+            if (sum(r.end - r.start for r in packed) + region.end -
+                region.start <= window_bases):
+                packed.append(region)
+                break
+        else:
+            bins.append([region])
+
+    jobs = []
+    for packed in bins:
+        bases = sum(r.end - r.start for r in packed)
+        share = min(1.0, bases / float(window_bases))
+        jobs.append(CallJob(regions=packed, bases=bases,
+            cores=max(1, int(round(max_cores * share))),
+            memory=max(min_memory, int(max_memory * share))))
+
+    return jobs
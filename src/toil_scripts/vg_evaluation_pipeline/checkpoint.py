@@ -0,0 +1,122 @@
+"""
+checkpoint.py: let pipeline stages skip work that a previous run finished.
+
+When a stage finishes, it saves a small completion manifest to the output
+store, after all of its outputs. The manifest lists the output keys, the
+stage's result (anything JSON can hold), and a fingerprint of the options the
+outputs depend on, which can include the identity of input files as well as
+their names. A later run with the same options finds the manifest, checks
+that the outputs are all still there, and can use the saved result instead of
+redoing the stage. Since the manifest is only written once everything else is,
+a stage that died partway through never looks finished.
+"""
+
+import hashlib
+import json
+import os
+import tempfile
+
+# Where do manifests go in the output store?
+CHECKPOINT_PREFIX = "checkpoints/"
+
+def fingerprint(options, names):
+    """
+    Return a string identifying the values of the named fields of the given
+    options object, so outputs made with different settings aren't reused.
+
+    >>> class Options(object):
+    ...     kmer_size = 16
+    ...     edge_max = 5
+    >>> fingerprint(Options(), ["kmer_size", "edge_max"]) == fingerprint(Options(), ["edge_max", "kmer_size"])
+    True
+    >>> other = Options()
+    >>> other.kmer_size = 24
+    >>> fingerprint(Options(), ["kmer_size"]) == fingerprint(other, ["kmer_size"])
+    False
+
+    """
+
+    values = dict((name, getattr(options, name, None)) for name in names)
+    return hashlib.sha1(json.dumps(values, sort_keys=True)).hexdigest()
+
+def file_identity(path):
+    """
+    Return the size and modification time of the given local file, or None if
+    there is no such file. Saved in an option, this tells a changed input apart
+    from the one the outputs were made from, even if it has the same name.
+
+    """
+
+    if not os.path.exists(path):
+        return None
+    stat = os.stat(path)
+    return {"size": stat.st_size, "mtime": stat.st_mtime}
+
+def checkpoint_key(name):
+    """
+    Return the output store key for the manifest of the stage with the given
+    name.
+
+    >>> checkpoint_key("alignment/NA12877_3")
+    'checkpoints/alignment/NA12877_3.json'
+
+    """
+
+    return "{}{}.json".format(CHECKPOINT_PREFIX, name)
+
+def save_checkpoint(out_store, name, stage_fingerprint, outputs, result=None):
+    """
+    Record in the given IOStore that the named stage finished, with the given
+    fingerprint, having written the given list of output keys and returned the
+    given result. Call this only after all the outputs are written.
+
+    """
+
+    manifest = {
+        "fingerprint": stage_fingerprint,
+        "outputs": list(outputs),
+        "result": result
+    }
+
+    handle, path = tempfile.mkstemp()
+    try:
+        with os.fdopen(handle, "w") as manifest_file:
+            json.dump(manifest, manifest_file)
+        out_store.write_output_file(path, checkpoint_key(name))
+    finally:
+        os.unlink(path)
+
+def load_checkpoint(out_store, name, stage_fingerprint):
+    """
+    Look in the given IOStore for a finished run of the named stage with the
+    given fingerprint. Returns a pair of whether one was found, with all its
+    outputs still present, and the result it saved.
+
+    """
+
+    key = checkpoint_key(name)
+    if not out_store.exists(key):
+        return False, None
+
+    handle, path = tempfile.mkstemp()
+    os.close(handle)
+    try:
+        out_store.read_input_file(key, path)
+        with open(path) as manifest_file:
+            manifest = json.load(manifest_file)
+    except ValueError:
+        # A damaged manifest means the stage has to run again
+        return False, None
+    finally:
+        if os.path.lexists(path):
+            os.unlink(path)
+
+    if manifest.get("fingerprint") != stage_fingerprint:
+        # Made with different settings
+        return False, None
+
+    for output in manifest.get("outputs", []):
+        if not out_store.exists(output):
+            return False, None
+
+    return True, manifest.get("result")
@@ -0,0 +1,139 @@
+"""
+chunk_plan.py: decide how to split reads into chunks for alignment.
+
+Every alignment job has to fetch and unpack the whole graph index before it
+can map anything, so chunks that are too small spend most of their time on the
+index, while too few chunks leave workers idle. The planner works out how many
+alignment jobs fit on a worker at once from the index size, and then sizes
+chunks so each one aligns for about the target time, but for long enough to
+amortize unpacking the index, and so there are enough chunks to go around.
+"""
+
+import collections
+import math
+import re
+
+# About how many reads does vg map align per core per second?
+DEFAULT_READS_PER_CORE_SECOND = 100
+
+# About how fast can a job download and unpack the index, in bytes per second?
+DEFAULT_INDEX_BYTES_PER_SECOND = 100 * 1024 * 1024
+
+# How many times longer than unpacking the index should aligning a chunk take?
+INDEX_AMORTIZATION = 4
+
+# vg loads the xg and GCSA indexes into memory, so an alignment job needs about
+# this much memory per byte of index, plus a fixed allowance.
+INDEX_MEMORY_FACTOR = 1.2
+BASE_MEMORY = 4 * 1024 ** 3
+
+# Disk for a chunk's FASTQ, GAM and stats, per byte of FASTQ, plus room for
+# the index tarball and its extracted contents.
+CHUNK_DISK_FACTOR = 4
+BASE_DISK = 1024 ** 3
+
+# When planning before the index exists, about how big will the index be for
+# each byte of graph?
+INDEX_GRAPH_RATIO = 8
+
+# About how many bytes is one FASTQ record, if we can't look?
+DEFAULT_BYTES_PER_READ = 350
+
+ChunkPlan = collections.namedtuple("ChunkPlan", ["read_count", "chunk_count",
+    "reads_per_chunk", "cores", "memory", "disk", "jobs_per_worker",
+    "chunk_seconds", "index_seconds"])
+
+def parse_size(size):
+    """
+    Parse a size like "100G" or "512M" or "1000" into a number of bytes.
+
+    >>> parse_size("100G")
+    107374182400
+    >>> parse_size("1.5k")
+    1536
+    >>> parse_size(42)
+    42
+
+    """
+
+    if isinstance(size, (int, long)):
+        return size
+
+    match = re.match(r"^\s*([0-9.]+)\s*([kmgtp]?)i?b?\s*$", size.lower())
+    if match is None:
+        raise ValueError("invalid size: {}".format(size))
+    return int(float(match.group(1)) *
+        1024 ** "_kmgtp".index(match.group(2) or "_"))
+
+def plan_chunks(read_count, index_bytes, worker_cores, worker_memory,
+    workers=1, target_chunk_seconds=1800,
+    reads_per_core_second=DEFAULT_READS_PER_CORE_SECOND,
+    index_bytes_per_second=DEFAULT_INDEX_BYTES_PER_SECOND,
+    bytes_per_read=DEFAULT_BYTES_PER_READ, reads_per_chunk=None):
+    """
+    Plan the alignment of read_count reads against an index of index_bytes
+    bytes, on workers workers each with worker_cores cores and worker_memory
+    bytes of memory. Aim for chunks that take target_chunk_seconds to align.
+    Returns a ChunkPlan.
+
+    If reads_per_chunk is given, that chunk size is used instead of the
+    planned one, and only the job resources are planned.
+
+    >>> plan = plan_chunks(10 ** 8, 20 * 1024 ** 3, 32, 256 * 1024 ** 3, 10)
+    >>> plan.jobs_per_worker, plan.cores, plan.chunk_count
+    (9, 3, 186)
+    >>> plan_chunks(1000, 1024 ** 3, 32, 64 * 1024 ** 3).chunk_count
+    1
+
+    """
+
+    # How much memory does each alignment job need, and how many fit at once?
+    memory = min(int(index_bytes * INDEX_MEMORY_FACTOR) + BASE_MEMORY,
+        worker_memory)
+    jobs_per_worker = max(1, min(worker_cores, worker_memory // memory))
+    cores = max(1, worker_cores // jobs_per_worker)
+
+    # How fast does each job go, and how long does it spend on the index?
+    reads_per_second = float(reads_per_core_second * cores)
+    index_seconds = index_bytes / float(index_bytes_per_second)
+
+    if reads_per_chunk is None:
+        # Aim for the target time, but make chunks long enough to amortize the
+        # index.
+        fewest_reads = index_seconds * INDEX_AMORTIZATION * reads_per_second
+        reads_per_chunk = max(target_chunk_seconds * reads_per_second,
+            fewest_reads)
+
+        # Make enough chunks to keep all the workers busy, if the amortization
+        # limit allows.
+        slots = workers * jobs_per_worker
+        if read_count < reads_per_chunk * slots:
+            reads_per_chunk = max(math.ceil(read_count / float(slots)),
+                fewest_reads)
+
+        reads_per_chunk = int(math.ceil(min(reads_per_chunk, read_count)))
+    reads_per_chunk = max(1, reads_per_chunk)
+
+    chunk_count = max(1, int(math.ceil(read_count / float(reads_per_chunk))))
+    disk = (2 * index_bytes + CHUNK_DISK_FACTOR * reads_per_chunk *
+        bytes_per_read + BASE_DISK)
+
+    return ChunkPlan(read_count=read_count, chunk_count=chunk_count,
+        reads_per_chunk=reads_per_chunk, cores=cores, memory=memory,
+        disk=int(disk), jobs_per_worker=jobs_per_worker,
+        chunk_seconds=reads_per_chunk / reads_per_second,
+        index_seconds=index_seconds)
+
+def describe_plan(plan):
+    """
+    Return a human-readable one-line description of a ChunkPlan.
+
+    """
+
+    return ("{} reads in {} chunks of {} reads; each chunk job gets {} cores, "
+        "{:.1f} GB memory and {:.1f} GB disk, {} jobs per worker; about {:.0f} "
+        "seconds aligning and {:.0f} seconds unpacking the index per "
+        "chunk").format(plan.read_count, plan.chunk_count,
+        plan.reads_per_chunk, plan.cores, plan.memory / 1024.0 ** 3,
+        plan.disk / 1024.0 ** 3, plan.jobs_per_worker, plan.chunk_seconds,
+        plan.index_seconds)
@@ -0,0 +1,188 @@
+"""
+fastq_split.py: split FASTQ files into chunks without parsing reads.
+
+Records are taken to be the usual 4 lines each (no wrapped sequences), so the
+splitter only ever needs to count newlines. Input is read in large blocks, the
+newlines are counted in C with str.count, and each chunk is written out as
+slices of those blocks, so no per-read Python objects are ever built.
+"""
+
+import gzip
+import os
+
+# How much input should we read at a time?
+BUFFER_SIZE = 4 * 1024 * 1024
+
+# What do gzip files start with?
+GZIP_MAGIC = "\x1f\x8b"
+
+def open_fastq(path):
+    """
+    Open the given FASTQ file for binary reading, decompressing it on the fly if
+    it is gzipped. Compression is detected from the file contents, not the
+    name.
+
+    """
+
+    with open(path, "rb") as handle:
+        magic = handle.read(len(GZIP_MAGIC))
+
+    if magic == GZIP_MAGIC:
+        return gzip.open(path, "rb")
+    return open(path, "rb")
+
+def _nth_newline(buffer, n, start=0, step=65536):
+    """
+    Return the index just past the nth newline in buffer at or after start, or
+    None if there are fewer than n. Newlines are counted a step at a time with
+    str.count, so only the last few lines are looked for one by one.
+
+    >>> _nth_newline("a\\nb\\nc\\n", 2)
+    4
+    >>> _nth_newline("a\\nb\\n", 3) is None
+    True
+
+    """
+
+    if n <= 0:
+        return start
+
+    # Skip whole steps that don't have enough newlines to get us there
+    position = start
+    while position < len(buffer):
+        count = buffer.count("\n", position, position + step)
+        if count >= n:
+            break
+        n -= count
+        position += step
+    else:
+        return None
+
+    # Then find the remaining newlines in the step that has them
+    for _ in xrange(n):
+        position = buffer.index("\n", position) + 1
+    return position
+
+def split_fastq(in_handle, chunk_path, reads_per_chunk=None,
+    bytes_per_chunk=None, buffer_size=BUFFER_SIZE):
+    """
+    Split the FASTQ data read from in_handle into chunk files. Each chunk gets
+    reads_per_chunk reads, or the fewest whole reads that make it at least
+    bytes_per_chunk bytes, whichever comes first. With neither limit there is
+    just one chunk.
+
+    chunk_path is a function from a chunk number, counting from 1, to the path
+    to write that chunk to.
+
+    This is a generator, yielding (chunk number, path, read count) for each
+    chunk as soon as it has been written and closed, so chunks can be sent on
+    while the rest of the input is still being split.
+
+    """
+
+    # How many lines are in each chunk at most?
+    max_lines = 4 * reads_per_chunk if reads_per_chunk else None
+
+    chunk_number = 0
+    out_handle = None
+    chunk_lines = 0
+    chunk_bytes = 0
+    last_byte = None
+
+    def finish_chunk():
+        """
+        Close the current chunk and describe it.
+        """
+        if chunk_lines % 4 != 0:
+            raise RuntimeError("FASTQ input ends partway through a record "
+                "in chunk {}".format(chunk_number))
+        out_handle.close()
+        return (chunk_number, chunk_path(chunk_number), chunk_lines // 4)
+
+    while True:
+        buffer = in_handle.read(buffer_size)
+        if not buffer:
+            break
+        last_byte = buffer[-1]
+
+        position = 0
+        while position < len(buffer):
+            if out_handle is None:
+                # Start a new chunk
+                if buffer[position] != "@":
+                    raise RuntimeError("FASTQ record does not start with @ "
+                        "at start of chunk {}".format(chunk_number + 1))
+                chunk_number += 1
+                out_handle = open(chunk_path(chunk_number), "wb")
+                chunk_lines = 0
+                chunk_bytes = 0
+
+            # How many more lines can we put in this chunk?
+            lines_wanted = None
+            if max_lines is not None:
+                lines_wanted = max_lines - chunk_lines
+            if (bytes_per_chunk is not None and
+                chunk_bytes + len(buffer) - position >= bytes_per_chunk):
+                # The chunk gets big enough in this buffer. Run to the end of
+                # the record we would be in at that size.
+                size_end = position + max(bytes_per_chunk - chunk_bytes, 1)
+                lines = chunk_lines + buffer.count("\n", position, size_end)
+                if buffer[size_end - 1] != "\n":
+                    # We stopped partway through a line
+                    lines += 1
+                lines = max(4, lines + (-lines % 4))
+                if lines_wanted is None or lines - chunk_lines < lines_wanted:
+                    lines_wanted = lines - chunk_lines
+
+            end = None
+            if lines_wanted is not None:
+                end = _nth_newline(buffer, lines_wanted, position)
+
+            if end is None:
+                # The whole rest of the buffer goes in this chunk
+                out_handle.write(buffer[position:])
+                chunk_lines += buffer.count("\n", position)
+                chunk_bytes += len(buffer) - position
+                position = len(buffer)
+            else:
+                out_handle.write(buffer[position:end])
+                chunk_lines += lines_wanted
+                chunk_bytes += end - position
+                position = end
+                yield finish_chunk()
+                out_handle = None
+
+    if out_handle is not None:
+        if last_byte != "\n":
+            # Tolerate a missing newline at the very end
+            out_handle.write("\n")
+            chunk_lines += 1
+        yield finish_chunk()
+
+def estimate_read_count(path, sample_bytes=BUFFER_SIZE * 4):
+    """
+    Estimate the number of reads in the given FASTQ file, which may be gzipped,
+    from the average size of the reads in its first sample_bytes of FASTQ data.
+    Small files are counted exactly.
+
+    """
+
+    with open_fastq(path) as handle:
+        sample = handle.read(sample_bytes)
+        at_end = not handle.read(1)
+        if hasattr(handle, "fileobj"):
+            # This is gzip. How much compressed data gave us the sample?
+            compressed_bytes = handle.fileobj.tell()
+        else:
+            compressed_bytes = len(sample)
+
+    if not sample:
+        return 0
+
+    read_count = (sample.count("\n") + (sample[-1] != "\n")) // 4
+    if at_end or read_count == 0:
+        return read_count
+
+    # Scale up by how much of the file the sample covered
+    return int(round(read_count * float(os.path.getsize(path)) /
+        max(compressed_bytes, 1)))
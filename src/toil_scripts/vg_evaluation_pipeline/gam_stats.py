@@ -0,0 +1,416 @@
+"""
+gam_stats.py: compute alignment statistics for vg GAM files.
+
+Reads the JSON dump of a GAM (as produced by `vg view -aj`) as a stream, and
+tallies read, mapping, indel and substitution statistics against the node
+sequences of the graph the reads were aligned to.
+
+Edits are processed in batches: a cheap pass over the parsed JSON collects the
+coordinates of every edit into flat arrays, and reference N counts for all the
+edits in the batch are then looked up at once in the N prefix-sum table of a
+NodeSequences store, instead of slicing and scanning each node sequence in
+Python.
+
+Stats for different chunks of reads can be saved in a compact mergeable form
+with dump_partial_stats, and combined into the stats for all the reads with
+merge_stats.
+"""
+
+import array
+import collections
+import gc
+import itertools
+import json
+from contextlib import contextmanager
+
+import numpy
+
+try:
+    # ujson decodes alignment JSON about three times as fast as the json module
+    import ujson
+    have_ujson = True
+except ImportError:
+    have_ujson = False
+    pass
+
+# How many alignments should we parse and tally at once?
+DEFAULT_BATCH_SIZE = 10000
+
+# Which stats are plain counts, and which are histograms?
+TOTALS = ["total_reads", "total_mapped", "total_multimapped"]
+HISTOGRAMS = ["mapped_lengths", "unmapped_lengths", "aligned_lengths",
+    "primary_scores", "primary_mismatches", "primary_indels",
+    "primary_substitutions", "secondary_scores", "secondary_mismatches",
+    "secondary_indels", "secondary_substitutions"]
+
+@contextmanager
+def gc_paused():
+    """
+    Pause the cyclic garbage collector for the duration of the context.
+
+    Parsed alignment JSON is nothing but acyclic dicts and lists, but holding a
+    batch of it alive makes the collector rescan the whole batch over and over,
+    which costs more than parsing it in the first place.
+
+    """
+
+    was_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if was_enabled:
+            gc.enable()
+
+def empty_stats(run_time=None):
+    """
+    Return a fresh stats dict, with all the counts at 0 and all the histograms
+    empty.
+
+    """
+
+    return {
+        "total_reads": 0,
+        "total_mapped": 0,
+        "total_multimapped": 0,
+        "mapped_lengths": collections.Counter(),
+        "unmapped_lengths": collections.Counter(),
+        "aligned_lengths": collections.Counter(),
+        "primary_scores": collections.Counter(),
+        "primary_mismatches": collections.Counter(),
+        "primary_indels": collections.Counter(),
+        "primary_substitutions": collections.Counter(),
+        "secondary_scores": collections.Counter(),
+        "secondary_mismatches": collections.Counter(),
+        "secondary_indels": collections.Counter(),
+        "secondary_substitutions": collections.Counter(),
+        "run_time": run_time
+    }
+
+class EditBatch(object):
+    """
+    Flat tables of the mappings and edits in a batch of alignments, filled in
+    as the alignments are walked and then tallied with array operations.
+
+    Only the values that need the JSON are collected in Python; where each edit
+    starts in its mapping's reference sequence, and which edits could be soft
+    clips, are worked out from the tables afterwards.
+
+    """
+
+    def __init__(self):
+        """
+        Make a new empty EditBatch.
+
+        """
+
+        # For each mapping: alignment number in the batch, whether it is on a
+        # node, node ID, offset on the node, whether it is reversed, and the
+        # index of its first edit.
+        self.mappings = array.array("l")
+        # For each edit: index of its mapping, from length, to length, and
+        # whether it has a sequence.
+        self.edits = array.array("l")
+        # Indexes of edits that are first in the first mapping or last in the
+        # last mapping of their alignment.
+        self.end_edits = array.array("l")
+
+        # How many mappings and edits have we seen?
+        self.mapping_count = 0
+        self.edit_count = 0
+
+    def add_alignment(self, alignment_number, alignment):
+        """
+        Record all the mappings and edits of the given parsed alignment.
+
+        """
+
+        # Get the mappings
+        mappings = alignment.get("path", {}).get("mapping", [])
+
+        # Bind the methods once, since this is the hot loop
+        add_mapping = self.mappings.extend
+        add_edit = self.edits.extend
+
+        for mapping_number, mapping in enumerate(mappings):
+            position = mapping.get("position", {})
+            has_node = "node_id" in position
+
+            add_mapping((alignment_number, has_node,
+                position["node_id"] if has_node else 0,
+                position.get("offset", 0) if has_node else 0,
+                mapping.get("is_reverse", False), self.edit_count))
+
+            # Pull out the edits
+            edits = mapping.get("edit", [])
+
+            if len(edits) > 0:
+                if mapping_number == 0:
+                    # The first edit of the read may be a soft clip
+                    self.end_edits.append(self.edit_count)
+                if mapping_number == len(mappings) - 1:
+                    # And so may the last
+                    self.end_edits.append(self.edit_count + len(edits) - 1)
+
+            for edit in edits:
+                add_edit((self.mapping_count, edit.get("from_length", 0),
+                    edit.get("to_length", 0), "sequence" in edit))
+
+            self.mapping_count += 1
+            self.edit_count += len(edits)
+
+    def tally(self, node_sequences, alignment_count):
+        """
+        Total up matches, indels, substitutions and aligned length for each of
+        the first alignment_count alignments in the batch, and return them as
+        four lists.
+
+        """
+
+        mappings = numpy.frombuffer(self.mappings, dtype=numpy.int_).astype(
+            numpy.int64).reshape(-1, 6)
+        edits = numpy.frombuffer(self.edits, dtype=numpy.int_).astype(
+            numpy.int64).reshape(-1, 4)
+
+        # Look up each edit's mapping
+        edit_mappings = mappings[edits[:, 0]]
+
+        alignment_numbers = edit_mappings[:, 0]
+        has_node = edit_mappings[:, 1].astype(bool)
+        from_lengths = edits[:, 1]
+        to_lengths = edits[:, 2]
+        has_sequence = edits[:, 3].astype(bool)
+
+        # An edit may be a soft clip if it's either the first edit in the first
+        # mapping, or the last edit in the last mapping.
+        may_be_soft_clip = numpy.zeros(len(edits), dtype=bool)
+        may_be_soft_clip[numpy.frombuffer(self.end_edits,
+            dtype=numpy.int_)] = True
+
+        # Each edit starts in its mapping's reference sequence where the from
+        # lengths of the mapping's earlier edits add up to.
+        preceding_lengths = numpy.cumsum(from_lengths) - from_lengths
+        starts = preceding_lengths - preceding_lengths[
+            numpy.minimum(edit_mappings[:, 5], max(len(edits) - 1, 0))]
+
+        # Count up the Ns in the reference sequence for each edit. Edits not on
+        # a node are against an empty reference and have none.
+        reference_N_counts = numpy.zeros(len(edits), dtype=numpy.int64)
+        if has_node.any():
+            reference_N_counts[has_node] = node_sequences.count_mapped_Ns(
+                edit_mappings[has_node, 2], edit_mappings[has_node, 3],
+                edit_mappings[has_node, 4].astype(bool), starts[has_node],
+                from_lengths[has_node])
+
+        # Edits with equal from and to lengths are aligned (not indels or soft
+        # clips). Without a sequence they are perfect matches; with one they
+        # are SNPs or MNPs.
+        equal_length = from_lengths == to_lengths
+        perfect_match = equal_length & ~has_sequence
+        substitution = equal_length & has_sequence
+
+        # We take as substituted all the bases except those opposite reference
+        # Ns, and pull those Ns out of the aligned length as well. We still
+        # count query Ns as "aligned" when not in indels.
+        matches = numpy.where(perfect_match, from_lengths, 0)
+        substitutions = numpy.where(substitution,
+            to_lengths - reference_N_counts, 0)
+        aligned_lengths = (numpy.where(equal_length, to_lengths, 0) -
+            numpy.where(substitution, reference_N_counts, 0))
+
+        # Only count indels that aren't on the very end of a read, and aren't
+        # against an N in the reference.
+        indels = (~may_be_soft_clip & ~equal_length &
+            (reference_N_counts == 0)).astype(numpy.int64)
+
+        def per_alignment(values):
+            # Sum up the per-edit values for each alignment
+            return numpy.bincount(alignment_numbers, weights=values,
+                minlength=alignment_count).astype(numpy.int64).tolist()
+
+        return (per_alignment(matches), per_alignment(indels),
+            per_alignment(substitutions), per_alignment(aligned_lengths))
+
+def _parsed_batches(lines, batch_size):
+    """
+    Yield lists of up to batch_size parsed JSON objects from the given iterator
+    over lines.
+
+    Decoding takes about half the time of computing the stats, so each batch is
+    decoded as a single JSON array, with ujson if it is available.
+
+    """
+
+    decode = ujson.loads if have_ujson else json.loads
+
+    while True:
+        batch = list(itertools.islice(lines, batch_size))
+        if len(batch) == 0:
+            break
+        yield decode("[" + ",".join(batch) + "]")
+
+def add_batch_stats(stats, alignments, node_sequences, last_alignment=None):
+    """
+    Add the given batch of parsed alignments into the given stats dict, using
+    the given NodeSequences to discount reference Ns.
+
+    last_alignment is the alignment that came right before the batch, if any.
+    Returns the last alignment in the batch, to pass along with the next batch.
+
+    """
+
+    # Collect all the edits of the aligned alignments
+    edits = EditBatch()
+    for alignment_number, alignment in enumerate(alignments):
+        if alignment.has_key("score"):
+            edits.add_alignment(alignment_number, alignment)
+
+    matches, indels, substitutions, aligned_lengths = edits.tally(
+        node_sequences, len(alignments))
+
+    for alignment_number, alignment in enumerate(alignments):
+        # How long is this read?
+        length = len(alignment["sequence"])
+
+        if alignment.has_key("score"):
+            # This alignment is aligned.
+            # Grab its score
+            score = alignment["score"]
+
+            # Calculate mismatches as what's not perfect matches
+            mismatches = length - matches[alignment_number]
+
+            if alignment.get("is_secondary", False):
+                # It's a multimapping. We can have max 1 per read, so it's a
+                # multimapped read.
+
+                if (last_alignment is None or
+                    last_alignment.get("name") != alignment.get("name") or
+                    last_alignment.get("is_secondary", False)):
+
+                    # This is a secondary alignment without a corresponding
+                    # primary alignment (which would have to be right before it
+                    # given the way vg dumps buffers
+                    raise RuntimeError("{} secondary alignment comes after "
+                        "alignment of {} instead of corresponding primary "
+                        "alignment\n".format(alignment.get("name"),
+                        last_alignment.get("name") if last_alignment is not None
+                        else "nothing"))
+
+                # Log its stats as multimapped
+                stats["total_multimapped"] += 1
+                stats["secondary_scores"][score] += 1
+                stats["secondary_mismatches"][mismatches] += 1
+                stats["secondary_indels"][indels[alignment_number]] += 1
+                stats["secondary_substitutions"][
+                    substitutions[alignment_number]] += 1
+            else:
+                # Log its stats as primary. We'll get exactly one of these per
+                # read with any mappings.
+                stats["total_mapped"] += 1
+                stats["primary_scores"][score] += 1
+                stats["primary_mismatches"][mismatches] += 1
+                stats["primary_indels"][indels[alignment_number]] += 1
+                stats["primary_substitutions"][
+                    substitutions[alignment_number]] += 1
+
+                # Record that a read of this length was mapped
+                stats["mapped_lengths"][length] += 1
+
+                # And that a read with this many aligned primary bases was found
+                stats["aligned_lengths"][aligned_lengths[alignment_number]] += 1
+
+                # We won't see an unaligned primary alignment for this read, so
+                # count the read
+                stats["total_reads"] += 1
+
+        elif not alignment.get("is_secondary", False):
+            # We have an unmapped primary "alignment"
+
+            # Count the read by its primary alignment
+            stats["total_reads"] += 1
+
+            # Record that an unmapped read has this length
+            stats["unmapped_lengths"][length] += 1
+
+        # Save the alignment for checking for wayward secondaries
+        last_alignment = alignment
+
+    return last_alignment
+
+def alignment_stats(alignment_lines, node_sequences,
+    batch_size=DEFAULT_BATCH_SIZE, run_time=None):
+    """
+    Compute the stats dict for the alignments in the given iterable of lines of
+    vg alignment JSON, as produced by `vg view -aj`, using the given
+    NodeSequences to discount reference Ns.
+
+    Secondary alignments must come right after their corresponding primary
+    alignments, as vg dumps them.
+
+    """
+
+    stats = empty_stats(run_time)
+
+    # Remember the last alignment for checking for wayward secondaries
+    last_alignment = None
+
+    with gc_paused():
+        for alignments in _parsed_batches(iter(alignment_lines), batch_size):
+            last_alignment = add_batch_stats(stats, alignments,
+                node_sequences, last_alignment)
+
+    return stats
+
+def merge_stats(stats_list):
+    """
+    Combine stats dicts for disjoint sets of reads into the stats dict for all
+    of them. Run times are added up, if there are any.
+
+    """
+
+    merged = empty_stats()
+
+    for stats in stats_list:
+        for name in TOTALS:
+            merged[name] += stats[name]
+        for name in HISTOGRAMS:
+            merged[name].update(stats[name])
+        if stats["run_time"] is not None:
+            merged["run_time"] = (merged["run_time"] or 0) + stats["run_time"]
+
+    return merged
+
+def dump_partial_stats(stats, handle):
+    """
+    Save the given stats dict to the given file handle in a compact form that
+    load_partial_stats can read back exactly, for merging later.
+
+    Plain JSON would turn the numeric histogram keys into strings, so
+    histograms are saved as sorted lists of [value, count] pairs instead.
+
+    """
+
+    partial = dict((name, stats[name]) for name in TOTALS)
+    for name in HISTOGRAMS:
+        partial[name] = sorted(stats[name].iteritems())
+    partial["run_time"] = stats["run_time"]
+
+    json.dump(partial, handle, separators=(",", ":"))
+
+def load_partial_stats(handle):
+    """
+    Load a stats dict saved by dump_partial_stats from the given file handle.
+
+    """
+
+    partial = json.load(handle)
+
+    stats = empty_stats(partial["run_time"])
+    for name in TOTALS:
+        stats[name] = partial[name]
+    for name in HISTOGRAMS:
+        for value, count in partial[name]:
+            stats[name][value] = count
+
+    return stats
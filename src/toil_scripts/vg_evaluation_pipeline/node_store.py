@@ -0,0 +1,435 @@
+"""
+node_store.py: compact, memory-mappable store of vg graph node sequences.
+
+All the node sequences of a graph live in one concatenated buffer. Nodes are
+found through a sorted array of node IDs with parallel arrays of offsets into
+the buffer and sequence lengths. Counting the Ns in any slice of the buffer
+takes two lookups in a two-level N prefix-sum table: a running total at the
+start of every block of BLOCK_SIZE bases, plus a one-byte count within the
+block for every base.
+
+A store can be built in memory, or written once into a directory (normally
+next to the xg/gcsa indexes) and then memory-mapped by every job that needs it,
+so no job has to parse the graph or hold its sequences as Python strings.
+"""
+
+import array
+import json
+import os
+
+import numpy
+
+# How many bases does each block of the N prefix-sum table cover? Counts
+# within a block have to fit in a byte.
+BLOCK_SIZE = 256
+
+# How many bases should we process at once when building the N table on disk?
+# Must be a multiple of BLOCK_SIZE.
+BUILD_CHUNK_SIZE = BLOCK_SIZE * 65536
+
+# How many nodes should we buffer in memory before flushing them to disk?
+NODE_FLUSH_COUNT = 1000000
+
+# What files make up a store directory?
+SEQUENCE_FILE = "sequences.bin"
+NODE_IDS_FILE = "node_ids.npy"
+OFFSETS_FILE = "offsets.npy"
+LENGTHS_FILE = "lengths.npy"
+N_BLOCKS_FILE = "n_blocks.npy"
+N_LOCAL_FILE = "n_local.npy"
+
+def _fill_n_tables(sequence, n_blocks, n_local, chunk_size=None):
+    """
+    Fill in the two-level N prefix-sum table for the given uint8 sequence
+    array. n_blocks must have one entry per block of BLOCK_SIZE positions in
+    len(sequence) + 1 positions, and n_local one entry per position.
+
+    n_blocks[b] gets the number of Ns before block b, and n_local[i] the number
+    of Ns between the start of i's block and i. The number of Ns in
+    sequence[0:i] is then n_blocks[i // BLOCK_SIZE] + n_local[i].
+
+    Works through the sequence chunk_size positions at a time, defaulting to
+    BUILD_CHUNK_SIZE.
+
+    """
+
+    if chunk_size is None:
+        chunk_size = BUILD_CHUNK_SIZE
+
+    # Total Ns before the current chunk
+    total = 0
+
+    # We have one more position than bases, for the end of the sequence.
+    positions = len(sequence) + 1
+
+    for start in xrange(0, positions, chunk_size):
+        end = min(start + chunk_size, positions)
+
+        # Mark the Ns in the chunk, padding out to a whole number of blocks.
+        # The position past the end of the sequence is never an N.
+        block_count = (end - start + BLOCK_SIZE - 1) // BLOCK_SIZE
+        is_n = numpy.zeros(block_count * BLOCK_SIZE, dtype=numpy.uint8)
+        bases = min(end, len(sequence)) - start
+        if bases > 0:
+            is_n[:bases] = sequence[start:start + bases] == ord("N")
+        is_n = is_n.reshape(block_count, BLOCK_SIZE)
+
+        # Ns before each position within its block
+        local = numpy.cumsum(is_n, axis=1, dtype=numpy.uint16) - is_n
+        n_local[start:end] = local.reshape(-1)[:end - start]
+
+        # Ns before each block
+        block_totals = is_n.sum(axis=1, dtype=numpy.int64)
+        first_block = start // BLOCK_SIZE
+        n_blocks[first_block:first_block + block_count] = (total +
+            numpy.cumsum(block_totals) - block_totals)
+        total += int(block_totals.sum())
+
+def _block_count(sequence_length):
+    """
+    Return the number of blocks in the N table for a sequence of the given
+    length.
+
+    >>> _block_count(0)
+    1
+    >>> _block_count(BLOCK_SIZE)
+    2
+    """
+
+    return sequence_length // BLOCK_SIZE + 1
+
+def _parse_nodes(graph_lines):
+    """
+    Yield (node ID, sequence) pairs from an iterable of lines of vg graph JSON,
+    as produced by `vg view -j`.
+
+    """
+
+    for line in graph_lines:
+        # Parse the graph chunk JSON
+        graph_chunk = json.loads(line)
+        for node_dict in graph_chunk.get("node", []):
+            # We want to crash if a node exists for which the id or the
+            # sequence isn't defined.
+            sequence = node_dict["sequence"]
+            if isinstance(sequence, unicode):
+                sequence = sequence.encode("ascii", "replace")
+            yield node_dict["id"], sequence
+
+def _sort_nodes(node_ids, offsets, lengths):
+    """
+    Sort parallel arrays of node IDs, offsets and lengths by node ID. If a node
+    ID appears more than once, the last occurrence wins. Returns the new
+    arrays; if they were already sorted and unique, returns them unchanged.
+
+    """
+
+    if len(node_ids) < 2 or (node_ids[1:] > node_ids[:-1]).all():
+        # vg emits nodes in ID order, so this is the usual case, and we don't
+        # need to copy anything.
+        return node_ids, offsets, lengths
+
+    # Sort by node ID, keeping the original order among duplicates
+    order = numpy.argsort(node_ids, kind="mergesort")
+    node_ids = node_ids[order]
+
+    # Keep only the last occurrence of each ID
+    keep = numpy.ones(len(node_ids), dtype=bool)
+    keep[:-1] = node_ids[1:] != node_ids[:-1]
+
+    return node_ids[keep], offsets[order][keep], lengths[order][keep]
+
+class NodeSequences(object):
+    """
+    Holds the sequences of all the nodes in a graph in one concatenated buffer,
+    along with a sorted array of node IDs, the offset and length of each node's
+    sequence in the buffer, and an N prefix-sum table over the buffer.
+
+    The arrays may be in memory or memory-mapped from a store directory.
+
+    """
+
+    def __init__(self, node_ids, offsets, lengths, sequence, n_blocks=None,
+        n_local=None):
+        """
+        Make a new NodeSequences from parallel arrays of node IDs, offsets
+        into the sequence buffer and lengths, and the buffer itself as a string
+        or uint8 array. Node IDs must be sorted and unique.
+
+        If the N table arrays are not given, they are computed.
+
+        """
+
+        self.node_ids = node_ids
+        self.offsets = offsets
+        self.lengths = lengths
+        if isinstance(sequence, str):
+            sequence = numpy.frombuffer(sequence, dtype=numpy.uint8)
+        self.sequence_buffer = sequence
+
+        if n_blocks is None or n_local is None:
+            n_blocks = numpy.zeros(_block_count(len(sequence)),
+                dtype=numpy.int64)
+            n_local = numpy.zeros(len(sequence) + 1, dtype=numpy.uint8)
+            _fill_n_tables(sequence, n_blocks, n_local)
+
+        self.n_blocks = n_blocks
+        self.n_local = n_local
+
+    @classmethod
+    def from_graph_json(cls, graph_lines):
+        """
+        Build a NodeSequences in memory from an iterable of lines of vg graph
+        JSON, as produced by `vg view -j`.
+
+        """
+
+        node_ids = array.array("l")
+        offsets = array.array("l")
+        lengths = array.array("l")
+        sequences = []
+
+        # Where will the next sequence start in the buffer?
+        next_offset = 0
+
+        for node_id, sequence in _parse_nodes(graph_lines):
+            node_ids.append(node_id)
+            offsets.append(next_offset)
+            lengths.append(len(sequence))
+            sequences.append(sequence)
+            next_offset += len(sequence)
+
+        node_ids, offsets, lengths = _sort_nodes(
+            numpy.array(node_ids, dtype=numpy.int64),
+            numpy.array(offsets, dtype=numpy.int64),
+            numpy.array(lengths, dtype=numpy.int64))
+
+        return cls(node_ids, offsets, lengths, "".join(sequences))
+
+    @classmethod
+    def build(cls, graph_lines, directory):
+        """
+        Build a store directory from an iterable of lines of vg graph JSON, as
+        produced by `vg view -j`, and return it loaded. Sequences are streamed
+        to disk as they are parsed, so memory use doesn't grow with the graph.
+
+        The directory must not already hold a store.
+
+        """
+
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+        sequence_path = os.path.join(directory, SEQUENCE_FILE)
+        # Raw node tables go here until we know how many nodes there are
+        raw_path = os.path.join(directory, "nodes.raw")
+
+        # Where will the next sequence start in the buffer?
+        next_offset = 0
+        node_count = 0
+
+        with open(sequence_path, "wb") as sequence_file, \
+            open(raw_path, "wb") as raw_file:
+
+            # Buffer up (ID, offset, length) triples
+            nodes = array.array("l")
+
+            for node_id, sequence in _parse_nodes(graph_lines):
+                sequence_file.write(sequence)
+                nodes.extend((node_id, next_offset, len(sequence)))
+                next_offset += len(sequence)
+                node_count += 1
+
+                if len(nodes) >= NODE_FLUSH_COUNT * 3:
+                    nodes.tofile(raw_file)
+                    nodes = array.array("l")
+
+            nodes.tofile(raw_file)
+
+        # Split the raw triples into the node tables
+        if node_count > 0:
+            raw = numpy.memmap(raw_path, dtype=numpy.int_, mode="r").reshape(
+                node_count, 3)
+        else:
+            raw = numpy.zeros((0, 3), dtype=numpy.int64)
+        node_ids, offsets, lengths = _sort_nodes(
+            raw[:, 0].astype(numpy.int64), raw[:, 1].astype(numpy.int64),
+            raw[:, 2].astype(numpy.int64))
+        numpy.save(os.path.join(directory, NODE_IDS_FILE), node_ids)
+        numpy.save(os.path.join(directory, OFFSETS_FILE), offsets)
+        numpy.save(os.path.join(directory, LENGTHS_FILE),
+            lengths.astype(numpy.uint32))
+        del raw, node_ids, offsets, lengths
+        os.unlink(raw_path)
+
+        # Now make the N table, straight into memory-mapped files
+        sequence = cls._map_sequence(sequence_path)
+        n_blocks = numpy.lib.format.open_memmap(
+            os.path.join(directory, N_BLOCKS_FILE), mode="w+",
+            dtype=numpy.int64, shape=(_block_count(len(sequence)),))
+        n_local = numpy.lib.format.open_memmap(
+            os.path.join(directory, N_LOCAL_FILE), mode="w+",
+            dtype=numpy.uint8, shape=(len(sequence) + 1,))
+        _fill_n_tables(sequence, n_blocks, n_local)
+        n_blocks.flush()
+        n_local.flush()
+        del n_blocks, n_local
+
+        return cls.load(directory)
+
+    @classmethod
+    def load(cls, directory):
+        """
+        Memory-map the store in the given directory. Only the pages actually
+        used get read.
+
+        """
+
+        def load_table(filename):
+            return numpy.load(os.path.join(directory, filename),
+                mmap_mode="r")
+
+        return cls(load_table(NODE_IDS_FILE), load_table(OFFSETS_FILE),
+            load_table(LENGTHS_FILE),
+            cls._map_sequence(os.path.join(directory, SEQUENCE_FILE)),
+            load_table(N_BLOCKS_FILE), load_table(N_LOCAL_FILE))
+
+    @staticmethod
+    def exists(directory):
+        """
+        Return True if the given directory holds a complete store.
+
+        """
+
+        return all(os.path.exists(os.path.join(directory, filename)) for
+            filename in [SEQUENCE_FILE, NODE_IDS_FILE, OFFSETS_FILE,
+            LENGTHS_FILE, N_BLOCKS_FILE, N_LOCAL_FILE])
+
+    @staticmethod
+    def _map_sequence(path):
+        """
+        Memory-map the sequence buffer file at the given path as a uint8 array.
+
+        """
+
+        if os.path.getsize(path) == 0:
+            # Can't mmap an empty file
+            return numpy.zeros(0, dtype=numpy.uint8)
+        return numpy.memmap(path, dtype=numpy.uint8, mode="r")
+
+    def __len__(self):
+        """
+        Return the number of distinct nodes stored.
+
+        """
+
+        return len(self.node_ids)
+
+    def find(self, node_ids):
+        """
+        Return the indexes into our arrays of each of the given node IDs.
+        Raises KeyError if any of them is not in the graph.
+
+        """
+
+        node_ids = numpy.asarray(node_ids, dtype=numpy.int64)
+        indexes = numpy.searchsorted(self.node_ids, node_ids)
+
+        # Anything past the end, or landing on a different ID, is missing
+        if len(self.node_ids) == 0:
+            missing = numpy.ones(len(node_ids), dtype=bool)
+        else:
+            clipped = numpy.minimum(indexes, len(self.node_ids) - 1)
+            missing = self.node_ids[clipped] != node_ids
+        if missing.any():
+            raise KeyError(int(node_ids[missing][0]))
+
+        return indexes
+
+    def n_prefix(self, positions):
+        """
+        Return the number of Ns before each of the given positions in the
+        sequence buffer.
+
+        """
+
+        positions = numpy.asarray(positions, dtype=numpy.int64)
+        return (self.n_blocks[positions // BLOCK_SIZE] +
+            self.n_local[positions])
+
+    def sequence(self, node_id):
+        """
+        Return the sequence of the node with the given ID.
+
+        """
+
+        index = self.find([node_id])[0]
+        offset = int(self.offsets[index])
+        return self.sequence_buffer[offset:offset +
+            int(self.lengths[index])].tostring()
+
+    def count_Ns(self, node_id, start=0, end=None):
+        """
+        Return the number of Ns in the given slice of the sequence of the node
+        with the given ID, in constant time. Follows slice semantics for
+        positive bounds.
+
+        """
+
+        index = self.find([node_id])[0]
+        offset = int(self.offsets[index])
+        length = int(self.lengths[index])
+        if end is None:
+            end = length
+        start = min(start, length)
+        end = max(min(end, length), start)
+        counts = self.n_prefix([offset + start, offset + end])
+        return int(counts[1] - counts[0])
+
+    def count_mapped_Ns(self, node_ids, node_offsets, is_reverse, starts,
+        lengths):
+        """
+        Count reference Ns under a batch of edits, all at once.
+
+        Each edit is described by the node it is on, the offset on that node at
+        which its mapping starts, whether the mapping is on the reverse strand,
+        the edit's start in the mapping's reference sequence, and the edit's
+        length along the reference. Parameters are parallel array-likes.
+
+        The mapping's reference sequence is the node sequence from the offset
+        onwards for forward mappings, and the reverse complement of the node
+        sequence up to and including the offset for reverse mappings. Edits
+        running off the end of the reference sequence are clipped, like string
+        slices would be.
+
+        Returns an array of N counts, one per edit.
+
+        """
+
+        indexes = self.find(node_ids)
+        node_starts = self.offsets[indexes].astype(numpy.int64)
+        node_lengths = self.lengths[indexes].astype(numpy.int64)
+
+        node_offsets = numpy.asarray(node_offsets, dtype=numpy.int64)
+        is_reverse = numpy.asarray(is_reverse, dtype=bool)
+        starts = numpy.asarray(starts, dtype=numpy.int64)
+        ends = starts + numpy.asarray(lengths, dtype=numpy.int64)
+
+        # How long is each mapping's reference sequence?
+        reference_lengths = numpy.where(is_reverse,
+            numpy.minimum(node_offsets + 1, node_lengths),
+            numpy.maximum(node_lengths - node_offsets, 0))
+
+        # Clip the edits to the reference sequence, like a slice would.
+        starts = numpy.minimum(starts, reference_lengths)
+        ends = numpy.minimum(ends, reference_lengths)
+
+        # Work out where each edit lands in the buffer. Reverse complementing
+        # doesn't move Ns anywhere but to the mirrored position.
+        forward_starts = node_starts + numpy.minimum(node_offsets, node_lengths)
+        buffer_starts = numpy.where(is_reverse,
+            node_starts + reference_lengths - ends, forward_starts + starts)
+        buffer_ends = numpy.where(is_reverse,
+            node_starts + reference_lengths - starts, forward_starts + ends)
+
+        return self.n_prefix(buffer_ends) - self.n_prefix(buffer_starts)
@@ -0,0 +1,24 @@
+def test_plan_covers_genome_in_balanced_jobs():
+    from toil_scripts.vg_evaluation_pipeline.call_plan import plan_calling, region_key
+    lengths = [249250621, 243199373, 198022430, 191154276, 180915260, 171115067, 159138663, 146364022, 141213431,
+               135534747, 135006516, 133851895, 115169878, 107349540, 102531392, 90354753, 81195210, 78077248,
+               59128983, 63025520, 48129895, 51304566, 155270560, 59373566]
+    contigs = zip([str(i) for i in xrange(1, 23)] + ['X', 'Y'], lengths)
+    window = 50000000
+    jobs = plan_calling(contigs, window, 16, 100 * 1024 ** 3, 4 * 1024 ** 3)
+    regions = sorted(region for job in jobs for region in job.regions)
+    # Every contig is called, all of it, exactly once, and the merge order is reference order
+    assert [region.order for region in regions] == range(len(regions))
+    for contig, length in contigs:
+        parts = [(region.start, region.end) for region in regions if region.contig == contig]
+        assert parts[0][0] == 0 and parts[-1][1] == length
+        assert all(a[1] == b[0] for a, b in zip(parts, parts[1:]))
+    assert len(set(region_key(region) for region in regions)) == len(regions)
+    # Jobs are balanced, and resources follow their bases
+    assert max(job.bases for job in jobs) <= window
+    assert min(job.bases for job in jobs) > window / 3
+    for job in jobs:
+        assert 1 <= job.cores <= 16
+        assert job.bases == sum(region.end - region.start for region in job.regions)
+    biggest, smallest = max(jobs, key=lambda job: job.bases), min(jobs, key=lambda job: job.bases)
+    assert biggest.memory > smallest.memory and biggest.cores > smallest.cores
@@ -0,0 +1,50 @@
+import os
+
+
+class _Options(object):
+    kmer_size = 16
+    sample_name = 'NA12877'
+
+
+def test_checkpoint_round_trip(tmpdir):
+    from toil_scripts.lib.toillib import FileIOStore
+    from toil_scripts.vg_evaluation_pipeline.checkpoint import (fingerprint, save_checkpoint, load_checkpoint,
+        checkpoint_key)
+    store = FileIOStore(str(tmpdir))
+    stage_fingerprint = fingerprint(_Options(), ['kmer_size', 'sample_name'])
+    assert load_checkpoint(store, 'alignment/NA12877_1', stage_fingerprint) == (False, None)
+
+    output = os.path.join(str(tmpdir), 'NA12877_1.gam')
+    with open(output, 'w') as f_out:
+        f_out.write('gam')
+    save_checkpoint(store, 'alignment/NA12877_1', stage_fingerprint, ['NA12877_1.gam'], {'reads': 10})
+    assert load_checkpoint(store, 'alignment/NA12877_1', stage_fingerprint) == (True, {'reads': 10})
+
+    # Different settings don't reuse the stage
+    other = _Options()
+    other.kmer_size = 24
+    assert not load_checkpoint(store, 'alignment/NA12877_1', fingerprint(other, ['kmer_size', 'sample_name']))[0]
+
+    # Nor does a stage whose outputs have gone missing, or whose manifest is damaged
+    os.unlink(output)
+    assert not load_checkpoint(store, 'alignment/NA12877_1', stage_fingerprint)[0]
+    with open(os.path.join(str(tmpdir), checkpoint_key('broken')), 'w') as f_out:
+        f_out.write('{"fingerprint": ')
+    assert load_checkpoint(store, 'broken', stage_fingerprint) == (False, None)
+
+
+def test_input_identity(tmpdir):
+    from toil_scripts.vg_evaluation_pipeline.checkpoint import fingerprint, file_identity
+    graph = os.path.join(str(tmpdir), 'graph.vg')
+    assert file_identity(graph) is None
+    with open(graph, 'w') as f_out:
+        f_out.write('graph')
+    options = _Options()
+    options.vg_graph = graph
+    options.vg_graph_identity = file_identity(graph)
+    before = fingerprint(options, ['vg_graph', 'vg_graph_identity'])
+    # An input replaced under the same name doesn't match the outputs made from the old one
+    with open(graph, 'w') as f_out:
+        f_out.write('bigger graph')
+    options.vg_graph_identity = file_identity(graph)
+    assert fingerprint(options, ['vg_graph', 'vg_graph_identity']) != before
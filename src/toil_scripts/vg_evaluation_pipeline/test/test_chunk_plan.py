@@ -0,0 +1,23 @@
+def test_chunks_amortize_index():
+    from toil_scripts.vg_evaluation_pipeline.chunk_plan import plan_chunks, INDEX_AMORTIZATION
+    # Lots of workers for not many reads: chunks stay big enough to be worth unpacking the index
+    plan = plan_chunks(10 ** 6, 10 * 1024 ** 3, 32, 64 * 1024 ** 3, workers=100)
+    assert plan.chunk_seconds >= INDEX_AMORTIZATION * plan.index_seconds
+    assert plan.chunk_count * plan.reads_per_chunk >= 10 ** 6
+    assert plan.memory <= 64 * 1024 ** 3
+    assert plan.cores * plan.jobs_per_worker <= 32
+
+
+def test_chunks_fill_workers():
+    from toil_scripts.vg_evaluation_pipeline.chunk_plan import plan_chunks
+    # A tiny index and plenty of reads: every job slot gets a chunk, within the target time
+    plan = plan_chunks(10 ** 7, 1024 ** 2, 16, 64 * 1024 ** 3, workers=4, target_chunk_seconds=3600)
+    assert plan.chunk_count >= 4 * plan.jobs_per_worker
+    assert plan.chunk_seconds <= 3600
+
+
+def test_fixed_chunk_size():
+    from toil_scripts.vg_evaluation_pipeline.chunk_plan import plan_chunks
+    plan = plan_chunks(100000, 1024 ** 3, 32, 100 * 1024 ** 3, reads_per_chunk=15034)
+    assert plan.reads_per_chunk == 15034
+    assert plan.chunk_count == 7
@@ -0,0 +1,82 @@
+import gzip
+import os
+import random
+
+
+def _fastq(read_count, seed=1):
+    rng = random.Random(seed)
+    records = []
+    for i in xrange(read_count):
+        length = rng.randint(1, 150)
+        sequence = ''.join(rng.choice('ACGTN') for _ in xrange(length))
+        # Qualities may start with @, which must not confuse the splitter
+        quality = '@' + ''.join(rng.choice('@ABCDEFGHIJ#') for _ in xrange(length - 1))
+        records.append('@read{}\n{}\n+\n{}\n'.format(i, sequence, quality))
+    return records
+
+
+def _split(tmpdir, path, **kwargs):
+    from toil_scripts.vg_evaluation_pipeline.fastq_split import open_fastq, split_fastq
+    chunk_path = lambda chunk_number: os.path.join(str(tmpdir), 'group_{}.fq'.format(chunk_number))
+    with open_fastq(path) as handle:
+        chunks = list(split_fastq(handle, chunk_path, **kwargs))
+    contents = []
+    for chunk_number, (number, chunk_file, read_count) in enumerate(chunks):
+        assert number == chunk_number + 1
+        with open(chunk_file) as chunk_handle:
+            contents.append(chunk_handle.read())
+        assert contents[-1].count('\n') == 4 * read_count
+    return chunks, contents
+
+
+def test_split_by_reads(tmpdir):
+    records = _fastq(1000)
+    path = os.path.join(str(tmpdir), 'input.fq.gz')
+    with gzip.open(path, 'wb') as handle:
+        handle.write(''.join(records))
+    # A small buffer makes records straddle buffer boundaries
+    chunks, contents = _split(tmpdir, path, reads_per_chunk=300, buffer_size=97)
+    assert [read_count for _, _, read_count in chunks] == [300, 300, 300, 100]
+    assert ''.join(contents) == ''.join(records)
+    assert contents[1] == ''.join(records[300:600])
+
+
+def test_split_by_bytes(tmpdir):
+    records = _fastq(1000)
+    path = os.path.join(str(tmpdir), 'input.fq')
+    with open(path, 'wb') as handle:
+        # Leave off the last newline
+        handle.write(''.join(records)[:-1])
+    chunks, contents = _split(tmpdir, path, bytes_per_chunk=5000, buffer_size=1000)
+    assert ''.join(contents) == ''.join(records)
+    for chunk in contents[:-1]:
+        # Each chunk is the fewest whole reads reaching the target size
+        assert len(chunk) >= 5000
+        assert len(''.join(chunk.splitlines(True)[:-4])) < 5000
+
+
+def test_split_both_limits(tmpdir):
+    records = _fastq(200)
+    path = os.path.join(str(tmpdir), 'input.fq')
+    with open(path, 'wb') as handle:
+        handle.write(''.join(records))
+    chunks, contents = _split(tmpdir, path, reads_per_chunk=10, bytes_per_chunk=10 ** 9)
+    assert len(chunks) == 20
+    assert ''.join(contents) == ''.join(records)
+
+
+def test_estimate_read_count(tmpdir):
+    from toil_scripts.vg_evaluation_pipeline.fastq_split import estimate_read_count
+    # Reads all the same size, so the estimate from a sample is exact
+    records = ['@read{:05d}\n{}\n+\n{}\n'.format(i, 'A' * 100, 'I' * 100) for i in xrange(10000)]
+    path = os.path.join(str(tmpdir), 'input.fq')
+    with open(path, 'wb') as handle:
+        handle.write(''.join(records))
+    assert estimate_read_count(path) == 10000
+    assert estimate_read_count(path, sample_bytes=len(records[0]) * 10) == 10000
+    gz_path = path + '.gz'
+    with gzip.open(gz_path, 'wb') as handle:
+        handle.write(''.join(records))
+    assert estimate_read_count(gz_path) == 10000
+    # Compression ratio varies, so a sampled estimate from gzip is only close
+    assert abs(estimate_read_count(gz_path, sample_bytes=len(records[0]) * 1000) - 10000) < 2000
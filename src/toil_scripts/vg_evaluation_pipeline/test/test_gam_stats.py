@@ -0,0 +1,52 @@
+import json
+
+import pytest
+
+
+def test_alignment_stats_match_legacy():
+    from toil_scripts.vg_evaluation_pipeline.benchmark import (synthetic_graph, synthetic_alignments,
+                                                               legacy_alignment_stats)
+    from toil_scripts.vg_evaluation_pipeline.gam_stats import alignment_stats
+    from toil_scripts.vg_evaluation_pipeline.node_store import NodeSequences
+    graph_lines = synthetic_graph(200, 16)
+    alignment_lines = synthetic_alignments(2000, 200, 16)
+    expected = json.dumps(legacy_alignment_stats(alignment_lines, graph_lines))
+    node_sequences = NodeSequences.from_graph_json(graph_lines)
+    # Small batches make sure secondaries are checked across batch boundaries
+    for batch_size in [1, 7, 10000]:
+        assert json.dumps(alignment_stats(alignment_lines, node_sequences, batch_size=batch_size)) == expected
+
+
+def test_merged_chunk_stats_match_serial():
+    from StringIO import StringIO
+    from toil_scripts.vg_evaluation_pipeline.benchmark import synthetic_graph, synthetic_alignments
+    from toil_scripts.vg_evaluation_pipeline.gam_stats import (alignment_stats, merge_stats, dump_partial_stats,
+                                                               load_partial_stats)
+    from toil_scripts.vg_evaluation_pipeline.node_store import NodeSequences
+    node_sequences = NodeSequences.from_graph_json(synthetic_graph(200, 16))
+    alignment_lines = synthetic_alignments(2000, 200, 16)
+    # Split into chunks at read boundaries, the way the FASTQ is split
+    chunks = [[]]
+    for line in alignment_lines:
+        if len(chunks[-1]) >= 300 and not json.loads(line).get('is_secondary', False):
+            chunks.append([])
+        chunks[-1].append(line)
+    partials = []
+    for chunk_number, chunk in enumerate(chunks):
+        saved = StringIO()
+        dump_partial_stats(alignment_stats(chunk, node_sequences, run_time=chunk_number), saved)
+        partials.append(load_partial_stats(StringIO(saved.getvalue())))
+    merged = merge_stats(partials)
+    serial = alignment_stats(alignment_lines, node_sequences)
+    assert merged.pop('run_time') == sum(xrange(len(chunks)))
+    assert serial.pop('run_time') is None
+    assert merged == serial
+
+
+def test_wayward_secondary():
+    from toil_scripts.vg_evaluation_pipeline.gam_stats import alignment_stats
+    from toil_scripts.vg_evaluation_pipeline.node_store import NodeSequences
+    node_sequences = NodeSequences.from_graph_json([])
+    lines = [json.dumps({'name': 'a', 'sequence': 'A', 'score': 1, 'is_secondary': True})]
+    with pytest.raises(RuntimeError):
+        alignment_stats(lines, node_sequences)
@@ -0,0 +1,59 @@
+import json
+import os
+import random
+
+import pytest
+
+
+def _graph_lines():
+    rng = random.Random(3)
+    nodes = [{'id': node_id, 'sequence': ''.join(rng.choice('ACGTNN') for _ in xrange(rng.randint(0, 700)))}
+             for node_id in xrange(1, 60)]
+    # Out of order, and with a duplicate ID that should win over the first copy
+    rng.shuffle(nodes)
+    nodes.append({'id': nodes[0]['id'], 'sequence': 'NNNAC'})
+    return [json.dumps({'node': nodes[:30]}), json.dumps({'node': nodes[30:]})], nodes
+
+
+def test_count_mapped_ns():
+    from toil_scripts.vg_evaluation_pipeline.node_store import NodeSequences
+    node_sequences = NodeSequences.from_graph_json([json.dumps({'node': [{'id': 5, 'sequence': 'ANNCGN'},
+                                                                         {'id': 2, 'sequence': 'NA'}]})])
+    assert node_sequences.sequence(5) == 'ANNCGN'
+    assert node_sequences.sequence(2) == 'NA'
+    # Forward from offset 1 covers 'NNCGN'; reverse from offset 2 covers revcomp('ANN') == 'NNT'
+    counts = node_sequences.count_mapped_Ns([5, 5, 5, 5, 2], [1, 1, 2, 9, 0], [False, False, True, False, True],
+                                            [0, 3, 0, 0, 0], [2, 10, 2, 4, 5])
+    assert counts.tolist() == [2, 1, 2, 0, 1]
+    with pytest.raises(KeyError):
+        node_sequences.count_mapped_Ns([3], [0], [False], [0], [1])
+
+
+def test_build_and_load(tmpdir):
+    from toil_scripts.vg_evaluation_pipeline import node_store
+    from toil_scripts.vg_evaluation_pipeline.node_store import NodeSequences
+    graph_lines, nodes = _graph_lines()
+    expected = dict((node['id'], node['sequence']) for node in nodes)
+    directory = os.path.join(str(tmpdir), 'graph.vg.nodes')
+    # Use tiny chunks so the N table is built across many chunk boundaries
+    old_chunk_size = node_store.BUILD_CHUNK_SIZE
+    node_store.BUILD_CHUNK_SIZE = node_store.BLOCK_SIZE * 3
+    try:
+        NodeSequences.build(graph_lines, directory)
+    finally:
+        node_store.BUILD_CHUNK_SIZE = old_chunk_size
+    assert NodeSequences.exists(directory)
+    for node_sequences in [NodeSequences.load(directory), NodeSequences.from_graph_json(graph_lines)]:
+        assert len(node_sequences) == len(expected)
+        for node_id, sequence in expected.iteritems():
+            assert node_sequences.sequence(node_id) == sequence
+            assert node_sequences.count_Ns(node_id) == sequence.count('N')
+            assert node_sequences.count_Ns(node_id, 3, 300) == sequence[3:300].count('N')
+
+
+def test_empty_store(tmpdir):
+    from toil_scripts.vg_evaluation_pipeline.node_store import NodeSequences
+    node_sequences = NodeSequences.build([], os.path.join(str(tmpdir), 'empty'))
+    assert len(node_sequences) == 0
+    with pytest.raises(KeyError):
+        node_sequences.sequence(1)
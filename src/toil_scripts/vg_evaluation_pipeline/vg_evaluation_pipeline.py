@@ -24,14 +24,38 @@ import ntpath
 import dateutil.parser
 import getpass
 import pdb
-
-from Bio import SeqIO
+import multiprocessing.pool
 
 from toil.common import Toil
 from toil.job import Job
 from toil_scripts.lib.toillib import *
 
-from toil_scripts.lib.programs import docker_call
+from toil_scripts.lib.files import concatenate_files
+from toil_scripts.lib.instrumentation import instrumented, MetricsCollector, DockerProfileCollector
+from toil_scripts.lib.programs import (docker_call, docker_output_stream,
+    docker_pipeline)
+from toil_scripts.vg_evaluation_pipeline.call_plan import (plan_calling,
+    region_key)
+from toil_scripts.vg_evaluation_pipeline.checkpoint import (fingerprint,
+    file_identity, save_checkpoint, load_checkpoint)
+from toil_scripts.vg_evaluation_pipeline.chunk_plan import (plan_chunks,
+    describe_plan, parse_size, ChunkPlan, INDEX_GRAPH_RATIO)
+from toil_scripts.vg_evaluation_pipeline.fastq_split import (open_fastq,
+    split_fastq, estimate_read_count)
+from toil_scripts.vg_evaluation_pipeline.gam_stats import (alignment_stats,
+    merge_stats, dump_partial_stats, load_partial_stats)
+from toil_scripts.vg_evaluation_pipeline.node_store import NodeSequences
+
+# Which options do the outputs of each stage depend on? Each stage depends on
+# the ones before it too. Finished stages are only reused with the same values.
+# Input files count by their size and modification time as well as their names.
+INDEX_OPTIONS = ["vg_graph", "vg_graph_identity", "index_mode", "kmer_size",
+    "edge_max", "include_pruned", "include_primary", "index_codec"]
+SPLIT_OPTIONS = INDEX_OPTIONS + ["sample_reads", "sample_reads_identity",
+    "reads_per_chunk", "chunk_bytes", "workers", "worker_cores",
+    "worker_memory", "chunk_seconds", "align_rate"]
+ALIGN_OPTIONS = SPLIT_OPTIONS + ["sample_name"]
+CALL_OPTIONS = ALIGN_OPTIONS + ["path_name", "path_size", "call_overlap"]
 
 def parse_args(args):
     """
@@ -78,7 +102,8 @@ def parse_args(args):
     parser.add_argument("--kmer_size", type=int, default=16,
         help="size of kmers to use in indexing and mapping")
     parser.add_argument("--overwrite", default=False, action="store_true",
-        help="overwrite existing result files")
+        help="overwrite existing result files, instead of resuming from "
+        "stages finished by an earlier run")
     parser.add_argument("--restat", default=False, action="store_true",
         help="recompute and overwrite existing stats files")
     parser.add_argument("--reindex", default=False, action="store_true",
@@ -96,6 +121,49 @@ def parse_args(args):
     parser.add_argument("--call_opts", type=str,
         default="-r 0.0001 -b 0.4 -f 0.25 -d 10",
         help="options to pass to vg call. wrap in \"\"")
+    parser.add_argument("--reads_per_chunk", type=int,
+        help="number of reads to align in each chunk, instead of planning it")
+    parser.add_argument("--workers", type=int, default=1,
+        help="number of worker nodes to plan alignment chunks for")
+    parser.add_argument("--worker_cores", type=int, default=32,
+        help="number of cores on each worker node")
+    parser.add_argument("--worker_memory", type=parse_size, default="100G",
+        help="amount of memory on each worker node (ex 100G)")
+    parser.add_argument("--chunk_seconds", type=int, default=1800,
+        help="target wall-clock time to align each chunk, in seconds")
+    parser.add_argument("--align_rate", type=float, default=100,
+        help="estimated reads aligned per core per second, for planning")
+    parser.add_argument("--plan_only", action="store_true",
+        help="estimate and print the alignment chunk plan, then exit")
+    parser.add_argument("--call_window", type=int, default=50000000,
+        help="number of bases of reference to call variants on in each job")
+    parser.add_argument("--call_overlap", type=int, default=2000,
+        help="bases of overlap between calling chunks and windows (must be even)")
+    parser.add_argument("--call_cores", type=int, default=16,
+        help="number of cores for a calling job with a whole window")
+    parser.add_argument("--call_memory", type=parse_size, default="100G",
+        help="amount of memory for a calling job with a whole window (ex 100G)")
+    parser.add_argument("--index_codec", choices=DIRECTORY_CODECS.keys(),
+        default="gzip",
+        help="compression to pack the graph index with")
+    parser.add_argument("--index_cache", type=str,
+        help="directory on each worker to cache the unpacked graph index in")
+    parser.add_argument("--index_cache_size", type=parse_size, default="100G",
+        help="disk budget for the index cache on each worker (ex 100G)")
+    parser.add_argument("--chunk_bytes", type=int,
+        help="make FASTQ chunks this many bytes instead, if fewer reads fit")
+    parser.add_argument("--download_threads", type=int, default=8,
+        help="number of files to download from the out store at once")
+    parser.add_argument("--upload_threads", type=int, default=8,
+        help="number of files to upload to the out store at once")
+    parser.add_argument("--out_store_transfer",
+        choices=FileIOStore.TRANSFER_MODES, default="copy",
+        help="how to put files in a local out store (link avoids copying "
+        "when the work dir is on the same filesystem)")
+    parser.add_argument("--skip_unchanged", action="store_true",
+        help="don't upload files the out store already has, by checksum")
+    parser.add_argument("--pipe_size", type=int, default=1024 * 1024,
+        help="capacity in bytes of the pipes between indexing stages")
 
     # The command line arguments start with the program name, which we don't
     # want to treat as an argument for argparse. So we remove it.
@@ -103,34 +171,6 @@ def parse_args(args):
 
     return parser.parse_args(args)
 
-# Reverse complement needs a global translation table
-reverse_complement_translation_table = string.maketrans("ACGTN", "TGCAN")
-def reverse_complement(sequence):
-    """  
-    Compute the reverse complement of a DNA sequence.
-    
-    Follows algorithm from <http://stackoverflow.com/a/26615937>
-    """
-    
-    if isinstance(sequence, unicode):
-        # Encode the sequence in ASCII for easy translation
-        sequence = sequence.encode("ascii", "replace")
-    
-    # Translate and then reverse
-    return sequence.translate(reverse_complement_translation_table)[::-1]
-    
-def count_Ns(sequence):
-    """  
-    Return the number of N bases in the given DNA sequence
-    """
-    
-    n_count = 0
-    for item in sequence:
-        if item == "N": 
-            n_count += 1 
-     
-    return n_count
-
 def get_files_by_file_size(dirname, reverse=False):
     """ Return list of file paths in directory sorted by file size """
 
@@ -147,6 +187,24 @@ def get_files_by_file_size(dirname, reverse=False):
 
     return filepaths
 
+def get_directory_size(dirname, exclude=[]):
+    """
+    Return the total size in bytes of all the files anywhere under the given
+    directory, except those whose paths relative to it are in exclude.
+    
+    """
+
+    total = 0
+    for parent, _, basenames in os.walk(dirname):
+        for basename in basenames:
+            filename = os.path.join(parent, basename)
+            if (os.path.relpath(filename, dirname) in exclude or
+                os.path.islink(filename)):
+                continue
+            total += os.path.getsize(filename)
+
+    return total
+
 def run(cmd, proc_stdout = sys.stdout, proc_stderr = sys.stderr,
         check = True):
     """ run command in shell and throw exception if it doesn't work 
@@ -160,35 +218,47 @@ def run(cmd, proc_stdout = sys.stdout, proc_stderr = sys.stderr,
         raise RuntimeError("Command: %s exited with non-zero status %i" % (cmd, sts))
     return output, errors
 
-def batch_iterator(iterator, batch_size):
-    """Returns lists of length batch_size.
+def finished_stage(options, out_store, name, option_names):
+    """
+    Check the out store for a finished run of the named stage, made with the
+    same values of the named options. Returns whether it was found, and the
+    result it saved. Nothing is reused if we were asked to overwrite.
+    
+    """
 
-    This can be used on any iterator, for example to batch up
-    SeqRecord objects from Bio.SeqIO.parse(...), or to batch
-    Alignment objects from Bio.AlignIO.parse(...), or simply
-    lines from a file handle.
+    if options.overwrite:
+        return False, None
+    found, result = load_checkpoint(out_store, name,
+        fingerprint(options, option_names))
+    if found:
+        RealTimeLogger.get().info("Reusing finished stage {}".format(name))
+    return found, result
 
-    This is a generator function, and it returns lists of the
-    entries from the supplied iterator.  Each list will have
-    batch_size entries, although the final list may be shorter.
+def finish_stage(options, out_store, name, option_names, outputs, result=None):
+    """
+    Record in the out store that the named stage finished, with the given
+    output keys and result, so a later run with the same values of the named
+    options can skip it.
+    
+    """
+
+    save_checkpoint(out_store, name, fingerprint(options, option_names),
+        outputs, result)
+
+def read_index_directory(options, file_store, index_dir_id, path):
+    """
+    Unpack the graph index directory with the given ID to the given path,
+    through the host's index cache if one is configured, so each host only
+    unpacks each index once. Files from the cache must not be modified.
     
-    From http://biopython.org/wiki/Split_large_file
     """
-    entry = True  # Make sure we loop once
-    while entry:
-        batch = []
-        while len(batch) < batch_size:
-            try:
-                entry = iterator.next()
-            except StopIteration:
-                entry = None
-            if entry is None:
-                # End of file
-                break
-            batch.append(entry)
-        if batch:
-            yield batch
 
+    cache = None
+    if options.index_cache is not None:
+        cache = DirectoryCache(options.index_cache, options.index_cache_size)
+    read_global_directory(file_store, index_dir_id, path, cache=cache)
+
+@instrumented
 def run_indexing(job, options):
     """
     For each server listed in the server_list tsv, kick off child jobs to
@@ -201,13 +271,28 @@ def run_indexing(job, options):
     # Set up the IO stores each time, since we can't unpickle them on Azure for
     # some reason.
     input_store = IOStore.get(options.input_store)
-    out_store = IOStore.get(options.out_store)
+    out_store = IOStore.get(options.out_store,
+        file_transfer=options.out_store_transfer,
+        skip_unchanged=options.skip_unchanged)
 
     graph_file = ntpath.basename(options.vg_graph)
 
     # Define work directory for docker calls
     work_dir = job.fileStore.getLocalTempDir()
     
+    # What will the compressed index be called in the output store?
+    index_key = "index{}".format(DIRECTORY_CODECS[options.index_codec])
+    
+    found, result = (False, None) if options.reindex else finished_stage(
+        options, out_store, "indexing", INDEX_OPTIONS)
+    if found:
+        # An earlier run made this index. Put the archive in the file store
+        # for our children, just as if we had packed it ourselves.
+        index_file = "{}/{}".format(job.fileStore.getLocalTempDir(), index_key)
+        out_store.read_input_file(index_key, index_file)
+        index_dir_id = job.fileStore.writeGlobalFile(index_file, cleanup=True)
+        return job.addChildJobFn(run_split_fastq, options, index_dir_id, work_dir, result["index_bytes"], cores=8, memory="100G", disk="20G").rv()
+    
     # Download local input files from the remote storage container
     graph_dir = work_dir
     #graph_dir = job.fileStore.getLocalTempDir()
@@ -252,12 +337,12 @@ def run_indexing(job, options):
                 # Prune out hard bits of the graph
                 # and complex regions
                 # and short disconnected chunks
-                docker_tools=['quay.io/ucsc_cgl/vg:1.4.0--4cbd3aa6d2c0449730975517fc542775f74910f3']
-                command = ['vg mod -p -l {} -t {} -e {} {}'.format(str(options.kmer_size), str(job.cores), str(options.edge_max), os.path.basename(graph_filename)),
-                            'vg mod -S -l {} -t {} -'.format(str(options.kmer_size * 2), str(job.cores))]
-                docker_call(work_dir=work_dir, parameters=command,
-                            tools=docker_tools,
-                            outfile=to_index_file)
+                vg_tool = 'quay.io/ucsc_cgl/vg:1.4.0--4cbd3aa6d2c0449730975517fc542775f74910f3'
+                stages = [(vg_tool, 'vg mod -p -l {} -t {} -e {} {}'.format(str(options.kmer_size), str(job.cores), str(options.edge_max), os.path.basename(graph_filename))),
+                          (vg_tool, 'vg mod -S -l {} -t {} -'.format(str(options.kmer_size * 2), str(job.cores)))]
+                docker_pipeline(stages, work_dir=work_dir,
+                                outfile=to_index_file,
+                                pipe_size=options.pipe_size)
 
             if options.include_primary:
 
@@ -300,12 +385,12 @@ def run_indexing(job, options):
 
         # Make the GCSA2 kmers file
         with open(kmers_filename, "w") as kmers_file:
-            docker_tools=['quay.io/ucsc_cgl/vg:1.4.0--4cbd3aa6d2c0449730975517fc542775f74910f3']
-            command = ['vg view -v {}'.format(os.path.basename(to_index_filename)),
-                       'vg kmers -g -B -k {} -H 1000000000 -T 1000000001 -t {} -'.format(str(options.kmer_size), str(job.cores))]
-            docker_call(work_dir=work_dir, parameters=command,
-                        tools=docker_tools,
-                        outfile=kmers_file)
+            vg_tool = 'quay.io/ucsc_cgl/vg:1.4.0--4cbd3aa6d2c0449730975517fc542775f74910f3'
+            stages = [(vg_tool, 'vg view -v {}'.format(os.path.basename(to_index_filename))),
+                      (vg_tool, 'vg kmers -g -B -k {} -H 1000000000 -T 1000000001 -t {} -'.format(str(options.kmer_size), str(job.cores)))]
+            docker_pipeline(stages, work_dir=work_dir,
+                            outfile=kmers_file,
+                            pipe_size=options.pipe_size)
 
         time.sleep(1)
 
@@ -338,84 +423,196 @@ def run_indexing(job, options):
     else:
         raise RuntimeError("Invalid indexing mode: " + options.index_mode)
 
-    # Define a file to keep the compressed index in, so we can send it to
-    # the output store.
-    index_dir_tgz = "{}/index.tar.gz".format(
-        job.fileStore.getLocalTempDir())
+    # Where do we put the node sequence store?
+    node_sequences_dirname = graph_filename + ".nodes"
+
+    RealTimeLogger.get().info("Storing node sequences of {} in {}".format(
+            graph_filename, node_sequences_dirname))
+
+    # Build it once here from vg's JSON output, so the jobs that need node
+    # sequences can memory-map it instead of parsing the graph themselves.
+    command = ['view', '-j', os.path.basename(graph_filename)]
+    with docker_output_stream(work_dir=work_dir, parameters=command,
+        tool='quay.io/ucsc_cgl/vg:1.4.0--4cbd3aa6d2c0449730975517fc542775f74910f3',
+        inputs=[graph_filename]) as read_graph:
+        NodeSequences.build(read_graph, node_sequences_dirname)
 
     # Now save the indexed graph directory to the file store. It can be
-    # cleaned up since only our children use it.
-    RealTimeLogger.get().info("Compressing index of {}".format(
+    # cleaned up since only our children use it. It is compressed once, and
+    # saved as output at the same time.
+    RealTimeLogger.get().info("Compressing and uploading index of {}".format(
         graph_filename))
     index_dir_id = write_global_directory(job.fileStore, graph_dir,
-        cleanup=True, tee=index_dir_tgz)
-
-    # Save it as output
-    RealTimeLogger.get().info("Uploading index of {}".format(
-        graph_filename))
-    index_key = ntpath.basename(index_dir_tgz)
-    out_store.write_output_file(index_dir_tgz, index_key)
+        cleanup=True, codec=options.index_codec,
+        copies=[(out_store, index_key)])
     RealTimeLogger.get().info("Index {} uploaded successfully".format(
         index_key))
 
+    # How big is the unpacked index? Alignment chunks are planned around it.
+    # Count the RocksDB index and node store directories, but not the pruned
+    # graph and kmers that were only needed to build the GCSA.
+    index_bytes = get_directory_size(graph_dir,
+        exclude=["to_index.vg", "index.graph"])
+    finish_stage(options, out_store, "indexing", INDEX_OPTIONS, [index_key],
+        {"index_bytes": index_bytes})
+
     #Split fastq files
-    return job.addChildJobFn(run_split_fastq, options, index_dir_id, work_dir, cores=8, memory="100G", disk="20G").rv()
+    return job.addChildJobFn(run_split_fastq, options, index_dir_id, work_dir, index_bytes, cores=8, memory="100G", disk="20G").rv()
+
+def plan_alignment(options, read_count, index_bytes):
+    """
+    Plan the alignment chunks and their job resources for read_count reads
+    against an index of index_bytes bytes, according to the options. Returns a
+    ChunkPlan.
+    
+    """
+
+    return plan_chunks(read_count, index_bytes, options.worker_cores,
+        options.worker_memory, workers=options.workers,
+        target_chunk_seconds=options.chunk_seconds,
+        reads_per_core_second=options.align_rate,
+        reads_per_chunk=options.reads_per_chunk)
+
+@instrumented
+def run_split_fastq(job, options, index_dir_id, work_dir, index_bytes):
+    """
+    Split the sample FASTQ, which may be gzipped, into chunks of whole reads,
+    upload each chunk to the output store, and align each one in its own
+    child job.
+
+    The chunk size and the alignment jobs' resources are planned from the
+    number of reads and the size of the index, which is index_bytes unpacked.
 
-def run_split_fastq(job, options, index_dir_id, work_dir):
+    Chunks are uploaded in the background while the rest of the input is still
+    being split, and each alignment job is added as soon as its chunk's upload
+    is done. Toil only starts children once this job finishes, though.
+    
+    """
     
     RealTimeLogger.get().info("Starting fastq split and alignment...")
     # Set up the IO stores each time, since we can't unpickle them on Azure for
     # some reason.
     input_store = IOStore.get(options.input_store)
-    out_store = IOStore.get(options.out_store)
-
-    # Download local input files from the remote storage container
-    graph_dir = work_dir
-    read_global_directory(job.fileStore, index_dir_id, graph_dir)
-
+    out_store = IOStore.get(options.out_store,
+        file_transfer=options.out_store_transfer,
+        skip_unchanged=options.skip_unchanged)
+
+    # Splitting doesn't need the graph, so we don't download the index here.
+    # But children expect work_dir to exist.
+    robust_makedirs(work_dir)
+
+    # Were these reads already split into these chunks by an earlier run?
+    split_stage = "split/{}".format(options.sample_name)
+    found, result = finished_stage(options, out_store, split_stage,
+        SPLIT_OPTIONS)
+    if found:
+        plan = ChunkPlan(**result["plan"])
+        stats_file_keys = [job.addChildJobFn(run_alignment, options, filename_key, chunk_id, index_dir_id, work_dir, cores=plan.cores, memory=plan.memory, disk=plan.disk).rv()
+            for chunk_id, filename_key in result["chunks"]]
+        return job.addFollowOnJobFn(run_merge_gam, options, len(stats_file_keys), index_dir_id, work_dir, stats_file_keys, cores=8, memory="100G", disk="20G").rv()
 
     # We need the sample fastq for alignment
     sample_filename = os.path.basename(options.sample_reads)
-    fastq_file = "{}/input.fq".format(work_dir)
+    fastq_file = "{}/input_{}".format(job.fileStore.getLocalTempDir(),
+        sample_filename)
     input_store.read_input_file(sample_filename, fastq_file)
 
-    record_iter = SeqIO.parse(open(fastq_file),"fastq")
-    
-    num_chunks = 0
-    for chunk_id, batch in enumerate(batch_iterator(record_iter, 15034)):
-        num_chunks += 1
-        chunk_id = chunk_id + 1
-        filename = "{}/group_{}.fq".format(work_dir, chunk_id)
-        handle = open(filename, "w")
-        count = SeqIO.write(batch, handle, "fastq")
-        handle.close()
-        
-        # Upload the fastq file chunk
+    # Work out how big to make the chunks
+    plan = plan_alignment(options, estimate_read_count(fastq_file), index_bytes)
+    RealTimeLogger.get().info("Alignment plan: {}".format(describe_plan(plan)))
+
+    def upload_chunk(filename):
+        """
+        Upload the given FASTQ chunk, delete the local copy, and return its
+        key in the out store.
+        """
         filename_key = os.path.basename(filename)
         out_store.write_output_file(filename, filename_key)
-        
-        RealTimeLogger.get().info("Wrote {} records to {}".format(count, filename))
+        os.unlink(filename)
+        return filename_key
+
+    # Which chunks went where, for the completion manifest?
+    chunk_keys = []
+
+    def add_alignment(chunk_id, upload):
+        """
+        Wait for the given chunk upload to finish, and then add a child job to
+        align the chunk, returning the promise of its stats file key.
+        """
+        filename_key = upload.get()
+        chunk_keys.append((chunk_id, filename_key))
+        return job.addChildJobFn(run_alignment, options, filename_key, chunk_id, index_dir_id, work_dir, cores=plan.cores, memory=plan.memory, disk=plan.disk).rv()
+
+    # Upload chunks in the background as they are split off. Only a few chunks
+    # are allowed to wait for upload at once, so they don't fill the disk.
+    upload_threads = max(1, options.upload_threads)
+    pool = multiprocessing.pool.ThreadPool(upload_threads)
+    pending = collections.deque()
+    stats_file_keys = []
+    try:
+        with open_fastq(fastq_file) as fastq_handle:
+            for chunk_id, filename, count in split_fastq(fastq_handle,
+                lambda chunk_id: "{}/group_{}.fq".format(work_dir, chunk_id),
+                reads_per_chunk=plan.reads_per_chunk,
+                bytes_per_chunk=options.chunk_bytes):
+                
+                RealTimeLogger.get().info("Wrote {} records to {}".format(count, filename))
+                pending.append((chunk_id, pool.apply_async(upload_chunk, (filename,))))
+
+                while len(pending) > 2 * upload_threads:
+                    stats_file_keys.append(add_alignment(*pending.popleft()))
 
-        #Run graph alignment on each fastq chunk
-        job.addChildJobFn(run_alignment, options, filename_key, chunk_id, index_dir_id, work_dir, cores=32, memory="100G", disk="20G")
+        # The input is all split now, and we don't need it any more.
+        os.unlink(fastq_file)
+        
+        while pending:
+            stats_file_keys.append(add_alignment(*pending.popleft()))
+    finally:
+        pool.terminate()
     
-    return job.addFollowOnJobFn(run_merge_gam, options, num_chunks, index_dir_id, work_dir, cores=8, memory="100G", disk="20G").rv()
+    num_chunks = len(stats_file_keys)
+    RealTimeLogger.get().info("Split {} into {} chunks".format(sample_filename, num_chunks))
+    finish_stage(options, out_store, split_stage, SPLIT_OPTIONS,
+        [filename_key for _, filename_key in chunk_keys],
+        {"chunks": chunk_keys, "plan": plan._asdict()})
+
+    return job.addFollowOnJobFn(run_merge_gam, options, num_chunks, index_dir_id, work_dir, stats_file_keys, cores=8, memory="100G", disk="20G").rv()
 
 
+@instrumented
 def run_alignment(job, options, filename_key, chunk_id, index_dir_id, work_dir):
+    """
+    Align the FASTQ chunk stored in the output store under filename_key
+    against the indexed graph, and upload the resulting GAM.
+
+    Also computes the alignment stats for just this chunk, while the graph is
+    already here, and uploads them in the partial form that run_merge_stats
+    can combine. Returns the output store key of the partial stats.
+    
+    """
+
 
     RealTimeLogger.get().info("Starting alignment on {} chunk {}".format(options.sample_name, chunk_id))
     # Set up the IO stores each time, since we can't unpickle them on Azure for
     # some reason.
     input_store = IOStore.get(options.input_store)
-    out_store = IOStore.get(options.out_store)
+    out_store = IOStore.get(options.out_store,
+        file_transfer=options.out_store_transfer,
+        skip_unchanged=options.skip_unchanged)
+
+    # Did an earlier run already align this chunk?
+    alignment_stage = "alignment/{}_{}".format(options.sample_name, chunk_id)
+    found, result = finished_stage(options, out_store, alignment_stage,
+        ALIGN_OPTIONS)
+    if found:
+        return result
 
     # How long did the alignment take to run, in seconds?
     run_time = None
     
     # Download local input files from the remote storage container
     graph_dir = work_dir
-    read_global_directory(job.fileStore, index_dir_id, graph_dir)
+    read_index_directory(options, job.fileStore, index_dir_id, graph_dir)
     
     # We know what the vg file in there will be named
     graph_file = "{}/graph.vg".format(graph_dir)
@@ -475,93 +672,148 @@ def run_alignment(job, options, filename_key, chunk_id, index_dir_id, work_dir):
     # Upload the alignment
     alignment_file_key = ntpath.basename(output_file)
     out_store.write_output_file(output_file, alignment_file_key)
-    
 
-def run_merge_gam(job, options, num_chunks, index_dir_id, work_dir):
+    # Count up the stats for this chunk, streaming the alignments in JSON-line
+    # format straight from vg. The node sequences were stored with the index,
+    # and are memory-mapped so we can count Ns in constant time.
+    node_sequences = NodeSequences.load(graph_file + ".nodes")
+    command = ['view', '-aj', os.path.basename(output_file)]
+    with docker_output_stream(work_dir=work_dir, parameters=command,
+        tool='quay.io/ucsc_cgl/vg:1.4.0--4cbd3aa6d2c0449730975517fc542775f74910f3',
+        inputs=[output_file]) as read_alignment:
+        stats = alignment_stats(read_alignment, node_sequences,
+            run_time=run_time)
+
+    # Save and upload the partial stats for merging
+    stats_file = "{}/{}_{}.gam.stats".format(job.fileStore.getLocalTempDir(),
+        options.sample_name, chunk_id)
+    with open(stats_file, "w") as stats_handle:
+        dump_partial_stats(stats, stats_handle)
+    stats_file_key = ntpath.basename(stats_file)
+    out_store.write_output_file(stats_file, stats_file_key)
+
+    finish_stage(options, out_store, alignment_stage, ALIGN_OPTIONS,
+        [alignment_file_key, stats_file_key], stats_file_key)
+
+    return stats_file_key
+
+@instrumented
+def run_merge_gam(job, options, num_chunks, index_dir_id, work_dir, stats_file_keys):
     
     RealTimeLogger.get().info("Starting gam merging...")
     # Set up the IO stores each time, since we can't unpickle them on Azure for
     # some reason.
     input_store = IOStore.get(options.input_store)
-    out_store = IOStore.get(options.out_store)
+    out_store = IOStore.get(options.out_store,
+        file_transfer=options.out_store_transfer,
+        skip_unchanged=options.skip_unchanged)
     
-    # Download local input files from the remote storage container
-    graph_dir = work_dir
-    read_global_directory(job.fileStore, index_dir_id, graph_dir)
-
-    # Define a temp file for our merged alignent output
-    output_merged_gam = "{}/{}.gam".format(work_dir, options.sample_name)
-    
-    gam_chunk_filelist = []
-    for i in xrange(num_chunks):
-        chunk_id = i + 1
-        output_file = "{}/{}_{}.gam".format(work_dir, options.sample_name, chunk_id)
-        out_store.read_input_file(os.path.basename(output_file), output_file)
-        gam_chunk_filelist.append(output_file)
-         
-    with open(output_merged_gam, "w") as output_merged_gam_handle:
-        for output_chunk_gam in gam_chunk_filelist:
-            with open(output_chunk_gam, "r") as output_chunk_gam_handle:
-                for line in output_chunk_gam_handle:
-                    output_merged_gam_handle.write(line)
-
-    # Upload the merged alignment file
-    alignment_file_key = os.path.basename(output_merged_gam)
-    out_store.write_output_file(output_merged_gam, alignment_file_key) 
-
-
-    #Run alignment stats
-    job.addChildJobFn(run_stats, options, index_dir_id, alignment_file_key, work_dir, cores=2, memory="4G", disk="10G")
+    # Did an earlier run already merge these chunks?
+    merge_stage = "merge_gam/{}".format(options.sample_name)
+    found, alignment_file_key = finished_stage(options, out_store, merge_stage,
+        ALIGN_OPTIONS)
+    if not found:
+        # Download local input files from the remote storage container
+        graph_dir = work_dir
+        read_index_directory(options, job.fileStore, index_dir_id, graph_dir)
+
+        # Define a temp file for our merged alignent output
+        output_merged_gam = "{}/{}.gam".format(work_dir, options.sample_name)
+
+        chunk_files = ["{}/{}_{}.gam".format(work_dir, options.sample_name, chunk_id)
+            for chunk_id in xrange(1, num_chunks + 1)]
+
+        # GAM is binary, so concatenate the chunks in big buffers rather than by
+        # line. The chunks download in parallel, and come back in order as they
+        # arrive, so we can append each chunk while later ones are still
+        # downloading. Each chunk is deleted once appended, to save disk.
+        start_time = timeit.default_timer()
+        with open(output_merged_gam, "wb") as output_merged_gam_handle:
+            merged_bytes = concatenate_files(out_store.iter_input_files(
+                [(os.path.basename(chunk_file), chunk_file) for chunk_file in chunk_files],
+                threads=options.download_threads), output_merged_gam_handle, remove=True)
+        merge_time = timeit.default_timer() - start_time
+
+        RealTimeLogger.get().info("Merged {} chunks into {}: {:.1f} MB in {:.1f} "
+            "seconds ({:.1f} MB/s)".format(num_chunks, output_merged_gam,
+            merged_bytes / 1e6, merge_time, merged_bytes / 1e6 / max(merge_time, 1e-6)))
+
+        # Upload the merged alignment file
+        alignment_file_key = os.path.basename(output_merged_gam)
+        out_store.write_output_file(output_merged_gam, alignment_file_key)
+        finish_stage(options, out_store, merge_stage, ALIGN_OPTIONS,
+            [alignment_file_key], alignment_file_key)
+
+
+    #Merge the per-chunk alignment stats. This only adds up histograms, so it
+    #needs next to nothing.
+    job.addChildJobFn(run_merge_stats, options, stats_file_keys, cores=1, memory="2G", disk="1G")
  
     # Run variant calling on .gams by chromosome if no path_name or path_size options are set 
-    return_value = []
-    vcf_file_key_list = [] 
     if options.path_name or options.path_size:
-        #Run variant calling
-        vcf_file_key = job.addChildJobFn(run_calling, options, index_dir_id, alignment_file_key, work_dir, options.path_name, options.path_size, cores=16, memory="100G", disk="20G").rv()
-        
-        vcf_file_key_list.append(vcf_file_key)
-
-        return_value = job.addFollowOnJobFn(run_merge_vcf, options, index_dir_id, work_dir, vcf_file_key_list, cores=8, memory="100G", disk="20G").rv()
-    
+        contigs = [(options.path_name, options.path_size)]
     else:
         chr_label_list = ["1","2","3","4","5","6","7","8","9","10","11","12","13","14","15","16","17","18","19","20","21","22","X","Y"]
         # chr_length_list obtained from Mike Lin's vg dnanexus pipeline configuration
         chr_length_list = [249250621,243199373,198022430,191154276,180915260,171115067,159138663,146364022,141213431,135534747,135006516,133851895,115169878,107349540,102531392,90354753,81195210,78077248,59128983,63025520,48129895,51304566,155270560,59373566]
-    
-        for chr_label, chr_length in itertools.izip(chr_label_list, chr_length_list):
-            vcf_file_key = job.addChildJobFn(run_calling, options, index_dir_id, alignment_file_key, work_dir, chr_label, chr_length, cores=16, memory="100G", disk="20G").rv()
-        vcf_file_key_list.append(vcf_file_key)
-        return_value = job.addFollowOnJobFn(run_merge_vcf, options, index_dir_id, work_dir, vcf_file_key_list, cores=8, memory="100G", disk="20G").rv()
+        contigs = zip(chr_label_list, chr_length_list)
+
+    # Balance the calling work between jobs: big contigs are split into
+    # windows, and small ones are packed together, with each job's resources
+    # scaled to the bases it calls.
+    call_jobs = plan_calling(contigs, options.call_window, options.call_cores,
+        options.call_memory, min_memory=4 * 1024 ** 3)
+
+    vcf_file_key_list = [] 
+    for call_job in call_jobs:
+        RealTimeLogger.get().info("Calling {} bases with {} cores and {} bytes "
+            "of memory: {}".format(call_job.bases, call_job.cores,
+            call_job.memory, ", ".join(region_key(region) for region in
+            call_job.regions)))
+        #Run variant calling
+        vcf_file_key_list.append(job.addChildJobFn(run_calling, options, index_dir_id, alignment_file_key, work_dir, call_job.regions, cores=call_job.cores, memory=call_job.memory, disk="20G").rv())
 
-    return return_value
+    return job.addFollowOnJobFn(run_merge_vcf, options, index_dir_id, work_dir, vcf_file_key_list, cores=8, memory="100G", disk="20G").rv()
 
+@instrumented
 def run_merge_vcf(job, options, index_dir_id, work_dir, vcf_file_key_list):
+    """
+    Merge the VCFs from all the calling jobs into one VCF for the sample, in
+    reference order. vcf_file_key_list holds a list of (order, key) pairs from
+    each calling job.
+    
+    """
 
     RealTimeLogger.get().info("Completed gam merging and gam path variant calling.")
     RealTimeLogger.get().info("Starting vcf merging...")
     # Set up the IO stores each time, since we can't unpickle them on Azure for
     # some reason.
     input_store = IOStore.get(options.input_store)
-    out_store = IOStore.get(options.out_store)
+    out_store = IOStore.get(options.out_store,
+        file_transfer=options.out_store_transfer,
+        skip_unchanged=options.skip_unchanged)
     
     # Download local input files from the remote storage container
     graph_dir = work_dir
-    read_global_directory(job.fileStore, index_dir_id, graph_dir)
+    read_index_directory(options, job.fileStore, index_dir_id, graph_dir)
+   
+    # Put the region VCFs back in reference order
+    vcf_file_key_list = [vcf_file_key for _, vcf_file_key in
+        sorted(itertools.chain.from_iterable(vcf_file_key_list))]
    
-    vcf_merging_file_key_list = [] 
-    for vcf_file_key in vcf_file_key_list:
-        vcf_file = "{}/{}".format(work_dir, vcf_file_key)
-        vcf_file_idx = "{}.tbi".format(vcf_file)
-        out_store.read_input_file(vcf_file_key, vcf_file)
-        out_store.read_input_file(vcf_file_key + ".tbi", vcf_file_idx)
-        vcf_merging_file_key_list.append(vcf_file)
+    # Fetch all the VCFs and their indexes at once
+    vcf_merging_file_key_list = ["{}/{}".format(work_dir, vcf_file_key)
+        for vcf_file_key in vcf_file_key_list]
+    out_store.read_input_files(itertools.chain.from_iterable(
+        [(vcf_file_key, vcf_file), (vcf_file_key + ".tbi", vcf_file + ".tbi")]
+        for vcf_file_key, vcf_file in zip(vcf_file_key_list, vcf_merging_file_key_list)),
+        threads=options.download_threads)
 
     vcf_merged_file_key = "" 
     if len(vcf_file_key_list) > 1:
         # merge vcf files
         vcf_merged_file_key = "{}.vcf.gz".format(options.sample_name)
-        command=['concat', '-O', 'z', '-o', '{}/{}'.format(work_dir, vcf_merged_file_key), ' '.join(vcf_merging_file_key_list)]
+        command=['concat', '-O', 'z', '-o', vcf_merged_file_key] + [os.path.basename(vcf_file) for vcf_file in vcf_merging_file_key_list]
         docker_call(work_dir=work_dir, parameters=command,
                     tool='biodckr/bcftools')
 #        run("bcftools concat -O z -o {}/{} {}".format(work_dir, vcf_merged_file_key, ' '.join(vcf_merging_file_key_list)))
@@ -573,8 +825,8 @@ def run_merge_vcf(job, options, index_dir_id, work_dir, vcf_file_key_list):
     vcf_file = "{}/{}".format(work_dir, vcf_merged_file_key)
     vcf_file_idx = "{}/{}.tbi".format(work_dir, vcf_merged_file_key)
 
-    out_store.write_output_file(vcf_file, vcf_merged_file_key)
-    out_store.write_output_file(vcf_file_idx, vcf_merged_file_key + ".tbi")
+    out_store.write_output_files([(vcf_file, vcf_merged_file_key),
+        (vcf_file_idx, vcf_merged_file_key + ".tbi")], threads=options.upload_threads)
     
     #Run downloader to download output IO store files to local output directory.
     vcf_file_id = job.fileStore.writeGlobalFile(vcf_file)
@@ -583,291 +835,43 @@ def run_merge_vcf(job, options, index_dir_id, work_dir, vcf_file_key_list):
 
     return downloadList
 
-def run_stats(job, options, index_dir_id, alignment_file_key, work_dir):
+@instrumented
+def run_merge_stats(job, options, stats_file_keys):
     """
-    If the stats aren't done, or if they need to be re-done, retrieve the
-    alignment file from the output store under alignment_file_key and compute the
-    stats file, saving it under stats_file_key.
-    
-    Uses index_dir_id to get the graph, and thus the reference sequence that
-    each read is aligned against, for the purpose of discounting Ns.
-    
-    Can take a run time to put in the stats.
-
-    Assumes that stats actually do need to be computed, and overwrites any old
-    stats.
-
-    TODO: go through the proper file store (and cache) for getting alignment
-    data.
+    Retrieve the partial stats computed for each alignment chunk from the
+    output store under stats_file_keys, and combine them into the stats file
+    for the whole sample, overwriting any old stats.
+
+    Since the FASTQ is split between reads, each read's primary and secondary
+    alignments are all in one chunk, and the merged stats are the same as
+    computing stats over the merged GAM would give. The run time is the total
+    alignment time over all the chunks.
     
     """
 
-    RealTimeLogger.get().info("Computing stats for {}".format(options.sample_name))
+    RealTimeLogger.get().info("Merging stats for {} from {} chunks".format(
+        options.sample_name, len(stats_file_keys)))
 
     # Set up the IO stores each time, since we can't unpickle them on Azure for
     # some reason.
-    input_store = IOStore.get(options.input_store)
-    out_store = IOStore.get(options.out_store)
-
-    # Download the indexed graph to a directory we can use
-    graph_dir = work_dir
-    read_global_directory(job.fileStore, index_dir_id, graph_dir)
+    out_store = IOStore.get(options.out_store,
+        file_transfer=options.out_store_transfer,
+        skip_unchanged=options.skip_unchanged)
 
-    # How long did the alignment take to run, in seconds?
-    run_time = None
+    work_dir = job.fileStore.getLocalTempDir()
 
-    # We know what the vg file in there will be named
-    graph_file = "{}/graph.vg".format(graph_dir)
+    partial_stats = []
+    for partial_file in out_store.iter_input_files([(stats_file_key,
+        "{}/{}".format(work_dir, stats_file_key)) for stats_file_key in stats_file_keys],
+        threads=options.download_threads):
+        with open(partial_file) as partial_handle:
+            partial_stats.append(load_partial_stats(partial_handle))
 
-    # Load the node sequences into memory. This holds node sequence string by
-    # ID.
-    node_sequences = {}
+    stats = merge_stats(partial_stats)
 
-    # Read the alignments in in JSON-line format
-    read_graph_filename = "{}/read_graph.json".format(graph_dir)
-    with open(read_graph_filename, "w") as read_graph:
-        command = ['view', '-j', os.path.basename(graph_file)]
-        docker_call(work_dir=work_dir, parameters=command,
-                    tool='quay.io/ucsc_cgl/vg:1.4.0--4cbd3aa6d2c0449730975517fc542775f74910f3',
-                    inputs=[graph_file],
-                    outfile=read_graph)
-
-    with open(read_graph_filename, "r") as read_graph:
-        for line in read_graph:
-            # Parse the graph chunk JSON
-            graph_chunk = json.loads(line)
-            for node_dict in graph_chunk.get("node", []):
-                # For each node, store its sequence under its id. We want to crash
-                # if a node exists for which one or the other isn't defined.
-                node_sequences[node_dict["id"]] = node_dict["sequence"]
-
-    # Declare local files for everything
-    stats_file = "{}/{}_stats.json".format(job.fileStore.getLocalTempDir(), options.sample_name)
-    alignment_file = "{}/{}_alignment.gam".format(job.fileStore.getLocalTempDir(), options.sample_name)
+    stats_file = "{}/{}_stats.json".format(work_dir, options.sample_name)
     stats_file_key = ntpath.basename(stats_file)
 
-    # Download the alignment
-    out_store.read_input_file(alignment_file_key, alignment_file)
-
-    # Read the alignments in in JSON-line format
-    read_alignment_filename = "{}/read_alignment.json".format(graph_dir)
-    with open(read_alignment_filename, "w") as read_alignment:
-        command = ['view', '-aj', os.path.basename(alignment_file)]
-        docker_call(work_dir=work_dir, parameters=command,
-                    tool='quay.io/ucsc_cgl/vg:1.4.0--4cbd3aa6d2c0449730975517fc542775f74910f3',
-                    inputs=[alignment_file],
-                    outfile=read_alignment)
-    
-    # Count up the stats
-    stats = {
-        "total_reads": 0,
-        "total_mapped": 0,
-        "total_multimapped": 0,
-        "mapped_lengths": collections.Counter(),
-        "unmapped_lengths": collections.Counter(),
-        "aligned_lengths": collections.Counter(),
-        "primary_scores": collections.Counter(),
-        "primary_mismatches": collections.Counter(),
-        "primary_indels": collections.Counter(),
-        "primary_substitutions": collections.Counter(),
-        "secondary_scores": collections.Counter(),
-        "secondary_mismatches": collections.Counter(),
-        "secondary_indels": collections.Counter(),
-        "secondary_substitutions": collections.Counter(),
-        "run_time": run_time
-    }
-
-    last_alignment = None
-
-    with open(read_alignment_filename, "r") as read_alignment:
-        for line in read_alignment:
-            # Parse the alignment JSON
-            alignment = json.loads(line)
-
-            # How long is this read?
-            length = len(alignment["sequence"])
-
-            if alignment.has_key("score"):
-                # This alignment is aligned.
-                # Grab its score
-                score = alignment["score"]
-
-                # Get the mappings
-                mappings = alignment.get("path", {}).get("mapping", [])
-
-                # Calculate the exact match bases
-                matches = 0
-
-                # And total up the instances of indels (only counting those where
-                # the reference has no Ns, and which aren't leading or trailing soft
-                # clips)
-                indels = 0
-
-                # And total up the number of substitutions (mismatching/alternative
-                # bases in edits with equal lengths where the reference has no Ns).
-                substitutions = 0
-
-                # What should the denominator for substitution rate be for this
-                # read? How many bases are in the read and aligned?
-                aligned_length = 0
-
-                for mapping_number, mapping in enumerate(mappings):
-                    # Figure out what the reference sequence for this mapping should
-                    # be
-
-                    position = mapping.get("position", {})
-                    if position.has_key("node_id"):
-                        # We actually are mapped to a reference node
-                        ref_sequence = node_sequences[position["node_id"]]
-     
-                        # Grab the offset
-                        offset = position.get("offset", 0)
-
-                        if mapping.get("is_reverse", False):
-                            # We start at the offset base on the reverse strand.
-
-                            # Add 1 to make the offset inclusive as an end poiint                        
-                            ref_sequence = reverse_complement(
-                                ref_sequence[0:offset + 1])
-                        else:
-                            # Just clip so we start at the specified offset
-                            ref_sequence = ref_sequence[offset:]
-
-                    else:
-                        # We're aligned against no node, and thus an empty reference
-                        # sequence (and thus must be all insertions)
-                        ref_sequence = ""
-
-                    # Start at the beginning of the reference sequence for the
-                    # mapping.
-                    index_in_ref = 0
-
-                    # Pull out the edits
-                    edits = mapping.get("edit", [])
-
-                    for edit_number, edit in enumerate(edits):
-                        # An edit may be a soft clip if it's either the first edit
-                        # in the first mapping, or the last edit in the last
-                        # mapping. This flag stores whether that is the case
-                        # (although to actually be a soft clip it also has to be an
-                        # insertion, and not either a substitution or a perfect
-                        # match as spelled by the aligner).
-                        may_be_soft_clip = ((edit_number == 0 and
-                            mapping_number == 0) or
-                            (edit_number == len(edits) - 1 and
-                            mapping_number == len(mappings) - 1))
-
-                        # Count up the Ns in the reference sequence for the edit. We
-                        # get the part of the reference string that should belong to
-                        # this edit.
-                        reference_N_count = count_Ns(ref_sequence[
-                            index_in_ref:index_in_ref + edit.get("from_length", 0)])
-
-                        if edit.get("to_length", 0) == edit.get("from_length", 0):
-                            # Add in the length of this edit if it's actually
-                            # aligned (not an indel or softclip)
-                            aligned_length += edit.get("to_length", 0)
-
-                        if (not edit.has_key("sequence") and
-                            edit.get("to_length", 0) == edit.get("from_length", 0)):
-                            # The edit has equal from and to lengths, but no
-                            # sequence provided.
-
-                            # We found a perfect match edit. Grab its length
-                            matches += edit["from_length"]
-
-                            # We don't care about Ns when evaluating perfect
-                            # matches. VG already split out any mismatches into non-
-                            # perfect matches, and we ignore the N-matched-to-N
-                            # case.
-
-                        if not may_be_soft_clip and (edit.get("to_length", 0) !=
-                            edit.get("from_length", 0)):
-                            # This edit is an indel and isn't on the very end of a
-                            # read.
-                            if reference_N_count == 0:
-                                # Only count the indel if it's not against an N in
-                                # the reference
-                                indels += 1
-
-                        if (edit.get("to_length", 0) ==
-                            edit.get("from_length", 0) and
-                            edit.has_key("sequence")):
-                            # The edit has equal from and to lengths, and a provided
-                            # sequence. This edit is thus a SNP or MNP. It
-                            # represents substitutions.
-
-                            # We take as substituted all the bases except those
-                            # opposite reference Ns. Sequence Ns are ignored.
-                            substitutions += (edit.get("to_length", 0) -
-                                reference_N_count)
-
-                            # Pull those Ns out of the substitution rate denominator
-                            # as well.
-                            aligned_length -= reference_N_count
-
-                        # We still count query Ns as "aligned" when not in indels
-
-                        # Advance in the reference sequence
-                        index_in_ref += edit.get("from_length", 0)
-
-                # Calculate mismatches as what's not perfect matches
-                mismatches = length - matches
-
-                if alignment.get("is_secondary", False):
-                    # It's a multimapping. We can have max 1 per read, so it's a
-                    # multimapped read.
-
-                    if (last_alignment is None or
-                        last_alignment.get("name") != alignment.get("name") or
-                        last_alignment.get("is_secondary", False)):
-
-                        # This is a secondary alignment without a corresponding primary
-                        # alignment (which would have to be right before it given the
-                        # way vg dumps buffers
-                        raise RuntimeError("{} secondary alignment comes after "
-                            "alignment of {} instead of corresponding primary "
-                            "alignment\n".format(alignment.get("name"),
-                            last_alignment.get("name") if last_alignment is not None
-                            else "nothing"))
-
-                    # Log its stats as multimapped
-                    stats["total_multimapped"] += 1
-                    stats["secondary_scores"][score] += 1
-                    stats["secondary_mismatches"][mismatches] += 1
-                    stats["secondary_indels"][indels] += 1
-                    stats["secondary_substitutions"][substitutions] += 1
-                else:
-                    # Log its stats as primary. We'll get exactly one of these per
-                    # read with any mappings.
-                    stats["total_mapped"] += 1
-                    stats["primary_scores"][score] += 1
-                    stats["primary_mismatches"][mismatches] += 1
-                    stats["primary_indels"][indels] += 1
-                    stats["primary_substitutions"][substitutions] += 1
-
-                    # Record that a read of this length was mapped
-                    stats["mapped_lengths"][length] += 1
-
-                    # And that a read with this many aligned primary bases was found
-                    stats["aligned_lengths"][aligned_length] += 1
-
-                    # We won't see an unaligned primary alignment for this read, so
-                    # count the read
-                    stats["total_reads"] += 1
-
-            elif not alignment.get("is_secondary", False):
-                # We have an unmapped primary "alignment"
-
-                # Count the read by its primary alignment
-                stats["total_reads"] += 1
-
-                # Record that an unmapped read has this length
-                stats["unmapped_lengths"][length] += 1
-
-            # Save the alignment for checking for wayward secondaries
-            last_alignment = alignment
-
     with open(stats_file, "w") as stats_handle:
         # Save the stats as JSON
         json.dump(stats, stats_handle)
@@ -875,21 +879,40 @@ def run_stats(job, options, index_dir_id, alignment_file_key, work_dir):
     # Now send the stats to the output store where they belong.
     out_store.write_output_file(stats_file, stats_file_key)
 
-def run_calling(job, options, index_dir_id, alignment_file_key, work_dir, path_name, path_size):
+@instrumented
+def run_calling(job, options, index_dir_id, alignment_file_key, work_dir, regions):
+    """
+    Call variants on each of the given CallRegions from the alignment, and
+    upload a VCF for each. Returns a list of (order, VCF key) pairs.
     
-    RealTimeLogger.get().info("Running variant calling on path {} from alignment file {}".format(path_name, alignment_file_key))
+    """
+    
+    RealTimeLogger.get().info("Running variant calling on {} from alignment file {}".format(
+        ", ".join(region_key(region) for region in regions), alignment_file_key))
     
     # Set up the IO stores each time, since we can't unpickle them on Azure for
     # some reason.
     input_store = IOStore.get(options.input_store)
-    out_store = IOStore.get(options.out_store)
+    out_store = IOStore.get(options.out_store,
+        file_transfer=options.out_store_transfer,
+        skip_unchanged=options.skip_unchanged)
+    
+    # Which regions did an earlier run already call?
+    vcf_file_keys = []
+    regions_to_call = []
+    for region in regions:
+        if finished_stage(options, out_store, "calling/{}_{}".format(
+            options.sample_name, region_key(region)), CALL_OPTIONS)[0]:
+            vcf_file_keys.append((region.order, region_key(region)))
+        else:
+            regions_to_call.append(region)
+            
+    if not regions_to_call:
+        return vcf_file_keys
     
     # Download the indexed graph to a directory we can use
     graph_dir = work_dir
-    read_global_directory(job.fileStore, index_dir_id, graph_dir)
-
-    # How long did the alignment take to run, in seconds?
-    run_time = None
+    read_index_directory(options, job.fileStore, index_dir_id, graph_dir)
 
     # We know what the xg file in there will be named
     xg_file = "{}/graph.vg.xg".format(graph_dir)
@@ -898,24 +921,48 @@ def run_calling(job, options, index_dir_id, alignment_file_key, work_dir, path_n
     alignment_file = "{}/{}.gam".format(work_dir, options.sample_name)
     out_store.read_input_file(alignment_file_key, alignment_file)
     
-    variant_call_dir = work_dir
-
-    # run chunked_call
-    run("dockered_chunked_call --overwrite --threads {} {} {} {} {} {} {}".format(
-        job.cores, xg_file, alignment_file, path_name, path_size, options.sample_name, variant_call_dir))
-
-    # save variant calling results to the output store
-    vcf_file = "{}/{}.vcf.gz".format(variant_call_dir, path_name)
-    vcf_file_key = os.path.basename(vcf_file)
-    vcf_file_idx = "{}.tbi".format(vcf_file)   
-
-    out_store.write_output_file(vcf_file, vcf_file_key)
-    out_store.write_output_file(vcf_file_idx, vcf_file_key + ".tbi")
+    for region in regions_to_call:
+        # Call each region in its own directory, so windows of the same contig
+        # don't clobber each other's chunks. The container needs the inputs in
+        # there too.
+        variant_call_dir = "{}/call_{}".format(job.fileStore.getLocalTempDir(),
+            region.order)
+        robust_makedirs(variant_call_dir)
+        for input_file in [xg_file, alignment_file]:
+            linked_file = os.path.join(variant_call_dir, os.path.basename(input_file))
+            try:
+                os.link(os.path.realpath(input_file), linked_file)
+            except OSError:
+                shutil.copy(input_file, linked_file)
+
+        # run chunked_call
+        run("dockered_chunked_call --overwrite --threads {} --overlap {} --start {} --end {} {} {} {} {} {} {}".format(
+            job.cores, options.call_overlap, region.start, region.end,
+            os.path.join(variant_call_dir, os.path.basename(xg_file)),
+            os.path.join(variant_call_dir, os.path.basename(alignment_file)),
+            region.contig, region.contig_length, options.sample_name, variant_call_dir))
+
+        # save variant calling results to the output store
+        vcf_file = "{}/{}.vcf.gz".format(variant_call_dir, region.contig)
+        vcf_file_key = region_key(region)
+        vcf_file_idx = "{}.tbi".format(vcf_file)   
+
+        out_store.write_output_files([(vcf_file, vcf_file_key),
+            (vcf_file_idx, vcf_file_key + ".tbi")], threads=options.upload_threads)
+        finish_stage(options, out_store, "calling/{}_{}".format(
+            options.sample_name, vcf_file_key), CALL_OPTIONS,
+            [vcf_file_key, vcf_file_key + ".tbi"])
+        vcf_file_keys.append((region.order, vcf_file_key))
+
+        # Don't fill the disk with chunks
+        shutil.rmtree(variant_call_dir)
  
-    RealTimeLogger.get().info("Completed variant calling on path {} from alignment file {}".format(path_name, alignment_file_key))
+    RealTimeLogger.get().info("Completed variant calling on {} from alignment file {}".format(
+        ", ".join(key for _, key in vcf_file_keys), alignment_file_key))
 
-    return vcf_file_key
+    return vcf_file_keys
 
+@instrumented
 def run_upload(job, options, uploadList):
     """
     Upload and file in uploadList to the remote IO store specified
@@ -961,8 +1008,27 @@ def main(args):
         # Run the tests
         return doctest.testmod(optionflags=doctest.NORMALIZE_WHITESPACE)
 
-    RealTimeLogger.start_master()
     options = parse_args(args) # This holds the nicely-parsed options object
+
+    if options.plan_only:
+        # Just say how we would split up the alignment. We don't have the index
+        # yet, so guess its size from the graph.
+        plan = plan_alignment(options, estimate_read_count(options.sample_reads),
+            os.path.getsize(options.vg_graph) * INDEX_GRAPH_RATIO)
+        print("Alignment plan: {}".format(describe_plan(plan)))
+        return 0
+
+    # Finished stages are only reused if the input files haven't changed since,
+    # so note what they are now
+    options.vg_graph_identity = file_identity(options.vg_graph)
+    options.sample_reads_identity = file_identity(options.sample_reads)
+
+    RealTimeLogger.start_master()
+    
+    # Collect the jobs' timing and resource measurements as they come in
+    metrics_collector = MetricsCollector().install()
+    # And where the time in their containers goes
+    docker_collector = DockerProfileCollector().install()
     
     with Toil(options) as toil:
         if not toil.options.restart:
@@ -983,6 +1049,13 @@ def main(args):
         # Download output files to the local machine that runs this script
         run_download(toil, options, outputFileIDList)
     
+    # Save the per-job timeline next to the outputs
+    for timeline_file in metrics_collector.write(options.out_dir):
+        RealTimeLogger.get().info("Wrote job timeline {}".format(timeline_file))
+    if docker_collector.events:
+        print(docker_collector.report())
+        docker_collector.write(options.out_dir)
+    
     print("All jobs completed successfully")
     
     RealTimeLogger.stop_master()